@@ -0,0 +1,70 @@
+"""
+Items per second of /dicom-upsert/batch and /dicom-delete/batch.
+
+Posts synthetic patient/study/series/image quadruples to a running Flask
+service, in batches and, with --single, one /dicom-upsert per item as the
+baseline. Every document belongs to a BENCH-<run> patient; its studies,
+series and images are removed with /dicom-delete/batch at the end, which
+is timed as well. The route leaves the patient document in place.
+
+    python bench/batch_upsert.py http://localhost:8082 --items 5000 --batch-size 500 --single
+"""
+import argparse
+import time
+import uuid
+
+import requests
+
+
+def make_item(run_id, index, images_per_series):
+    patient_id = f"BENCH-{run_id}"
+    study_id = f"{run_id}.{index // (images_per_series * 4)}"
+    series_id = f"{study_id}.{index // images_per_series}"
+    return {
+        "metadata_patient": {"patient_id": patient_id, "patient_name": "BENCH^PATIENT"},
+        "metadata_study": {"patient_id": patient_id, "study_id": study_id},
+        "metadata_series": {"patient_id": patient_id, "study_id": study_id, "series_id": series_id},
+        "metadata_image": {"patient_id": patient_id, "study_id": study_id, "series_id": series_id,
+                           "image_uid": f"{series_id}.{index}", "path": f"/bench/{run_id}/{index}.dcm"},
+    }
+
+
+def report(label, count, elapsed):
+    print(f"{label:>14}: {count} items in {elapsed:.2f}s, {count / elapsed:.1f} items/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("base_url")
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--images-per-series", type=int, default=50)
+    parser.add_argument("--single", action="store_true", help="also time one /dicom-upsert request per item")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    items = [make_item(run_id, index, args.images_per_series) for index in range(args.items)]
+    session = requests.Session()
+
+    start = time.perf_counter()
+    for offset in range(0, len(items), args.batch_size):
+        response = session.post(f"{args.base_url}/dicom-upsert/batch", json={"items": items[offset:offset + args.batch_size]})
+        response.raise_for_status()
+    report("batch upsert", len(items), time.perf_counter() - start)
+
+    if args.single:
+        start = time.perf_counter()
+        for item in items:
+            session.post(f"{args.base_url}/dicom-upsert", json=item).raise_for_status()
+        report("single upsert", len(items), time.perf_counter() - start)
+
+    studies = sorted({(item["metadata_study"]["patient_id"], item["metadata_study"]["study_id"]) for item in items})
+    start = time.perf_counter()
+    response = session.post(f"{args.base_url}/dicom-delete/batch",
+                            json={"items": [{"patient_id": patient_id, "study_id": study_id} for patient_id, study_id in studies]})
+    response.raise_for_status()
+    report("batch delete", len(items), time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
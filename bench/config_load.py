@@ -0,0 +1,58 @@
+"""
+Latency of loading the configuration.
+
+Cold: a fresh interpreter imports utils.config and calls init(), timed
+inside the child so interpreter startup is excluded. Warm: repeated
+init() calls in this process, which return the loaded settings. Neither
+makes a network call; the remote values are fetched on first access.
+
+    python bench/config_load.py --cold 20 --warm 100000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHILD = (
+    "import time; start = time.perf_counter(); "
+    "from utils import config; config.init(); "
+    "print((time.perf_counter() - start) * 1000)"
+)
+
+
+def summary(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:>5}: mean {statistics.mean(samples):.3f} ms, median {statistics.median(samples):.3f} ms, "
+          f"p95 {p95:.3f} ms over {len(samples)} runs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cold", type=int, default=10, help="fresh interpreters to start")
+    parser.add_argument("--warm", type=int, default=10000, help="init() calls in this process")
+    args = parser.parse_args()
+
+    cold = []
+    for _ in range(args.cold):
+        output = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, capture_output=True, text=True, check=True)
+        cold.append(float(output.stdout.strip().splitlines()[-1]))
+    summary("cold", cold)
+
+    from utils import config
+    config.init()
+    warm = []
+    for _ in range(args.warm):
+        start = time.perf_counter()
+        config.init()
+        warm.append((time.perf_counter() - start) * 1000)
+    summary("warm", warm)
+
+
+if __name__ == "__main__":
+    main()
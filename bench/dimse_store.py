@@ -0,0 +1,90 @@
+"""
+C-STORE throughput against the SCP, in MB/s and instances/s.
+
+Sends every DICOM file below a directory over one or more associations.
+The calling AE title selects the per-AE DIMSE profile of the SCP, and
+--max-pdu sets the PDU size this SCU proposes, so profiles can be
+compared run against run.
+
+    python bench/dimse_store.py /data/dicom localhost 11112 --called-ae ROUTER --calling-ae CT01 --associations 2
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom import dcmread
+from pydicom.filereader import read_file_meta_info
+from pynetdicom import AE, build_context
+
+# An association negotiates at most 128 presentation contexts
+MAX_CONTEXTS = 128
+
+
+def load(directory):
+    files, contexts = [], {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                meta = read_file_meta_info(path)
+            except Exception:
+                continue
+            files.append((path, os.path.getsize(path)))
+            contexts.setdefault(meta.MediaStorageSOPClassUID, set()).add(meta.TransferSyntaxUID)
+    return files, [build_context(sop_class, sorted(syntaxes)) for sop_class, syntaxes in contexts.items()]
+
+
+def send(args, contexts, chunk):
+    ae = AE(ae_title=args.calling_ae)
+    ae.maximum_pdu_size = args.max_pdu
+    ae.requested_contexts = contexts
+    assoc = ae.associate(args.host, args.port, ae_title=args.called_ae)
+    if not assoc.is_established:
+        raise RuntimeError("Association rejected or aborted")
+
+    sent, failed = 0, 0
+    try:
+        for path, size in chunk:
+            status = assoc.send_c_store(dcmread(path))
+            if status and status.Status == 0x0000:
+                sent += size
+            else:
+                failed += 1
+    finally:
+        assoc.release()
+    return sent, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("directory")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--called-ae", default="ANY-SCP")
+    parser.add_argument("--calling-ae", default="BENCH")
+    parser.add_argument("--max-pdu", type=int, default=16382, help="0 is unlimited")
+    parser.add_argument("--associations", type=int, default=1)
+    args = parser.parse_args()
+
+    files, contexts = load(args.directory)
+    if not files:
+        parser.error(f"no DICOM files below {args.directory}")
+    if len(contexts) > MAX_CONTEXTS:
+        sys.exit(f"{len(contexts)} SOP classes, more than the {MAX_CONTEXTS} contexts of an association")
+
+    chunks = [files[i::args.associations] for i in range(args.associations)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.associations) as executor:
+        results = list(executor.map(lambda chunk: send(args, contexts, chunk), chunks))
+    elapsed = time.perf_counter() - start
+
+    sent = sum(size for size, _ in results)
+    failed = sum(count for _, count in results)
+    print(f"{len(files) - failed} instances, {sent / 1e6:.1f} MB in {elapsed:.2f}s: "
+          f"{sent / elapsed / 1e6:.1f} MB/s, {(len(files) - failed) / elapsed:.1f} instances/s, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
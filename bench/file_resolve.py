@@ -0,0 +1,77 @@
+"""
+Throughput of /file/resolve: full downloads, byte ranges and revalidation.
+
+The file has to be below FILE_RESOLVE_DIR of the running Flask service.
+Full downloads report MB/s; range and If-None-Match requests report
+requests/s and check for 206 and 304 answers.
+
+    python bench/file_resolve.py http://localhost:8082 /var/www/lts-temp/study.zip --requests 200 --threads 8
+"""
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def run(label, count, threads, request):
+    local = threading.local()
+
+    def one(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return request(local.session)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(one, range(count)))
+    elapsed = time.perf_counter() - start
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    transferred = sum(size for _, size in results)
+    print(f"{label:>11}: {count / elapsed:.1f} req/s, {transferred / elapsed / 1e6:.1f} MB/s, statuses {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("base_url")
+    parser.add_argument("path", help="path of the file on the server")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--range-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    url = f"{args.base_url}/file/resolve"
+    params = {"path": args.path}
+    head = requests.get(url, params=params, stream=True)
+    head.raise_for_status()
+    size = int(head.headers["Content-Length"])
+    etag = head.headers.get("ETag")
+    head.close()
+    print(f"{args.path}: {size} bytes, ETag {etag}, Cache-Control {head.headers.get('Cache-Control')}")
+
+    def full(session):
+        response = session.get(url, params=params)
+        return response.status_code, len(response.content)
+
+    def ranged(session):
+        first = random.randrange(max(1, size - args.range_size))
+        response = session.get(url, params=params, headers={"Range": f"bytes={first}-{first + args.range_size - 1}"})
+        return response.status_code, len(response.content)
+
+    def revalidate(session):
+        response = session.get(url, params=params, headers={"If-None-Match": etag})
+        return response.status_code, len(response.content)
+
+    run("full", args.requests, args.threads, full)
+    run("range", args.requests, args.threads, ranged)
+    if etag:
+        run("revalidate", args.requests, args.threads, revalidate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Load test of the ServiceRequest intake on the HTTP server.
+
+Each client thread keeps one HTTP/1.1 connection and POSTs the payload
+(a ServiceRequest or a Bundle, as JSON) in a loop, reconnecting whenever
+the server closes it. --idle opens extra connections that send one
+request and then stay silent, as idle keep-alive clients do, to check
+they no longer starve the worker pool.
+
+    python bench/http_intake.py localhost 8083 servicerequest.json --clients 16 --requests 200 --idle 16
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+
+
+def post(connection, path, body):
+    connection.request("POST", path, body=body, headers={"Content-Type": "application/fhir+json"})
+    response = connection.getresponse()
+    response.read()
+    return response.status, response.getheader("Connection", "").lower() == "close"
+
+
+def client(args, path, body, results):
+    connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        try:
+            status, closed = post(connection, path, body)
+        except (http.client.HTTPException, OSError):
+            # Closed by the server between requests, e.g. after its idle timeout
+            connection.close()
+            connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+            status, closed = post(connection, path, body)
+        results.append((time.perf_counter() - start, status, closed))
+        if closed:
+            connection.close()
+            connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("payload", help="JSON file with a ServiceRequest or a Bundle")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per client")
+    parser.add_argument("--idle", type=int, default=0, help="idle keep-alive connections held open")
+    args = parser.parse_args()
+
+    with open(args.payload) as fp:
+        resource = json.load(fp)
+    body = json.dumps(resource).encode("utf-8")
+    path = "/fhir/ServiceRequest" if resource.get("resourceType") == "ServiceRequest" else "/fhir/Bundle"
+
+    idle = []
+    for _ in range(args.idle):
+        connection = http.client.HTTPConnection(args.host, args.port, timeout=60)
+        post(connection, path, body)
+        idle.append(connection)
+
+    results = []
+    threads = [threading.Thread(target=client, args=(args, path, body, results)) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for connection in idle:
+        connection.close()
+
+    latencies = sorted(latency * 1000 for latency, _, _ in results)
+    statuses = {}
+    for _, status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    closed = sum(1 for _, _, closed in results if closed)
+    print(f"{len(results)} requests in {elapsed:.2f}s: {len(results) / elapsed:.1f} req/s, statuses {statuses}")
+    print(f"latency p50 {statistics.median(latencies):.1f} ms, p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms, "
+          f"max {latencies[-1]:.1f} ms; {closed} responses with Connection: close")
+
+
+if __name__ == "__main__":
+    main()
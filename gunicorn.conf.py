@@ -0,0 +1,50 @@
+"""
+Gunicorn settings for serving the Flask API in production (FLASK_MODE=production).
+
+Each worker is a separate process importing the app on its own, so Flask
+requests no longer share the GIL with the DICOM SCP. Send HUP to the master
+process to reload the workers gracefully.
+
+State shared by the workers lives outside of them: /sync jobs and their
+single-flight in the sync_job SQLite table, /to-satusehat jobs in the
+integration_job collection (leases plus a unique index over active jobs),
+WhatsApp notifications in whatsapp_notification with the rate limit split
+across the workers registered in whatsapp_queue_member. What stays per worker is safe to duplicate: the
+preview process pool writes its cache atomically, and the metadata writer
+only batches idempotent upserts.
+"""
+import logging
+import os
+
+from dotenv import load_dotenv
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('FLASK_PORT', 8082)}"
+workers = int(os.getenv('FLASK_WORKERS', os.cpu_count() or 2))
+threads = int(os.getenv('FLASK_THREADS', 4))  # Threads per worker, uses the gthread worker when > 1
+timeout = int(os.getenv('FLASK_TIMEOUT', 120))  # Seconds before a silent worker is restarted
+graceful_timeout = int(os.getenv('FLASK_GRACEFUL_TIMEOUT', 30))  # Seconds to finish requests on reload/stop
+keepalive = int(os.getenv('FLASK_KEEPALIVE', 5))
+max_requests = int(os.getenv('FLASK_MAX_REQUESTS', 0))  # Recycle workers after N requests, 0 disables
+max_requests_jitter = max_requests // 10
+
+# Workers import the app after the fork, so no Mongo client, thread or
+# executor is ever inherited from the master
+preload_app = False
+
+accesslog = os.getenv('FLASK_ACCESS_LOG')  # e.g. "-" for stdout, unset disables
+errorlog = os.getenv('FLASK_ERROR_LOG', 'dicom_router_inotify.log')
+
+
+def post_fork(server, worker):
+    logging.getLogger("flask_server").info(f"[Init] - Flask worker {worker.pid} started")
+
+
+def post_worker_init(worker):
+    # Resume persisted jobs now rather than on the first request to their endpoints
+    from internal.flask_server import start_background_workers
+    start_background_workers()
+
+
+def worker_abort(worker):
+    logging.getLogger("flask_server").error(f"[Init] - Flask worker {worker.pid} timed out and was aborted")
@@ -1,10 +1,11 @@
 import logging
 import os
 import requests
+from datetime import datetime
+from urllib.parse import quote
 
 from utils.dbquery import DBQuery
-from utils import oauth2, halosis_config
-from utils.dicomutils import make_hash
+from utils import config, halosis_config
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -112,10 +113,21 @@ def send_to_whatsapp(bearer_token, patientPhoneNumber, previewImage, patientName
 
 
 def get_service_request(accessionNumber):
-    """Retrieve a ServiceRequest based on the accession number."""
+    """
+    Retrieve a ServiceRequest based on the accession number.
+
+    The local service_request table, kept up to date by the ServiceRequest
+    synchronizer, is consulted first; SATUSEHAT is only queried on a miss.
+    """
+    rows = dbq.query(dbq.GET_SERVICE_REQUEST_BY_ACSN, [accessionNumber])
+    # A row without Patient reference cannot resolve the patient, treat it as a miss
+    if rows and rows[0]["patient_id"]:
+        LOGGER.info(f"ServiceRequest for accession {accessionNumber} resolved locally")
+        return rows[0]["id"], rows[0]["patient_id"]
+
     headers = {
         "Accept": "application/json",
-        "Authorization": f"Bearer {oauth2.token}",
+        "Authorization": f"Bearer {config.token}",
         'User-Agent': 'PostmanRuntime/7.26.8',
     }
     path = (f"{fhir_pathsuffix}/ServiceRequest?identifier=http://sys-ids.kemkes.go.id/acsn/"
@@ -125,12 +137,55 @@ def get_service_request(accessionNumber):
     data = response.json()
 
     if data.get("resourceType") == "Bundle" and data.get("total", 0) >= 1:
-        _, patientID = data["entry"][0]["resource"]["subject"]["reference"].split("/")
-        return data["entry"][0]["resource"]["id"], patientID
+        resource = data["entry"][0]["resource"]
+        _, patientID = resource["subject"]["reference"].split("/")
+        dbq.insert(dbq.UPSERT_SERVICE_REQUEST, service_request_row(resource))
+        return resource["id"], patientID
 
     raise Exception("ServiceRequest not found")
 
 
+def service_request_row(resource):
+    """Build a service_request table row from a ServiceRequest resource."""
+    accession_number = next(
+        (idf.get("value") for idf in resource.get("identifier", [])
+         if idf.get("system") == f"http://sys-ids.kemkes.go.id/acsn/{organization_id}"),
+        None
+    )
+    reference = (resource.get("subject") or {}).get("reference", "")
+    patient_id = reference.split("/")[-1] if reference.startswith("Patient/") else None
+    last_updated = (resource.get("meta") or {}).get("lastUpdated")
+    return (resource.get("id"), accession_number, patient_id, last_updated)
+
+
+def search_service_requests(token, since=None, page_url=None, count=100):
+    """
+    Retrieve one page of this organization's ServiceRequests updated since `since`.
+
+    Returns the resources on the page and the URL of the next page, if any.
+    """
+    headers = {
+        "Accept": "application/json",
+        "Authorization": f"Bearer {token}",
+        'User-Agent': 'PostmanRuntime/7.26.8',
+    }
+    if page_url is None:
+        path = (f"{fhir_pathsuffix}/ServiceRequest?identifier=http://sys-ids.kemkes.go.id/acsn/"
+                f"{organization_id}%7C&_sort=_lastUpdated&_count={count}")
+        if since:
+            # Offsets such as +07:00 would otherwise be decoded as a space
+            path += f"&_lastUpdated=ge{quote(since, safe='')}"
+        page_url = f"{url}{path}"
+
+    response = requests.get(url=page_url, headers=headers)
+    response.raise_for_status()
+    data = response.json()
+
+    resources = [entry["resource"] for entry in data.get("entry", []) if "resource" in entry]
+    next_url = next((link["url"] for link in data.get("link", []) if link.get("relation") == "next"), None)
+    return resources, next_url
+
+
 def get_imaging_study(accessionNumber, token):
     """Retrieve an ImagingStudy based on the accession number."""
     headers = {
@@ -154,7 +209,7 @@ def get_imaging_study(accessionNumber, token):
 def imagingstudy_post(filename, id):
     """Post or update an ImagingStudy."""
     headers = {
-        "Authorization": f"Bearer {oauth2.token}",
+        "Authorization": f"Bearer {config.token}",
         "Content-Type": "application/json",
         'User-Agent': 'PostmanRuntime/7.26.8',
     }
@@ -174,41 +229,41 @@ def imagingstudy_post(filename, id):
     raise Exception("POST ImagingStudy failed")
 
 
-def dicom_push(assocId, study_iuid, imagingStudyID):
-    """Push DICOM instances to the server."""
+def dicom_push(study_iuid, imagingStudyID):
+    """Push the DICOM instances of a study that have not been sent yet."""
     if imagingStudyID is None:
         return None
 
     LOGGER.info("DICOM Push started")
-    subdir = make_hash(assocId)
     LOGGER.info(f"DICOM Push ImagingStudyID: {imagingStudyID}")
 
     headers = {
         "Content-Type": "application/dicom",
         "Accept": "application/dicom+json",
-        "Authorization": f"Bearer {oauth2.token}",
+        "Authorization": f"Bearer {config.token}",
         "X-ImagingStudy-ID": imagingStudyID,
         'User-Agent': 'PostmanRuntime/7.26.8',
     }
 
-    instances = dbq.Query(dbq.GET_INSTANCES_PER_STUDY, [assocId, study_iuid])
+    # One staged file per instance, whichever associations delivered it;
+    # instances sent before (streaming, earlier associations) are skipped
+    instances = dbq.query(dbq.GET_UNSENT_INSTANCES_PER_STUDY, [study_iuid])
 
-    for series_iuid, instance_uid in instances:
-        filename = os.path.join(os.getcwd(), dcm_dir, subdir, study_iuid, series_iuid, f"{instance_uid}.dcm")
+    for series_iuid, instance_uid, filename, last_id, sha256 in instances:
+        sent = (study_iuid, series_iuid, instance_uid, last_id, sha256)
         try:
             with open(filename, "rb") as payload:
                 response = requests.post(url=f"{url}{dicom_pathsuffix}", data=payload, headers=headers)
 
             if response.status_code == 200:
                 LOGGER.info(f"Sending Instance UID: {series_iuid}/{instance_uid} success")
-                dbq.Update(dbq.UPDATE_INSTANCE_STATUS_SENT, [assocId, study_iuid, series_iuid, instance_uid])
+                mark_instance_sent(*sent)
             else:
                 LOGGER.error(f"Error sending Instance UID {instance_uid}: {response.json()}")
                 if "Instance already exists" in response.text:
+                    # The staged file is shared by every association of the study, keep it
                     LOGGER.warning("Image already exists")
-                    os.remove(filename)  # Remove the DICOM file if it already exists
-                    # Remove Series UID Folder if Empty
-                    os.rmdir(os.path.dirname(filename))
+                    mark_instance_sent(*sent)
         except Exception as e:
             LOGGER.error(f"Sending DICOM failed: {e}")
             raise Exception("Sending DICOM failed")
@@ -216,6 +271,18 @@ def dicom_push(assocId, study_iuid, imagingStudyID):
     return True
 
 
+def mark_instance_sent(study_iuid, series_iuid, instance_uid, last_id, sha256):
+    """
+    Record an instance as sent, for the associations that delivered it and for its staged content.
+
+    Only rows up to `last_id`, read before the push, and the content hashed
+    `sha256` are marked: an instance received again meanwhile is sent on
+    the next pass.
+    """
+    dbq.update(dbq.UPDATE_INSTANCE_STATUS_SENT, [study_iuid, series_iuid, instance_uid, last_id])
+    dbq.update(dbq.UPDATE_INSTANCE_STORE_SENT, [datetime.now().isoformat(), instance_uid, sha256])
+
+
 def get_dcm_config(token):
     """Retrieve DICOM configuration."""
     headers = {
@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+
+from pynetdicom import AE
+from pynetdicom.association import Association
+
+from utils.dbquery import DBQuery
+
+# Logger initialization
+LOGGER = logging.getLogger("pynetdicom")
+
+# C-STORE status returned when a calling AE has too many stores in flight
+STATUS_OUT_OF_RESOURCES = 0xA700
+
+# Kinds of admission slots
+ASSOCIATION, STORE = "association", "store"
+
+# Stands for "no limit" in the slot query
+_UNLIMITED = 2 ** 31
+
+
+class AdmissionController:
+    """
+    Per-calling-AE limits on concurrent associations and in-flight C-STOREs.
+
+    A limit of 0 means unlimited. Associations over their AE's limit are
+    rejected the way pynetdicom rejects associations over
+    AE.maximum_associations: rejected-transient, service-provider
+    (presentation), local-limit-exceeded. C-STOREs over the limit are
+    answered with Out of Resources (0xA700).
+
+    Slots are rows of the admission_slot SQLite table, taken with a single
+    conditional INSERT, so the limits, including the global
+    `max_associations`, hold across all SCP worker processes rather than
+    per process. Slots of a worker that exits are dropped by
+    release_process(); every slot is dropped when the controller is created.
+    """
+
+    def __init__(self, ae_limits=None, default_associations=0, default_stores=0, max_associations=0):
+        self.ae_limits = ae_limits or {}
+        self.default_limits = (default_associations, default_stores)
+        self.max_associations = max_associations
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.dbq = DBQuery()
+        self.dbq.delete(self.dbq.CLEAR_ADMISSION_SLOTS, ())
+
+    def _limits(self, ae_title):
+        return self.ae_limits.get(ae_title, self.default_limits)
+
+    def _count(self, ae_title, counter):
+        with self.lock:
+            counters = self.counters.setdefault(ae_title, {
+                "accepted": 0, "rejected": 0, "stores": 0, "stores_refused": 0
+            })
+            counters[counter] += 1
+
+    def _take(self, ae_title, kind, ae_limit, total_limit=0):
+        """Take a slot of `kind` for `ae_title` unless a limit is reached. Returns True on success."""
+        return bool(self.dbq.update(self.dbq.TAKE_ADMISSION_SLOT, (
+            ae_title, kind, os.getpid(),
+            ae_title, kind, ae_limit or _UNLIMITED,
+            kind, total_limit or _UNLIMITED,
+        )))
+
+    def _free(self, ae_title, kind):
+        self.dbq.delete(self.dbq.FREE_ADMISSION_SLOT, (ae_title, kind, os.getpid()))
+
+    def admit(self, ae_title):
+        """Reserve an association slot for `ae_title`. Returns False when its limit or the global one is reached."""
+        if not self._take(ae_title, ASSOCIATION, self._limits(ae_title)[0], self.max_associations):
+            self._count(ae_title, "rejected")
+            LOGGER.warning(f"Rejecting association from {ae_title}: association limit reached")
+            return False
+        self._count(ae_title, "accepted")
+        return True
+
+    def release(self, ae_title):
+        """Free the association slot of `ae_title`."""
+        self._free(ae_title, ASSOCIATION)
+
+    def begin_store(self, ae_title):
+        """Reserve an in-flight C-STORE for `ae_title`. Returns False when its limit is reached."""
+        limit = self._limits(ae_title)[1]
+        # Unlimited stores need no shared slot
+        if limit and not self._take(ae_title, STORE, limit):
+            self._count(ae_title, "stores_refused")
+            return False
+        self._count(ae_title, "stores")
+        return True
+
+    def end_store(self, ae_title):
+        if self._limits(ae_title)[1]:
+            self._free(ae_title, STORE)
+
+    def release_process(self, pid):
+        """Drop the slots held by a worker process that exited."""
+        self.dbq.delete(self.dbq.FREE_ADMISSION_SLOTS_OF_PROCESS, (pid,))
+
+    def limit_store(self, handler):
+        """Wrap an EVT_C_STORE handler so it answers Out of Resources over the AE's limit."""
+        def handle_store(event, *args):
+            ae_title = calling_ae_title(event.assoc)
+            if not self.begin_store(ae_title):
+                LOGGER.warning(f"Refusing C-STORE from {ae_title}: in-flight limit reached")
+                return STATUS_OUT_OF_RESOURCES
+            try:
+                return handler(event, *args)
+            finally:
+                self.end_store(ae_title)
+        return handle_store
+
+    def handle_requested(self, event):
+        """EVT_REQUESTED handler taking an association slot for the calling AE, see AdmissionAE."""
+        assoc = event.assoc
+        if not hasattr(assoc, "_admitted"):
+            assoc._admitted = self.admit(calling_ae_title(assoc))
+
+    def handle_closed(self, event):
+        """EVT_CONN_CLOSE handler freeing the slot of an admitted association, however it ended."""
+        if getattr(event.assoc, "_admitted", False):
+            event.assoc._admitted = False
+            self.release(calling_ae_title(event.assoc))
+
+    def metrics(self):
+        """Return active associations and in-flight C-STOREs across processes, and this process's counters, per calling AE."""
+        active = {}
+        for row in self.dbq.query(self.dbq.COUNT_ADMISSION_SLOTS) or []:
+            active.setdefault(row["ae_title"], {})[row["kind"]] = row["slots"]
+        with self.lock:
+            counters = {ae_title: dict(values) for ae_title, values in self.counters.items()}
+        return {
+            ae_title: {
+                "associations": active.get(ae_title, {}).get(ASSOCIATION, 0),
+                "stores_in_flight": active.get(ae_title, {}).get(STORE, 0),
+                "limits": dict(zip(("associations", "stores"), self._limits(ae_title))),
+                **counters.get(ae_title, {}),
+            }
+            for ae_title in sorted(set(active) | set(counters))
+        }
+
+
+def calling_ae_title(assoc):
+    """Return the calling AE title of an association request, without padding."""
+    title = assoc.requestor.primitive.calling_ae_title
+    if isinstance(title, bytes):
+        title = title.decode("ascii", "replace")
+    return title.strip()
+
+
+class AdmissionAE(AE):
+    """
+    AE rejecting the associations refused by AdmissionController.handle_requested.
+
+    pynetdicom offers no documented way to reject an association request
+    from a handler. It does reject requests while more than
+    `maximum_associations` are active: ACSE.negotiate_as_acceptor() reads
+    `len(self.assoc.ae.active_associations)` on the negotiating thread,
+    after EVT_REQUESTED, and answers rejected-transient, service-provider
+    (presentation), local-limit-exceeded. For an association refused in
+    EVT_REQUESTED, this property reports the list as full on that thread
+    only. Reading it has no side effect; the admission decision is taken by
+    the handler. This relies on pynetdicom 2.0.2, pinned in conda_env/.
+    """
+
+    @property
+    def active_associations(self):
+        associations = super().active_associations
+        current = threading.current_thread()
+        if (isinstance(current, Association) and current.is_acceptor and not current.is_established
+                and getattr(current, "_admitted", True) is False):
+            return associations + [current] * (self.maximum_associations + 1)
+        return associations
@@ -1,6 +1,11 @@
+import hashlib
+import io
 import logging
 import os
 import requests
+import threading
+import time
+from datetime import datetime
 
 from pydicom import dcmread
 from pydicom.dataset import Dataset
@@ -9,9 +14,10 @@ from interface import satusehat
 from utils.dbquery import DBQuery
 from utils.findquery import FindQuery
 from utils.dicom2fhir import process_dicom_to_fhir
-from utils.dicomutils import make_association_id, make_hash
+from utils.dicomutils import make_association_id, read_metas, requested_contexts, transfer_syntaxes_by_sop_class
+from utils.mongodb import connect_mongodb
 
-from utils import oauth2
+from utils import config
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -54,6 +60,13 @@ _ATTRIBUTES = {
     "InstanceNumber": ("IMAGE", "R", "UI", 1),
 }
 
+# Requested presentation contexts per C-MOVE destination, reused across moves
+_move_contexts = {}
+_move_contexts_lock = threading.Lock()
+
+# Seconds between attempts to claim a study being uploaded elsewhere
+_CLAIM_POLL_INTERVAL = 1.0
+
 
 def handle_echo(event, logger):
     """Handles the C-ECHO request."""
@@ -65,7 +78,7 @@ def handle_echo(event, logger):
     return 0x0000
 
 
-def handle_store(event, dcm_dir, logger):
+def handle_store(event, dcm_dir, logger, streamer=None, mpps=None):
     """Handles a C-STORE request event."""
     LOGGER.info("Handling C-STORE request.")
 
@@ -76,9 +89,9 @@ def handle_store(event, dcm_dir, logger):
     ds = event.dataset
     ds.file_meta = event.file_meta
 
-    # Generate paths and association details
+    # Generate paths and association details; staging is shared by every association
     assocId = make_association_id(event)
-    subdir = os.path.join(make_hash(assocId), ds.StudyInstanceUID, ds.SeriesInstanceUID)
+    subdir = os.path.join(ds.StudyInstanceUID, ds.SeriesInstanceUID)
 
     # Ensure the directory exists
     try:
@@ -88,7 +101,7 @@ def handle_store(event, dcm_dir, logger):
         LOGGER.warning("Directory already exists.")
 
     filename = os.path.join(dcm_dir, subdir, f"{ds.SOPInstanceUID}.dcm")
-    ds.save_as(filename, write_like_original=False)
+    sent_status = stage_instance(dbq, ds, filename)
 
     # Insert entry into the database
     scu_ae = event.assoc.requestor.primitive.calling_ae_title
@@ -101,84 +114,81 @@ def handle_store(event, dcm_dir, logger):
         ds.StudyInstanceUID,
         ds.SeriesInstanceUID,
         ds.SOPInstanceUID,
-        filename
+        filename,
+        sent_status
     )
 
     try:
-        dbq.Insert(dbq.INSERT_SOP, entry)
+        dbq.insert(dbq.INSERT_SOP, entry)
     except Exception as e:
         LOGGER.error(f"Failed to insert SOP entry into database: {e}")
 
+    if streamer:
+        streamer.touch(assocId, ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.AccessionNumber)
+    if mpps:
+        mpps.instance_stored(ds.StudyInstanceUID)
+
     return 0x0000
 
 
-def handle_assoc_released(event, dcm_dir, organization_id, mroc_client_url, encrypt, logger):
+def stage_instance(dbq, ds, filename):
+    """
+    Write an instance to the staging store unless identical content is already there.
+
+    The encoded file is hashed (SHA-256) and recorded in instance_store.
+    An identical re-send leaves the staged file untouched; changed content
+    replaces it atomically and has to be sent again.
+
+    Returns:
+        int: 1 when this exact content has already been sent, else 0.
+    """
+    buffer = io.BytesIO()
+    ds.save_as(buffer, write_like_original=False)
+    data = buffer.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+
+    stored = dbq.query(dbq.GET_INSTANCE_STORE, [ds.SOPInstanceUID])
+    stored = stored[0] if stored else None
+    identical = stored is not None and stored["sha256"] == digest
+    if identical and os.path.isfile(stored["fs_location"]):
+        LOGGER.info(f"Instance {ds.SOPInstanceUID} already staged with identical content, skipping write")
+        return stored["sent_status"]
+
+    temp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_filename, "wb") as out_file:
+        out_file.write(data)
+    os.replace(temp_filename, filename)
+
+    dbq.insert(dbq.UPSERT_INSTANCE_STORE, (
+        ds.SOPInstanceUID, ds.StudyInstanceUID, ds.SeriesInstanceUID, filename, digest, len(data),
+        datetime.now().isoformat()
+    ))
+    return stored["sent_status"] if identical else 0
+
+
+def handle_assoc_released(event, dcm_dir, organization_id, mroc_client_url, encrypt, logger, streamer=None):
     """Handles an ASSOCIATION RELEASE event."""
     dbq = DBQuery()
     global token
-    token = oauth2.get_token()
+    token = config.token
 
     assocId = make_association_id(event)
+    if streamer:
+        streamer.finish(assocId)
 
     try:
-        imagingStudyID = None
-        dbq.Update(dbq.UPDATE_ASSOC_COMPLETED, [assocId])
-        ids = dbq.Query(dbq.GET_IDS_PER_ASSOC, [assocId])
+        dbq.update(dbq.UPDATE_ASSOC_COMPLETED, [assocId])
+        ids = dbq.query(dbq.GET_IDS_PER_ASSOC, [assocId])
 
         if len(ids) > 0:
             LOGGER.info("Processing DICOM files.")
 
         for study in ids:
             study_iuid, accession_no = study[0], study[1]
-            LOGGER.info(f"Accession Number: {accession_no}, Study IUID: {study_iuid}")
-
-            imagingStudyID = satusehat.get_imaging_study(accession_no, token)
-            study_dir = os.path.join(dcm_dir, make_hash(assocId), study_iuid)
-
-            # Obtain Patient ID and ServiceRequest ID
-            try:
-                serviceRequestID, patientID = satusehat.get_service_request(accession_no)
-                LOGGER.info("Successfully obtained Patient ID and ServiceRequest ID.")
-            except Exception as e:
-                LOGGER.error("Failed to obtain Patient ID and ServiceRequest ID.", exc_info=True)
-                continue
-
-            # Post files to MROC client backend
-            if encrypt:
-                try:
-                    LOGGER.info("Posting files to MROC client backend.")
-                    response = post_files_to_mroc_client(patientID, organization_id, study_dir, accession_no, mroc_client_url)
-                    LOGGER.info(f"Response from MROC client: {response}")
-                except Exception as e:
-                    LOGGER.error(f"Failed to POST to MROC client backend: {e}")
-
-            # Create ImagingStudy
-            try:
-                imagingStudy = process_dicom_to_fhir(study_dir, imagingStudyID, serviceRequestID, patientID)
-                output = os.path.join(study_dir, "ImagingStudy.json")
-                with open(output, 'w') as out_file:
-                    out_file.write(imagingStudy.json(indent=2))
-                LOGGER.info(f"ImagingStudy {study_iuid} created.")
-            except Exception as e:
-                LOGGER.error(f"Failed to create ImagingStudy for {study_iuid}: {e}")
-
-            # Post ImagingStudy to server
-            try:
-                imaging_study_json = os.path.join(study_dir, "ImagingStudy.json")
-                id = satusehat.imagingstudy_post(imaging_study_json, imagingStudyID or None)
-                LOGGER.info(f"ImagingStudy POST-ed successfully, id: {id}")
-            except Exception as e:
-                LOGGER.error(f"Failed to POST ImagingStudy: {e}")
-
-            # Push DICOM files
-            try:
-                satusehat.dicom_push(assocId, study_iuid, imagingStudyID)
-                LOGGER.info("DICOM files sent successfully.")
-            except Exception as e:
-                LOGGER.error("Failed to send DICOM files.", exc_info=True)
+            process_study(assocId, study_iuid, accession_no, dcm_dir, organization_id, mroc_client_url, encrypt, final=True)
 
         # Check if all instances are sent and delete the folder if needed
-        unsentInstances = any(inst[3] == 0 for inst in dbq.Query(dbq.GET_INSTANCES_PER_ASSOC, [assocId]))
+        unsentInstances = any(inst[3] == 0 for inst in dbq.query(dbq.GET_INSTANCES_PER_ASSOC, [assocId]))
 
     except Exception as e:
         LOGGER.error(f"Error processing association {assocId}: {e}", exc_info=True)
@@ -186,8 +196,120 @@ def handle_assoc_released(event, dcm_dir, organization_id, mroc_client_url, encr
     return 0x0000
 
 
-def post_files_to_mroc_client(patient_id, organization_id, study_dir, accession_number, mroc_client_url):
-    """Post files to the MROC client backend."""
+def _process_alive(pid):
+    """True if a process with this pid runs on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim_study(dbq, study_iuid):
+    """
+    Claim the upload of a study in the study_upload table.
+
+    Streaming, release and MPPS uploads of a study may run in any thread of
+    any SCP worker process; the claim lets one of them at a time build and
+    push it. Waits while another owner holds it and takes over the claim of
+    a process that no longer runs. Returns (owner, imaging_study_id).
+    """
+    owner = f"{os.getpid()}-{threading.get_ident()}"
+    while True:
+        dbq.insert(dbq.INSERT_STUDY_UPLOAD, [study_iuid])
+        if dbq.update(dbq.CLAIM_STUDY_UPLOAD, [owner, os.getpid(), study_iuid]):
+            return owner, dbq.query(dbq.GET_STUDY_UPLOAD, [study_iuid])[0]["imaging_study_id"]
+
+        rows = dbq.query(dbq.GET_STUDY_UPLOAD, [study_iuid])
+        if rows and rows[0]["owner_pid"] and not _process_alive(rows[0]["owner_pid"]):
+            LOGGER.warning(f"Taking over study {study_iuid} from stopped process {rows[0]['owner_pid']}")
+            dbq.update(dbq.RELEASE_STUDY_UPLOAD, [study_iuid, rows[0]["owner"]])
+            continue
+        time.sleep(_CLAIM_POLL_INTERVAL)
+
+
+def process_study(assocId, study_iuid, accession_no, dcm_dir, organization_id, mroc_client_url, encrypt, final=False):
+    """
+    Upload a study: ImagingStudy and not yet sent instances.
+
+    Called for each completed series while streaming and once more at
+    association release (`final`). The ImagingStudy is posted the first
+    time and updated with PUT afterwards; only instances not sent yet are
+    pushed. The MROC client receives the study once, at release.
+
+    The staging store holds the study whichever associations delivered it,
+    so the whole study is built and pushed. `assocId` is None when a
+    completed MPPS triggers it. Studies with a step still in progress, or
+    completed and waiting for its instances, are left to the MPPS and
+    skipped at association level; later re-sends are uploaded as usual.
+    """
+    dbq = DBQuery()
+    if assocId is not None and dbq.query(dbq.GET_PENDING_MPPS_PER_STUDY, [study_iuid]):
+        LOGGER.info(f"Study {study_iuid} is reported by MPPS, processing it on procedure completion")
+        return
+
+    study_dir = os.path.join(dcm_dir, study_iuid)
+    owner, imagingStudyID = _claim_study(dbq, study_iuid)
+    try:
+        LOGGER.info(f"Accession Number: {accession_no}, Study IUID: {study_iuid}")
+
+        # Read under the claim: instances stored until now are in this upload
+        files = [row[0] for row in dbq.query(dbq.GET_FILES_PER_STUDY, [study_iuid])]
+        files = [path for path in files if os.path.isfile(path)]
+
+        if imagingStudyID is None:
+            imagingStudyID = satusehat.get_imaging_study(accession_no, config.token)
+
+        # Obtain Patient ID and ServiceRequest ID
+        try:
+            serviceRequestID, patientID = satusehat.get_service_request(accession_no)
+            LOGGER.info("Successfully obtained Patient ID and ServiceRequest ID.")
+        except Exception as e:
+            LOGGER.error("Failed to obtain Patient ID and ServiceRequest ID.", exc_info=True)
+            return
+
+        # Post files to MROC client backend
+        if encrypt and final:
+            try:
+                LOGGER.info("Posting files to MROC client backend.")
+                response = post_files_to_mroc_client(patientID, organization_id, study_dir, accession_no, mroc_client_url, files)
+                LOGGER.info(f"Response from MROC client: {response}")
+            except Exception as e:
+                LOGGER.error(f"Failed to POST to MROC client backend: {e}")
+
+        # Create ImagingStudy
+        try:
+            imagingStudy = process_dicom_to_fhir(study_dir, imagingStudyID, serviceRequestID, patientID, files)
+            output = os.path.join(study_dir, "ImagingStudy.json")
+            with open(output, 'w') as out_file:
+                out_file.write(imagingStudy.json(indent=2))
+            LOGGER.info(f"ImagingStudy {study_iuid} created.")
+        except Exception as e:
+            LOGGER.error(f"Failed to create ImagingStudy for {study_iuid}: {e}")
+
+        # Post ImagingStudy to server, then update it in place
+        try:
+            imaging_study_json = os.path.join(study_dir, "ImagingStudy.json")
+            imagingStudyID = satusehat.imagingstudy_post(imaging_study_json, imagingStudyID or None)
+            dbq.update(dbq.SET_STUDY_UPLOAD_ID, [imagingStudyID, study_iuid])
+            LOGGER.info(f"ImagingStudy POST-ed successfully, id: {imagingStudyID}")
+        except Exception as e:
+            LOGGER.error(f"Failed to POST ImagingStudy: {e}")
+
+        # Push DICOM files
+        try:
+            satusehat.dicom_push(study_iuid, imagingStudyID)
+            LOGGER.info("DICOM files sent successfully.")
+        except Exception as e:
+            LOGGER.error("Failed to send DICOM files.", exc_info=True)
+    finally:
+        dbq.update(dbq.RELEASE_STUDY_UPLOAD, [study_iuid, owner])
+
+
+def post_files_to_mroc_client(patient_id, organization_id, study_dir, accession_number, mroc_client_url, paths=None):
+    """Post files (those of study_dir unless given) to the MROC client backend."""
     url = f"{mroc_client_url}/files"
     data = {
         'patientId': patient_id,
@@ -195,11 +317,10 @@ def post_files_to_mroc_client(patient_id, organization_id, study_dir, accession_
         'accessionNumber': accession_number
     }
 
-    files = []
-    for root, _, filenames in os.walk(study_dir):
-        for filename in filenames:
-            file_path = os.path.join(root, filename)
-            files.append(('files', (filename, open(file_path, 'rb'), 'application/dicom')))
+    if paths is None:
+        paths = [os.path.join(root, filename) for root, _, filenames in os.walk(study_dir) for filename in filenames]
+
+    files = [('files', (os.path.basename(path), open(path, 'rb'), 'application/dicom')) for path in paths]
 
     try:
         response = requests.post(url=url, data=data, files=files)
@@ -271,3 +392,170 @@ def handle_find(event, logger):
         # Populate other fields here...
 
         yield (0xFF00, ds)
+
+
+def _as_list(value):
+    """Return a (possibly multi-valued) element value as a list of strings."""
+    if value is None or value == "":
+        return []
+    if isinstance(value, (list, tuple)) or value.__class__.__name__ == "MultiValue":
+        return [str(v) for v in value if v]
+    return [str(value)]
+
+
+def _query_sqlite_locations(level, identifier):
+    """Resolve SOP Instance UID -> file path from the local dicom_obj table."""
+    filters, params = [], []
+    for keyword, column in (("StudyInstanceUID", "study_iuid"),
+                            ("SeriesInstanceUID", "series_iuid"),
+                            ("SOPInstanceUID", "instance_uid")):
+        values = _as_list(identifier.get(keyword))
+        if values:
+            filters.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+
+    # dicom_obj has no patient columns, so PATIENT level is served from MongoDB only
+    if level == "PATIENT" or not filters:
+        return {}
+
+    dbq = DBQuery()
+    rows = dbq.query(dbq.GET_LOCATIONS.format(" AND ".join(filters)), params) or []
+    return {row["instance_uid"]: row["fs_location"] for row in rows}
+
+
+def _query_mongo_locations(level, identifier):
+    """Resolve SOP Instance UID -> file path from the image collection."""
+    patient_ids = _as_list(identifier.get("PatientID"))
+    study_uids = _as_list(identifier.get("StudyInstanceUID"))
+    series_uids = _as_list(identifier.get("SeriesInstanceUID"))
+    sop_uids = _as_list(identifier.get("SOPInstanceUID"))
+
+    if sop_uids:
+        query = {"sop_instance_uid": {"$in": sop_uids}}
+    elif series_uids:
+        series = connect_mongodb("series").find(
+            {"series_instance_uid": {"$in": series_uids}},
+            {"patient_id": 1, "study_id": 1, "series_number": 1}
+        )
+        keys = [{"patient_id": s["patient_id"], "study_id": s["study_id"], "series_number": s["series_number"]}
+                for s in series]
+        if not keys:
+            return {}
+        query = {"$or": keys}
+    elif study_uids:
+        studies = connect_mongodb("study").find(
+            {"study_instance_uid": {"$in": study_uids}},
+            {"patient_id": 1, "study_id": 1}
+        )
+        keys = [{"patient_id": s["patient_id"], "study_id": s["study_id"]} for s in studies]
+        if not keys:
+            return {}
+        query = {"$or": keys}
+    elif level == "PATIENT" and patient_ids:
+        query = {"patient_id": {"$in": patient_ids}}
+    else:
+        return {}
+
+    images = connect_mongodb("image").find(query, {"sop_instance_uid": 1, "path": 1})
+    return {img["sop_instance_uid"]: img["path"] for img in images if img.get("path")}
+
+
+def resolve_instance_paths(identifier, roots):
+    """
+    Resolve the files matching a C-MOVE/C-GET identifier in one pass.
+
+    All lookups are batched per request so sub-operations never wait on a
+    per-instance query. Only files located under one of `roots` are returned.
+    """
+    level = identifier.get("QueryRetrieveLevel", "STUDY")
+    locations = {}
+
+    try:
+        locations.update(_query_mongo_locations(level, identifier))
+    except Exception as e:
+        LOGGER.warning(f"Unable to resolve instances from MongoDB: {e}")
+
+    # Files still held in the staging store take precedence
+    locations.update(_query_sqlite_locations(level, identifier))
+
+    allowed = [os.path.realpath(root) for root in roots if root]
+    paths = []
+    for sop_uid, path in sorted(locations.items()):
+        real_path = os.path.realpath(path)
+        if not any(os.path.commonpath([root, real_path]) == root for root in allowed):
+            LOGGER.warning(f"Skipping instance {sop_uid} outside of the staging store: {path}")
+            continue
+        if os.path.isfile(real_path):
+            paths.append(real_path)
+
+    return paths
+
+
+def _requested_contexts(ae_title, paths):
+    """Build the requested contexts for a move destination from the files to send."""
+    needed = transfer_syntaxes_by_sop_class(read_metas(paths))
+
+    # Remember what each destination has needed so far, so repeated moves
+    # negotiate a stable set of contexts
+    with _move_contexts_lock:
+        known = _move_contexts.setdefault(ae_title, {})
+        for sop_class, syntaxes in needed.items():
+            known.setdefault(sop_class, set()).update(syntaxes)
+        extra = [(sop_class, set(syntaxes)) for sop_class, syntaxes in known.items() if sop_class not in needed]
+
+    return requested_contexts(list(needed.items()) + extra)
+
+
+def handle_get(event, dcm_dir, inotify_dir, logger):
+    """Handles a C-GET request event."""
+    ds = event.identifier
+    LOGGER.info(f"Handling C-GET request at level {ds.get('QueryRetrieveLevel', 'STUDY')}")
+
+    paths = resolve_instance_paths(ds, [dcm_dir, inotify_dir])
+
+    # Yield the number of sub-operations first
+    yield len(paths)
+
+    for path in paths:
+        if event.is_cancelled:
+            yield (0xFE00, None)
+            return
+
+        # Files are sent as-is, without decoding the dataset
+        yield (0xFF00, path)
+
+
+def handle_move(event, dcm_dir, inotify_dir, move_destinations, logger):
+    """Handles a C-MOVE request event."""
+    ds = event.identifier
+    destination = event.move_destination
+    if isinstance(destination, bytes):
+        destination = destination.decode("ascii")
+    destination = destination.strip()
+
+    LOGGER.info(f"Handling C-MOVE request to {destination}")
+
+    if destination not in move_destinations:
+        LOGGER.error(f"Unknown C-MOVE destination: {destination}")
+        yield (None, None)
+        return
+
+    paths = resolve_instance_paths(ds, [dcm_dir, inotify_dir])
+    addr, port = move_destinations[destination]
+
+    # Only request the presentation contexts the matched instances need
+    if paths:
+        yield (addr, port, {"contexts": _requested_contexts(destination, paths)})
+    else:
+        yield (addr, port)
+
+    # Yield the number of sub-operations
+    yield len(paths)
+
+    for path in paths:
+        if event.is_cancelled:
+            yield (0xFE00, None)
+            return
+
+        # Files are sent as-is, without decoding the dataset
+        yield (0xFF00, path)
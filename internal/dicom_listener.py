@@ -1,26 +1,17 @@
-import time
-import zipfile
+import atexit
+import threading
 import os
-from pydicom import dcmread
-from pynetdicom import AE, AllStoragePresentationContexts, StoragePresentationContexts, ALL_TRANSFER_SYNTAXES
-from pynetdicom.presentation import PresentationContext
+from concurrent.futures import ThreadPoolExecutor
 from pydicom.errors import InvalidDicomError
-from utils.mongodb import connect_mongodb, client_mongodb
-from pymongo.errors import OperationFailure
+from pymongo import UpdateOne
+from pynetdicom import AE
+from utils.mongodb import connect_mongodb, shared_db
 from datetime import datetime
-from utils import config
+from utils import config, metrics
+from utils.dicom_metadata import MetadataExtractor, load_metadata_fields
+from utils.dicomutils import read_metas, requested_contexts, transfer_syntaxes_by_sop_class
+from internal.metadata_writer import MetadataWriter, COLLECTIONS
 import logging
-from pynetdicom.sop_class import (
-    Verification,
-    PatientRootQueryRetrieveInformationModelFind,
-    PatientRootQueryRetrieveInformationModelMove,
-    PatientRootQueryRetrieveInformationModelGet,
-    StudyRootQueryRetrieveInformationModelFind,
-    StudyRootQueryRetrieveInformationModelMove,
-    StudyRootQueryRetrieveInformationModelGet,
-    ModalityWorklistInformationFind,
-    DigitalXRayImageStorageForPresentation
-)
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -34,102 +25,59 @@ LOGGER = logging.getLogger("flask_server")
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'dcm', 'zip'}
 
-# MongoDB client and database connection
-_client = client_mongodb()
-_db = _client[config.pacs_db_name]
+# Header-only extractor and batching writer for the patient/study/series/image collections
+_extractor = None
+_writer = None
+_writer_lock = threading.Lock()
 
 def allowed_file(filename):
     """Check if the file extension is allowed."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def generate_metadata(collection, file_dcm, pathname):
-    """Generate metadata for the specified DICOM collection."""
-    common_metadata = {
-        "patient_id": str(file_dcm.PatientID) if hasattr(file_dcm, 'PatientID') else None,
-    }
-
-    if collection == "patient":
-        return {
-            **common_metadata,
-            "patient_name": str(file_dcm.PatientName) if hasattr(file_dcm, 'PatientName') else None,
-        }
-    elif collection == "study":
-        return {
-            **common_metadata,
-            "study_id": str(file_dcm[0x0020, 0x0010].value) if [0x0020, 0x0010] in file_dcm else None,
-            "study_instance_uid": str(file_dcm.StudyInstanceUID) if hasattr(file_dcm, 'StudyInstanceUID') else None,
-            "study_date": str(file_dcm.StudyDate) if hasattr(file_dcm, 'StudyDate') else None,
-            "study_time": str(file_dcm.StudyTime) if hasattr(file_dcm, 'StudyTime') else None,
-            "study_description": str(file_dcm.StudyDescription) if hasattr(file_dcm, 'StudyDescription') else None,
-            "accession_number": str(file_dcm.AccessionNumber) if hasattr(file_dcm, 'AccessionNumber') else None,
-        }
-    elif collection == "series":
-        return {
-            **common_metadata,
-            "study_id": str(file_dcm[0x0020, 0x0010].value) if [0x0020, 0x0010] in file_dcm else None,
-            "series_number": str(file_dcm.SeriesNumber) if hasattr(file_dcm, 'SeriesNumber') else None,
-            "series_instance_uid": str(file_dcm.SeriesInstanceUID) if hasattr(file_dcm, 'SeriesInstanceUID') else None,
-            "series_date": str(file_dcm.SeriesDate) if hasattr(file_dcm, 'SeriesDate') else None,
-            "series_time": str(file_dcm.SeriesTime) if hasattr(file_dcm, 'SeriesTime') else None,
-            "series_description": str(file_dcm.SeriesDescription) if hasattr(file_dcm, 'SeriesDescription') else None,
-            "body_part_examined": str(file_dcm.BodyPartExamined) if hasattr(file_dcm, 'BodyPartExamined') else None,
-            "modality": str(file_dcm.Modality) if hasattr(file_dcm, 'Modality') else None,
-        }
-    elif collection == "image":
-        return {
-            **common_metadata,
-            "study_id": str(file_dcm[0x0020, 0x0010].value) if [0x0020, 0x0010] in file_dcm else None,
-            "series_number": str(file_dcm.SeriesNumber) if hasattr(file_dcm, 'SeriesNumber') else None,
-            "instance_number": str(file_dcm.InstanceNumber) if hasattr(file_dcm, 'InstanceNumber') else None,
-            "sop_instance_uid": str(file_dcm.SOPInstanceUID) if hasattr(file_dcm, 'SOPInstanceUID') else None,
-            "path": str(pathname),
-        }
-    return None
+def get_metadata_extractor():
+    """Return the process-wide metadata extractor, compiling it on first use."""
+    global _extractor
+    if _extractor is None:
+        _extractor = MetadataExtractor(load_metadata_fields(config.metadata_fields_file))
+    return _extractor
+
+def get_metadata_writer():
+    """Return the process-wide metadata writer, creating it on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = MetadataWriter(shared_db(), config.metadata_batch_size, config.metadata_flush_interval)
+                metrics.register("metadata_writer", _writer.metrics)
+                atexit.register(_writer.close)
+    return _writer
+
+def _reset_after_fork():
+    """Start a new writer in a forked child; the parent's flush thread does not survive the fork."""
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 def handle_file_dcm(pathname):
-    """Handle and process a DICOM file."""
-    with _client.start_session() as session:
-        try:
-            session.start_transaction()
-            file_dcm = dcmread(pathname, force=True)
-
-            # Insert patient metadata
-            insert_metadata("patient", file_dcm, pathname, session)
-
-            # Insert study metadata
-            insert_metadata("study", file_dcm, pathname, session)
-
-            # Insert series metadata
-            insert_metadata("series", file_dcm, pathname, session)
-
-            # Insert image metadata
-            insert_metadata("image", file_dcm, pathname, session)
-
-            session.commit_transaction()
-            LOGGER.info(f"Successfully inserted {pathname}")
-        except (InvalidDicomError, OperationFailure) as e:
-            session.abort_transaction()
-            LOGGER.error(f"Error processing {pathname}: {e}")
-
-def insert_metadata(collection, file_dcm, pathname, session):
-    """Helper function to insert DICOM metadata into MongoDB."""
-    metadata = generate_metadata(collection, file_dcm, pathname)
-    collection_name = _db[collection]
-    if metadata:
-        collection_name.update_one(
-            {key: metadata[key] for key in metadata if key in ["patient_id", "study_id", "series_instance_uid", "sop_instance_uid"]},
-            {
-                "$set": {**metadata, "updated_at": datetime.now()},
-                "$setOnInsert": {"created_at": datetime.now()}
-            },
-            upsert=True,
-            session=session
-        )
+    """Handle and process a DICOM file. Returns True when the file was queued for indexing."""
+    try:
+        documents = get_metadata_extractor().extract(pathname)
+    except (InvalidDicomError, OSError) as e:
+        LOGGER.error(f"Error processing {pathname}: {e}")
+        return False
 
-def dicom_push(pathname):
-    """Process a DICOM file push request."""
-    time.sleep(3)
+    writer = get_metadata_writer()
+    for collection in COLLECTIONS:
+        if collection in documents:
+            writer.add(collection, documents[collection])
 
+    LOGGER.info(f"Queued metadata of {pathname}")
+    return True
+
+def dicom_push(pathname):
+    """Process a DICOM file push request for a completely written file."""
     if allowed_file(pathname):
         if pathname.lower().endswith('.dcm'):
             handle_file_dcm(pathname)
@@ -140,71 +88,79 @@ def dicom_to_satusehat_task(patient_id, study_id, accession_number, series_numbe
     """Send DICOM data to Satusehat."""
     LOGGER.info("Processing to Satusehat Task")
 
+    try:
+        image_coll = connect_mongodb("image")
+        query = {
+            "patient_id": patient_id,
+            "study_id": study_id,
+            "integration_status_satusehat": {"$ne": 1}
+        }
+        if series_number is not None:
+            query["series_number"] = series_number
+        if instance_number is not None:
+            query["instance_number"] = instance_number
+        instance_list = list(image_coll.find(query, {"_id": 1, "path": 1}).sort("series_number", 1))
+        LOGGER.info(f"Instances found: {len(instance_list)}")
+
+        update_integration_status(patient_id, study_id, series_number, instance_number)
+
+        if not instance_list:
+            return
+
+        recorder = StatusRecorder(image_coll, config.resend_status_batch)
+        paths = [imd.get('path') for imd in instance_list]
+        metas = read_metas(paths)
+
+        # Instances whose file cannot be read are failed up front
+        sendable = []
+        for imd, meta in zip(instance_list, metas):
+            if meta is None:
+                recorder.add(imd["_id"], 0)
+            else:
+                sendable.append((imd["_id"], imd["path"]))
+
+        # Without a readable file there is nothing to negotiate: only the failures are recorded
+        if sendable:
+            contexts = requested_contexts(transfer_syntaxes_by_sop_class(metas).items())
+            workers = max(1, min(config.resend_associations, len(sendable)))
+            chunks = [sendable[i::workers] for i in range(workers)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda chunk: _send_chunk(chunk, contexts, recorder), chunks))
+
+        recorder.flush()
+        update_integration_summary(patient_id, study_id, accession_number, image_coll)
+        LOGGER.info("Process to Satusehat Task finished")
+    except Exception as e:
+        LOGGER.error(f"Error processing to Satusehat Task: {str(e)}")
+        # JobExecutor records the job as failed
+        raise
+
+def _send_chunk(chunk, contexts, recorder):
+    """Send a share of the instances over one association, streaming each file as-is."""
     ae = AE(ae_title=config.self_ae_title)
-
-    transfer_syntaxes = ALL_TRANSFER_SYNTAXES #  -> seems no need
-
-    for context in StoragePresentationContexts: # -> seems no need
-        ae.add_supported_context(context.abstract_syntax, transfer_syntaxes)
-    
-    # Support verification SCP (echo)  -> seems no need
-    ae.add_requested_context(Verification)
-
-    # Query/Retrieve SCP -> seems no need
-    ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
-    ae.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
-    ae.add_supported_context(PatientRootQueryRetrieveInformationModelGet)
-    ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
-    ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
-    ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
-    ae.add_supported_context(ModalityWorklistInformationFind)
-
-    # Add support for Digital X-Ray Image Storage for Presentation
-    ae.add_supported_context(DigitalXRayImageStorageForPresentation)
- 
-    # Support presentation contexts for all storage SOP Classes  -> seems no need
-    ae.supported_contexts = AllStoragePresentationContexts
-
-    # Set to require the *Called AE Title* must match the AE title  -> seems no need
-    ae.require_called_aet = config.self_ae_title
-
+    ae.requested_contexts = contexts
     assoc = ae.associate('localhost', config.dicom_port, ae_title=config.self_ae_title)
 
-    if assoc.is_established:
-        try:
-            image_coll = connect_mongodb("image")
-            query = {
-                "patient_id": patient_id,
-                "study_id": study_id,
-                "integration_status_satusehat": {"$ne": 1}
-            }
-            if series_number is not None:
-                query["series_number"] = series_number
-            if instance_number is not None:
-                query["instance_number"] = instance_number
-            study_instances = image_coll.find(query).sort("series_number", 1)
-
-            instance_list = list(study_instances)
-            LOGGER.info(f"Instances found: {len(instance_list)}")
-
-            update_integration_status(patient_id, study_id, series_number, instance_number)
-
-            for i, imd in enumerate(instance_list):
-                process_instance(imd, patient_id, study_id, series_number, instance_number, assoc, image_coll)
-
-                if i == len(instance_list) - 1:
-                    update_integration_summary(patient_id, study_id, accession_number, instance_list, image_coll)
-
-                time.sleep(1)
-
-            LOGGER.info("Process to Satusehat Task finished")
-        except Exception as e:
-            LOGGER.error(f"Error processing to Satusehat Task: {str(e)}")
-
+    if not assoc.is_established:
+        LOGGER.info('Association rejected, aborted or never connected')
+        for _id, _ in chunk:
+            recorder.add(_id, 0)
+        return
+
+    try:
+        for _id, path in chunk:
+            try:
+                status = assoc.send_c_store(path)
+                success = status and status.Status == 0x0000
+            except Exception as e:
+                LOGGER.error(f"Failed to send DICOM file {path}: {e}")
+                success = False
+            if not success:
+                LOGGER.error(f'Failed to send DICOM file {path}')
+            recorder.add(_id, 1 if success else 0)
+    finally:
         assoc.release()
         LOGGER.info('Association released')
-    else:
-        LOGGER.info('Association rejected, aborted or never connected')
 
 def update_integration_status(patient_id, study_id, series_number, instance_number):
     """Update the integration status in MongoDB."""
@@ -218,44 +174,37 @@ def update_integration_status(patient_id, study_id, series_number, instance_numb
         "$set": {"integration_satusehat_at": datetime.now()}
     })
 
-def process_instance(imd, patient_id, study_id, series_number, instance_number, assoc, image_coll):
-    """Process each DICOM instance."""
-    LOGGER.info(f"Processing item with instance_number: {imd['instance_number']}")
-
-    path = imd.get('path')
-    dcm_data = dcmread(path)
-    status = assoc.send_c_store(dcm_data)
-
-    if status.Status == 0x0000:
-        LOGGER.info('DICOM file sent successfully')
-        update_image_status(image_coll, patient_id, study_id, series_number, instance_number, 1)
-    else:
-        LOGGER.error('Failed to send DICOM file')
-        update_image_status(image_coll, patient_id, study_id, series_number, instance_number, 0)
-
-def update_image_status(image_coll, patient_id, study_id, series_number, instance_number, status):
-    """Update the status of the DICOM image in the MongoDB."""
-    image_coll.update_one({
-        "patient_id": patient_id,
-        "study_id": study_id,
-        "series_number": series_number,
-        "instance_number": instance_number,
-    }, {
-        "$set": {"integration_status_satusehat": status}
-    })
-
-def update_integration_summary(patient_id, study_id, accession_number, instance_list, image_coll):
-    """Update the integration summary based on success and failure counts."""
-    success_count = image_coll.count_documents({
-        "patient_id": patient_id,
-        "study_id": study_id,
-        "integration_status_satusehat": 1
-    })
-    failed_count = image_coll.count_documents({
-        "patient_id": patient_id,
-        "study_id": study_id,
-        "integration_status_satusehat": 0
-    })
+class StatusRecorder:
+    """Collects per-instance send results and writes them with batched bulk_write keyed on _id."""
+
+    def __init__(self, image_coll, batch_size=500):
+        self.image_coll = image_coll
+        self.batch_size = batch_size
+        self.operations = []
+        self.lock = threading.Lock()
+
+    def add(self, _id, status):
+        with self.lock:
+            self.operations.append(UpdateOne({"_id": _id}, {"$set": {"integration_status_satusehat": status}}))
+            full = len(self.operations) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            operations, self.operations = self.operations, []
+        if operations:
+            self.image_coll.bulk_write(operations, ordered=False)
+
+def update_integration_summary(patient_id, study_id, accession_number, image_coll):
+    """Update the integration summary from the status counts of the whole study."""
+    counts = {row["_id"]: row["count"] for row in image_coll.aggregate([
+        {"$match": {"patient_id": patient_id, "study_id": study_id}},
+        {"$group": {"_id": "$integration_status_satusehat", "count": {"$sum": 1}}}
+    ])}
+    success_count = counts.get(1, 0)
+    failed_count = counts.get(0, 0)
+    all_sent = success_count == sum(counts.values())
 
     LOGGER.info(f"Success Count: {success_count}")
     LOGGER.info(f"Failed Count: {failed_count}")
@@ -269,7 +218,7 @@ def update_integration_summary(patient_id, study_id, accession_number, instance_
         "$set": {
             "count_success": success_count,
             "count_failed": failed_count,
-            "status": "SUCCESS" if success_count == len(instance_list) else "PENDING",
-            "message": "[dicom-router] All instances sent successfully" if success_count == len(instance_list) else "[dicom-router] All or some instances failed to send"
+            "status": "SUCCESS" if all_sent else "PENDING",
+            "message": "[dicom-router] All instances sent successfully" if all_sent else "[dicom-router] All or some instances failed to send"
         }
     })
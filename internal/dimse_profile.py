@@ -0,0 +1,132 @@
+import json
+import logging
+import socket
+
+from pydicom import uid
+from pynetdicom import ALL_TRANSFER_SYNTAXES
+
+from internal.admission import calling_ae_title
+
+# Logger initialization
+LOGGER = logging.getLogger("pynetdicom")
+
+# Uncompressed syntaxes first; the rest of pynetdicom's list follows in its order
+_PREFERRED_SYNTAXES = [
+    uid.ExplicitVRLittleEndian,
+    uid.ImplicitVRLittleEndian,
+    uid.DeflatedExplicitVRLittleEndian,
+    uid.ExplicitVRBigEndian,
+]
+
+# Network settings of the SCP. Timeouts are in seconds, 0 or None means no
+# timeout; max_pdu is the largest P-DATA PDU we accept (0 is unlimited);
+# socket buffers of None keep the OS defaults. pynetdicom accepts the first
+# syntax proposed by the SCU that is in transfer_syntaxes, so the list
+# decides which syntaxes can be negotiated at all.
+DEFAULT_PROFILE = {
+    "max_pdu": 16382,
+    "acse_timeout": 30,
+    "dimse_timeout": 30,
+    "network_timeout": 60,
+    "connection_timeout": None,
+    "socket_send_buffer": None,
+    "socket_receive_buffer": None,
+    "transfer_syntaxes": _PREFERRED_SYNTAXES + [ts for ts in ALL_TRANSFER_SYNTAXES if ts not in _PREFERRED_SYNTAXES],
+}
+
+# Settings that can be overridden per calling AE title
+PER_AE_SETTINGS = ("max_pdu", "acse_timeout", "dimse_timeout", "network_timeout",
+                   "socket_send_buffer", "socket_receive_buffer")
+
+
+def _transfer_syntax(name):
+    """Accept a transfer syntax UID or its pydicom keyword, e.g. "ExplicitVRLittleEndian"."""
+    value = name if name[:1].isdigit() else getattr(uid, name, None)
+    if value is None:
+        raise ValueError(f"Unknown transfer syntax: {name}")
+    return str(value)
+
+
+class DimseProfile:
+    """
+    Declarative network profile of the DIMSE layer, with per-calling-AE overrides.
+
+    Loaded from a JSON file shaped like:
+
+        {"default": {"max_pdu": 262144, "transfer_syntaxes": ["ExplicitVRLittleEndian", ...]},
+         "ae": {"CT01": {"max_pdu": 0, "dimse_timeout": 120}}}
+
+    Settings that are not given keep the DEFAULT_PROFILE values.
+    """
+
+    def __init__(self, default=None, ae=None):
+        self.default = {**DEFAULT_PROFILE, **(default or {})}
+        self.default["transfer_syntaxes"] = [_transfer_syntax(ts) for ts in self.default["transfer_syntaxes"]]
+        self.ae = {}
+        for ae_title, overrides in (ae or {}).items():
+            unknown = set(overrides) - set(PER_AE_SETTINGS)
+            if unknown:
+                raise ValueError(f"Settings not supported per AE ({ae_title}): {', '.join(sorted(unknown))}")
+            self.ae[ae_title] = overrides
+
+    @classmethod
+    def load(cls, path=None):
+        """Read a profile file; without a path the defaults are used."""
+        if not path:
+            return cls()
+        with open(path) as fp:
+            data = json.load(fp)
+        return cls(data.get("default"), data.get("ae"))
+
+    def for_ae(self, ae_title):
+        """Return the effective settings for a calling AE title."""
+        return {**self.default, **self.ae.get(ae_title, {})}
+
+    def apply(self, ae):
+        """Apply the default settings to an AE before its server is started."""
+        ae.maximum_pdu_size = self.default["max_pdu"]
+        ae.acse_timeout = self.default["acse_timeout"]
+        ae.dimse_timeout = self.default["dimse_timeout"]
+        ae.network_timeout = self.default["network_timeout"]
+        ae.connection_timeout = self.default["connection_timeout"]
+
+    def socket_options(self):
+        """
+        Return (level, option, value) for the listening socket.
+
+        Accepted sockets inherit the buffer sizes of the listener, and the
+        receive buffer has to be set before listen() to affect TCP window
+        scaling.
+        """
+        options = []
+        if self.default["socket_send_buffer"]:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.default["socket_send_buffer"]))
+        if self.default["socket_receive_buffer"]:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.default["socket_receive_buffer"]))
+        return options
+
+    def handle_requested(self, event):
+        """EVT_REQUESTED handler applying the overrides of the calling AE to its association."""
+        ae_title = calling_ae_title(event.assoc)
+        overrides = self.ae.get(ae_title)
+        if not overrides:
+            return
+
+        assoc = event.assoc
+        if "max_pdu" in overrides:
+            assoc.acceptor.maximum_length = overrides["max_pdu"]
+        if "acse_timeout" in overrides:
+            assoc.acse_timeout = overrides["acse_timeout"]
+        if "dimse_timeout" in overrides:
+            assoc.dimse_timeout = overrides["dimse_timeout"]
+        if "network_timeout" in overrides:
+            assoc.network_timeout = overrides["network_timeout"]
+
+        sock = assoc.dul.socket.socket if assoc.dul.socket else None
+        try:
+            if sock and overrides.get("socket_send_buffer"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, overrides["socket_send_buffer"])
+            if sock and overrides.get("socket_receive_buffer"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, overrides["socket_receive_buffer"])
+        except OSError as e:
+            LOGGER.warning(f"Unable to apply socket buffers for {ae_title}: {e}")
@@ -1,11 +1,17 @@
-from flask import Flask, jsonify, request, send_file
-from utils.mongodb import connect_mongodb, client_mongodb
-from utils import config
-from internal.dicom_listener import dicom_push, dicom_to_satusehat_task
+from flask import Flask, jsonify, request, send_file, url_for
+from utils.mongodb import connect_mongodb, shared_client, shared_db
+from utils import config, metrics
+from internal.dicom_listener import dicom_to_satusehat_task
+from internal import sync_job
+from internal.job_executor import JobExecutor
+from internal.notification_queue import NotificationQueue
+from internal.preview import PreviewGenerator
 from urllib.parse import unquote
 from flask_cors import CORS
+from pymongo import DeleteMany, UpdateOne
 from internal.whatsapp_handler import send
 from datetime import datetime
+import json
 import os
 import threading
 import logging
@@ -20,11 +26,106 @@ LOGGER = logging.getLogger("dicom_router_inotify")
 app = Flask(__name__)
 CORS(app)  # Allow all origins
 
-# MongoDB client
-_client = client_mongodb()
-_db = _client[config.pacs_db_name]
+# Let a fronting web server (X-Sendfile) transmit resolved files when configured
+app.config['USE_X_SENDFILE'] = config.file_resolve_x_sendfile
+
+# Request keys of /dicom-upsert items and the collection each is stored in
+UPSERT_KEYS = {
+    'metadata_patient': 'patient',
+    'metadata_study': 'study',
+    'metadata_series': 'series',
+    'metadata_image': 'image',
+}
+
+# Bounded executor for /to-satusehat jobs, created by start_background_workers()
+_satusehat_executor = None
+_satusehat_executor_lock = threading.Lock()
+
+# WhatsApp notification queue, started by start_background_workers()
+_notification_queue = None
+_notification_queue_lock = threading.Lock()
+
+# Preview renderer, its process pool is started on first use
+_preview_generator = None
+_preview_generator_lock = threading.Lock()
 
 # Helper functions
+def get_satusehat_executor():
+    """Return the /to-satusehat job executor, recovering jobs with an expired lease on creation."""
+    global _satusehat_executor
+    if _satusehat_executor is None:
+        with _satusehat_executor_lock:
+            if _satusehat_executor is None:
+                executor = JobExecutor(
+                    shared_db()['integration_job'], dicom_to_satusehat_task,
+                    ('patient_id', 'study_id', 'accession_number'), config.satusehat_task_workers,
+                    config.satusehat_job_lease
+                )
+                executor.recover()
+                _satusehat_executor = executor
+    return _satusehat_executor
+
+def start_background_workers():
+    """
+    Start the job workers of this serving process and resume persisted jobs.
+
+    Called once per process after fork: by gunicorn's post_worker_init in
+    production, before the development server otherwise. A failure is
+    logged and the start is retried on first use.
+    """
+    try:
+        get_satusehat_executor()
+    except Exception as e:
+        LOGGER.error(f"Unable to start the /to-satusehat executor: {e}")
+    try:
+        get_notification_queue()
+    except Exception as e:
+        LOGGER.error(f"Unable to start the WhatsApp notification queue: {e}")
+
+def get_notification_queue():
+    """Return the WhatsApp notification queue, starting its workers on creation."""
+    global _notification_queue
+    if _notification_queue is None:
+        with _notification_queue_lock:
+            if _notification_queue is None:
+                # Each gunicorn worker runs its own queue workers; the rate is split between those running
+                _notification_queue = NotificationQueue(
+                    shared_db()['whatsapp_notification'], send, config.whatsapp_workers,
+                    config.whatsapp_rate_limit, config.whatsapp_max_attempts,
+                    members=shared_db()['whatsapp_queue_member']
+                )
+    return _notification_queue
+
+def get_preview_generator():
+    """Return the preview generator, starting its process pool on creation."""
+    global _preview_generator
+    if _preview_generator is None:
+        with _preview_generator_lock:
+            if _preview_generator is None:
+                _preview_generator = PreviewGenerator(
+                    shared_db(), config.preview_dir, config.preview_workers, config.preview_max_size,
+                    config.preview_format, config.preview_series_rule, config.preview_slice_rule
+                )
+                metrics.register("preview", _preview_generator.metrics)
+    return _preview_generator
+
+def preview_url(path):
+    """Return the /file/resolve URL of a preview image."""
+    return url_for('file_resolve_by_path', path=path, _external=True)
+
+def _reset_after_fork():
+    """Drop the parent's executor, queue and pool in a forked worker; their threads do not survive the fork."""
+    global _satusehat_executor, _satusehat_executor_lock, _notification_queue, _notification_queue_lock
+    global _preview_generator, _preview_generator_lock
+    _satusehat_executor = None
+    _satusehat_executor_lock = threading.Lock()
+    _notification_queue = None
+    _notification_queue_lock = threading.Lock()
+    _preview_generator = None
+    _preview_generator_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 def validate_request_keys(data, required_keys):
     """Validate the existence of required keys in the request data."""
     missing_keys = [key for key in required_keys if key not in data]
@@ -34,21 +135,27 @@ def validate_request_keys(data, required_keys):
 
 @app.route('/sync', methods=['GET'])
 def sync():
-    """Synchronize DICOM files from the specified folder."""
+    """Start a background job synchronizing DICOM files from the specified folder."""
     try:
         folder_path = config.inotify_dir
-        if not os.path.isdir(folder_path):
+        if not folder_path or not os.path.isdir(folder_path):
             raise ValueError(f"Invalid folder path: {folder_path}")
 
-        for filename in os.listdir(folder_path):
-            if os.path.isfile(os.path.join(folder_path, filename)):
-                dicom_push(f'{folder_path}/{filename}')
-
-        return jsonify({'message': 'Successfully synced filesystem'}), 200
+        job = sync_job.start_sync(folder_path, config.sync_workers)
+        return jsonify({'message': 'Sync job started', **job}), 202
     except Exception as e:
         LOGGER.error(f"Error syncing filesystem: {e}")
         return jsonify({'message': f'Error when syncing filesystem: {str(e)}'}), 500
 
+@app.route('/sync/status', methods=['GET'])
+@app.route('/sync/status/<job_id>', methods=['GET'])
+def sync_status(job_id=None):
+    """Report the progress of a sync job (the most recent one by default)."""
+    job = sync_job.get_job(job_id)
+    if job is None:
+        return jsonify({'message': 'Sync job not found'}), 404
+    return jsonify(job), 200
+
 @app.route('/whatsapp', methods=['POST'])
 def whatsapp_send():
     """Send a WhatsApp message."""
@@ -58,7 +165,7 @@ def whatsapp_send():
         return validation_error
 
     try:
-        send(
+        response = send(
             data.get('patient_phone_number'),
             data.get('preview_image'),
             data.get('patient_name'),
@@ -67,11 +174,75 @@ def whatsapp_send():
             data.get('date'),
             data.get('link')
         )
+        if response.status_code != 200:
+            return jsonify({'message': f'WhatsApp provider returned {response.status_code}'}), 502
         return jsonify({'message': 'Successfully sent WhatsApp message'}), 200
     except Exception as e:
         LOGGER.error(f"Error sending WhatsApp message: {e}")
         return jsonify({'message': f'Error sending WhatsApp message: {str(e)}'}), 500
 
+@app.route('/whatsapp/batch', methods=['POST'])
+def whatsapp_send_batch():
+    """Queue WhatsApp messages and return their job ids without waiting for the provider."""
+    data = request.json or {}
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return jsonify({'message': 'messages must be a non-empty list'}), 400
+
+    for index, message in enumerate(messages):
+        if not isinstance(message, dict) or not message.get('patient_phone_number'):
+            return jsonify({'message': f'Missing keys: patient_phone_number (item {index})'}), 400
+
+    try:
+        # Render missing previews in the background; the URL is known before the image exists
+        for message in messages:
+            if not message.get('preview_image') and message.get('study_instance_uid'):
+                generator = get_preview_generator()
+                instance = generator.find_instance(study_instance_uid=message['study_instance_uid'])
+                if instance is not None:
+                    path, _ = generator.submit(instance)
+                    message['preview_image'] = preview_url(path)
+
+        jobs = get_notification_queue().enqueue(messages)
+        return jsonify({'message': f'{len(jobs)} WhatsApp message(s) queued', 'jobs': jobs}), 202
+    except Exception as e:
+        LOGGER.error(f"Error queueing WhatsApp messages: {e}")
+        return jsonify({'message': f'Error queueing WhatsApp messages: {str(e)}'}), 500
+
+@app.route('/whatsapp/jobs/<job_id>', methods=['GET'])
+def whatsapp_job_status(job_id):
+    """Return the status of a queued WhatsApp message."""
+    job = get_notification_queue().get(job_id)
+    if job is None:
+        return jsonify({'message': 'WhatsApp job not found'}), 404
+    job['job_id'] = job.pop('_id')
+    job.pop('instance', None)
+    return jsonify(job), 200
+
+@app.route('/preview', methods=['GET'])
+def preview():
+    """Render (or reuse) the preview image of a study or instance and return its URL."""
+    study_instance_uid = request.args.get('study_instance_uid')
+    sop_instance_uid = request.args.get('sop_instance_uid')
+    if not study_instance_uid and not sop_instance_uid:
+        return jsonify({'message': 'study_instance_uid or sop_instance_uid is required'}), 400
+
+    try:
+        generator = get_preview_generator()
+        instance = generator.find_instance(study_instance_uid, sop_instance_uid)
+        if instance is None:
+            return jsonify({'message': 'Instance not found'}), 404
+
+        path = generator.generate(instance)
+        return jsonify({
+            'sop_instance_uid': instance['sop_instance_uid'],
+            'path': path,
+            'url': preview_url(path)
+        }), 200
+    except Exception as e:
+        LOGGER.error(f"Error generating preview: {e}")
+        return jsonify({'message': f'Error generating preview: {str(e)}'}), 500
+
 @app.route('/to-satusehat', methods=['POST'])
 def to_satusehat():
     """Process data to Satusehat."""
@@ -99,20 +270,49 @@ def to_satusehat():
             return jsonify({'message': 'Data already sent to Satu Sehat'}), 200
         elif integration_data['status'] in ['PENDING', 'FAILED']:
             LOGGER.info("Processing pending integration data")
-            threading.Thread(target=dicom_to_satusehat_task, args=(
+            job, created = get_satusehat_executor().submit(query, (
                 data['patient_id'], data['study_id'], data['accession_number'],
                 data.get('series_number'), data.get('instance_number')
-            )).start()
-            return jsonify({'message': 'Integration data processed'}), 200
+            ))
+            message = 'Integration data processed' if created else 'Integration already in progress'
+            return jsonify({'message': message, 'job_id': job['_id'], 'status': job['status']}), 200
     except Exception as e:
         LOGGER.error(f"Error processing to Satusehat: {e}")
         return jsonify({'message': f'Error processing to Satusehat: {str(e)}'}), 500
 
+@app.route('/to-satusehat/status', methods=['GET'])
+@app.route('/to-satusehat/status/<job_id>', methods=['GET'])
+def to_satusehat_status(job_id=None):
+    """Report the status of a Satusehat job, by id or by patient/study/accession."""
+    executor = get_satusehat_executor()
+    if job_id:
+        job = executor.get(job_id)
+    else:
+        validation_error = validate_request_keys(request.args, ['patient_id', 'study_id'])
+        if validation_error:
+            return validation_error
+        job = executor.find_latest(request.args)
+
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+
+    return jsonify({
+        'job_id': job['_id'],
+        'patient_id': job['patient_id'],
+        'study_id': job['study_id'],
+        'accession_number': job['accession_number'],
+        'status': job['status'],
+        'error': job.get('error'),
+        'created_at': job.get('created_at'),
+        'started_at': job.get('started_at'),
+        'finished_at': job.get('finished_at'),
+    }), 200
+
 @app.route('/dicom-upsert', methods=['POST'])
 def dicom_upsert():
     """Upsert DICOM data."""
     data = request.json
-    with _client.start_session() as session:
+    with shared_client().start_session() as session:
         try:
             session.start_transaction()
             upsert_collection('patient', data["metadata_patient"], session)
@@ -126,10 +326,14 @@ def dicom_upsert():
             LOGGER.error(f"Error upserting DICOM data: {e}")
             return jsonify({'message': f'Failed to upsert DICOM data: {str(e)}'}), 500
 
+def upsert_filter(metadata):
+    """Build the upsert filter from the identifying (*_id / *_uid) fields."""
+    return {key: metadata[key] for key in metadata if key.endswith('_id') or key.endswith('_uid')}
+
 def upsert_collection(collection_name, metadata, session):
     """Helper function to upsert into a MongoDB collection."""
-    collection = _db[collection_name]
-    query = {key: metadata[key] for key in metadata if key.endswith('_id') or key.endswith('_uid')}
+    collection = shared_db()[collection_name]
+    query = upsert_filter(metadata)
     collection.update_one(
         query,
         {
@@ -140,20 +344,66 @@ def upsert_collection(collection_name, metadata, session):
         session=session
     )
 
+@app.route('/dicom-upsert/batch', methods=['POST'])
+def dicom_upsert_batch():
+    """Upsert many patient/study/series/image quadruples in one transaction."""
+    data = request.json or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': "'items' must be a non-empty list"}), 400
+
+    results = []
+    documents = {collection: {} for collection in UPSERT_KEYS.values()}
+    for index, item in enumerate(items):
+        missing = [key for key in UPSERT_KEYS if not isinstance(item, dict) or not isinstance(item.get(key), dict)]
+        if missing:
+            results.append({'index': index, 'status': 'invalid', 'message': f'Missing keys: {", ".join(missing)}'})
+            continue
+        for key, collection in UPSERT_KEYS.items():
+            metadata = item[key]
+            # Identical documents within a batch are written once; values may be lists or objects
+            query = upsert_filter(metadata)
+            filter_key = json.dumps(query, sort_keys=True, default=str)
+            documents[collection].setdefault(filter_key, (query, {}))[1].update(metadata)
+        results.append({'index': index, 'status': 'upserted'})
+
+    now = datetime.now()
+    with shared_client().start_session() as session:
+        try:
+            session.start_transaction()
+            for collection, pending in documents.items():
+                operations = [
+                    UpdateOne(query, {"$set": {**metadata, "updated_at": now}, "$setOnInsert": {"created_at": now}}, upsert=True)
+                    for query, metadata in pending.values()
+                ]
+                if operations:
+                    shared_db()[collection].bulk_write(operations, ordered=False, session=session)
+            session.commit_transaction()
+        except Exception as e:
+            session.abort_transaction()
+            LOGGER.error(f"Error upserting DICOM data batch: {e}")
+            return jsonify({'message': f'Failed to upsert DICOM data: {str(e)}'}), 500
+
+    upserted = sum(1 for result in results if result['status'] == 'upserted')
+    return jsonify({
+        'message': f'{upserted} of {len(items)} items upserted',
+        'results': results
+    }), 200
+
 @app.route('/dicom-delete', methods=['POST'])
 def dicom_delete():
     """Delete DICOM data."""
     try:
         data = request.json
         file_query = {'path': data['path']}
-        image_coll = _db['image']
+        image_coll = shared_db()['image']
 
         result = image_coll.find_one(file_query)
         query = {'study_id': result['study_id'], 'patient_id': result['patient_id']}
 
         delete_from_collection(image_coll, query, 'image')
-        delete_from_collection(_db['study'], query, 'study')
-        delete_from_collection(_db['series'], query, 'series')
+        delete_from_collection(shared_db()['study'], query, 'study')
+        delete_from_collection(shared_db()['series'], query, 'series')
 
         return jsonify({'message': 'Successfully deleted DICOM file'}), 200
     except Exception as e:
@@ -168,23 +418,111 @@ def delete_from_collection(collection, query, collection_name):
     else:
         LOGGER.info(f"No documents matched the query in {collection_name} collection.")
 
+@app.route('/dicom-delete/batch', methods=['POST'])
+def dicom_delete_batch():
+    """
+    Delete many DICOM entries in one transaction.
+
+    Items are identified by image `path` or by `patient_id` and `study_id`.
+    A `path` item removes only the image with that path, unless `cascade`
+    is set: then every image, series and study document of its study is
+    removed. A `patient_id`/`study_id` item always removes the whole study.
+    """
+    data = request.json or {}
+    items = data.get('items')
+    cascade = data.get('cascade', False) is True
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': "'items' must be a non-empty list"}), 400
+
+    image_coll = shared_db()['image']
+    paths = [item['path'] for item in items if isinstance(item, dict) and item.get('path')]
+    studies_by_path = {
+        image['path']: (image['patient_id'], image['study_id'])
+        for image in image_coll.find({'path': {'$in': paths}}, {'path': 1, 'patient_id': 1, 'study_id': 1})
+    } if paths else {}
+
+    results, studies, image_paths = [], set(), set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'index': index, 'status': 'invalid', 'message': 'Item must be an object'})
+        elif item.get('path'):
+            if item['path'] not in studies_by_path:
+                results.append({'index': index, 'status': 'not_found'})
+                continue
+            if cascade:
+                studies.add(studies_by_path[item['path']])
+            else:
+                image_paths.add(item['path'])
+            results.append({'index': index, 'status': 'deleted'})
+        elif item.get('patient_id') and item.get('study_id'):
+            studies.add((item['patient_id'], item['study_id']))
+            results.append({'index': index, 'status': 'deleted'})
+        else:
+            results.append({'index': index, 'status': 'invalid', 'message': "Item needs 'path' or 'patient_id' and 'study_id'"})
+
+    operations = [DeleteMany({'patient_id': patient_id, 'study_id': study_id}) for patient_id, study_id in studies]
+    deleted = {}
+    with shared_client().start_session() as session:
+        try:
+            session.start_transaction()
+            for collection in ('image', 'series', 'study'):
+                collection_ops = list(operations)
+                if collection == 'image' and image_paths:
+                    collection_ops.append(DeleteMany({'path': {'$in': list(image_paths)}}))
+                if collection_ops:
+                    result = shared_db()[collection].bulk_write(collection_ops, ordered=False, session=session)
+                    deleted[collection] = result.deleted_count
+            session.commit_transaction()
+        except Exception as e:
+            session.abort_transaction()
+            LOGGER.error(f"Error deleting DICOM data batch: {e}")
+            return jsonify({'message': f'Failed to delete DICOM data: {str(e)}'}), 500
+
+    return jsonify({
+        'message': f'Deleted {deleted.get("image", 0)} image(s)',
+        'deleted': deleted,
+        'results': results
+    }), 200
+
 @app.route('/file/resolve', methods=['GET'])
 def file_resolve_by_path():
-    """Resolve file by path and serve it."""
+    """
+    Resolve file by path and serve it.
+
+    Byte ranges and If-None-Match / If-Modified-Since revalidation are
+    answered by Werkzeug's conditional responses; the body is handed to the
+    WSGI server's file wrapper so servers with sendfile support avoid
+    copying it through Python.
+    """
     file_path = request.args.get('path')
     if not file_path:
         return "Path not provided", 400
 
-    allowed_directory = '/var/www/lts-temp'
+    allowed_directory = os.path.realpath(config.file_resolve_dir)
     real_file_path = os.path.realpath(file_path)
 
-    if not os.path.commonpath([allowed_directory, real_file_path]).startswith(allowed_directory):
+    if os.path.commonpath([allowed_directory, real_file_path]) != allowed_directory:
         return "Unauthorized file access", 403
 
-    if not os.path.isfile(file_path):
+    if not os.path.isfile(real_file_path):
         return "File not found", 404
 
     try:
-        return send_file(file_path, as_attachment=True)
+        response = send_file(
+            real_file_path,
+            as_attachment=True,
+            conditional=True,
+            etag=True,
+            max_age=config.file_resolve_max_age
+        )
+        # Patient data must not be stored by shared caches; max_age made it public
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
     except FileNotFoundError:
         return "File not found", 404
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Report the internal metrics of this process and those published by the DICOM processes."""
+    return jsonify({**metrics.snapshot(), 'processes': metrics.collect(config.metrics_dir)}), 200
@@ -1,7 +1,10 @@
+import copy
 import datetime
 import json
 import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse
 from fhir.resources.servicerequest import ServiceRequest
@@ -18,6 +21,20 @@ organization_id = os.getenv('ORGANIZATION_ID')
 # Initialize logger
 LOGGER = logging.getLogger('pynetdicom')
 
+# Database connection shared by all request threads (DBQuery serializes access)
+_dbq = None
+_dbq_lock = threading.Lock()
+
+
+def get_dbq():
+    """Return the process-wide DBQuery instance, creating it on first use."""
+    global _dbq
+    if _dbq is None:
+        with _dbq_lock:
+            if _dbq is None:
+                _dbq = DBQuery()
+    return _dbq
+
 # Common response templates
 response_templates = {
     "all_ok": {
@@ -54,13 +71,65 @@ response_templates = {
     }
 }
 
+class OrderError(Exception):
+    """Raised when a ServiceRequest cannot be turned into a worklist entry."""
+
+    def __init__(self, severity, code, details, status_code=400):
+        super().__init__(details)
+        self.severity = severity
+        self.code = code
+        self.details = details
+        self.status_code = status_code
+
+
+def bundle_entry_error(error):
+    """Build a batch-response entry for a rejected Bundle entry."""
+    outcome = copy.deepcopy(response_templates["operation_outcome"])
+    outcome['issue'][0]['severity'] = error.severity
+    outcome['issue'][0]['code'] = error.code
+    outcome['issue'][0]['details']['text'] = error.details
+    return {"response": {"status": f"{error.status_code} Bad Request", "outcome": outcome}}
+
+
 class HTTPHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests; every response
+    # therefore has to carry an explicit Content-Length.
+    protocol_version = 'HTTP/1.1'
+
+    # Seconds allowed for reading a request
+    timeout = 15
+
+    # Idle keep-alive connections are closed after this many seconds, so they
+    # do not hold a worker of the pool while waiting for the next request
+    idle_timeout = 2
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        if self.requests_served:
+            self.connection.settimeout(self.idle_timeout)
+        super().handle_one_request()
+
+    def parse_request(self):
+        # The request line has arrived: the rest of the request gets the full timeout
+        self.connection.settimeout(self.timeout)
+        self.requests_served += 1
+        return super().parse_request()
+
     def _set_response(self, status_code=200, content_type='application/json', response_body=None):
+        body = json.dumps(response_body).encode('utf-8') if response_body else b''
         self.send_response(status_code)
         self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        # Connections are waiting for a worker: hand this one back instead of keeping it alive
+        if getattr(self.server, 'saturated', lambda: False)():
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         self.end_headers()
-        if response_body:
-            self.wfile.write(json.dumps(response_body).encode('utf-8'))
+        if body:
+            self.wfile.write(body)
 
     def do_GET(self):
         parsed_path = urlparse(self.path)
@@ -74,7 +143,7 @@ class HTTPHandler(BaseHTTPRequestHandler):
             self._set_response(404, response_body=response_templates["404"])
 
     def do_POST(self):
-        dbq_instance = DBQuery()
+        dbq_instance = get_dbq()
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length).decode('utf-8')
 
@@ -91,53 +160,153 @@ class HTTPHandler(BaseHTTPRequestHandler):
             self._set_response(400, response_body=response)
             return
 
+        # Arrays and scalars are valid JSON but not FHIR resources
+        if not isinstance(json_data, dict):
+            self._set_response(400, response_body=response_templates["invalid_resource"])
+            return
+
         # Handle ServiceRequest POST request
         if resource_type == "ServiceRequest":
             self.handle_service_request(json_data, dbq_instance)
+        elif resource_type in ("", "Bundle") and json_data.get("resourceType") == "Bundle":
+            self.handle_bundle(json_data, dbq_instance)
         else:
             self._set_response(400, response_body=response_templates["invalid_resource"])
 
     def handle_service_request(self, json_data, dbq_instance):
         """Handles the ServiceRequest resource processing."""
         try:
-            sr = ServiceRequest(**json_data)
-        except ValueError as e:
-            LOGGER.error("Error parsing ServiceRequest", exc_info=True)
-            self._send_operation_outcome("error", "invalid", f"{e}", 400)
+            sr, work_list_entry, patient_entry, sr_entry, study_iuid = self.prepare_order(json_data)
+        except OrderError as e:
+            self._send_operation_outcome(e.severity, e.code, e.details, e.status_code)
+            return
+        except Exception as e:
+            LOGGER.error("Error processing ServiceRequest", exc_info=True)
+            self._send_operation_outcome("error", "exception", f"{type(e).__name__}: {e}", 400)
             return
 
-        patient_data = self.extract_patient_data(sr)
-        if patient_data is None:
+        # Insert into MWL and patient table; insert_many raises, unlike insert()
+        try:
+            dbq_instance.insert_many([
+                (dbq_instance.INSERT_MWL, [work_list_entry]),
+                (dbq_instance.INSERT_PATIENT, [patient_entry]),
+                (dbq_instance.UPSERT_SERVICE_REQUEST, [sr_entry] if sr_entry else []),
+            ])
+        except Exception as e:
+            LOGGER.error("Error inserting data", exc_info=True)
+            self._send_operation_outcome("error", "exception", f"Error inserting data: {e}", 500)
             return
 
-        accession_number, study_iuid = self.extract_study_data(sr, dbq_instance)
-        if study_iuid is None:
+        self.add_study_identifier(sr, study_iuid)
+        self._set_response(response_body=sr.dict())
+
+    def handle_bundle(self, json_data, dbq_instance):
+        """
+        Handles a transaction/batch Bundle of ServiceRequests.
+
+        All worklist and patient rows of the valid entries are written in a
+        single SQLite transaction. A transaction Bundle is rejected as a whole
+        if any entry is invalid; a batch Bundle reports errors per entry.
+        """
+        bundle_type = json_data.get("type")
+        if bundle_type not in ("transaction", "batch"):
+            self._send_operation_outcome("error", "invalid", "Bundle type must be 'transaction' or 'batch'", 400)
             return
 
-        modality, scheduled_station_ae_title, referring_phyisician_name, procedure_data = self.extract_order_details(sr)
+        results, work_list_entries, patient_entries, sr_entries = [], [], [], []
+        for index, entry in enumerate(json_data.get("entry") or []):
+            try:
+                resource = (entry or {}).get("resource") or {}
+                if resource.get("resourceType") != "ServiceRequest":
+                    raise OrderError("error", "not-supported", "Only ServiceRequest entries are supported")
+                sr, work_list_entry, patient_entry, sr_entry, study_iuid = self.prepare_order(resource)
+            except Exception as e:
+                # Anything unexpected is reported for its entry instead of aborting the Bundle
+                if not isinstance(e, OrderError):
+                    LOGGER.error(f"Error processing Bundle entry {index}", exc_info=True)
+                    e = OrderError("error", "exception", f"{type(e).__name__}: {e}")
+                if bundle_type == "transaction":
+                    self._send_operation_outcome(e.severity, e.code, f"Bundle entry {index}: {e.details}", e.status_code)
+                    return
+                results.append(bundle_entry_error(e))
+                continue
+
+            work_list_entries.append(work_list_entry)
+            patient_entries.append(patient_entry)
+            if sr_entry:
+                sr_entries.append(sr_entry)
+            results.append((sr, study_iuid))
 
-        # Insert into MWL and patient table
         try:
-            self.insert_work_list(dbq_instance, study_iuid, accession_number, patient_data, modality,
-                                  scheduled_station_ae_title, referring_phyisician_name, procedure_data, sr)
-            self.insert_patient_data(dbq_instance, patient_data)
+            # INSERT OR REPLACE updates orders already in the worklist: those answer 200 OK.
+            # They are looked up in the transaction of the insert.
+            found = dbq_instance.insert_many([
+                (dbq_instance.INSERT_MWL, work_list_entries),
+                (dbq_instance.INSERT_PATIENT, patient_entries),
+                (dbq_instance.UPSERT_SERVICE_REQUEST, sr_entries),
+            ], lookup=(dbq_instance.GET_MWL_STUDIES, [json.dumps([entry[0] for entry in work_list_entries])]))
+            existing = {row[0] for row in found}
         except Exception as e:
-            LOGGER.error("Error inserting data", exc_info=True)
+            LOGGER.error("Error inserting Bundle data", exc_info=True)
+            self._send_operation_outcome("error", "exception", f"Error inserting data: {e}", 500)
             return
 
-        # Add study instance UID to resource identifier
+        LOGGER.info(f"Bundle processed: {len(work_list_entries)} of {len(results)} ServiceRequests stored")
+
+        response_entries = []
+        for result in results:
+            if isinstance(result, dict):
+                response_entries.append(result)
+                continue
+            sr, study_iuid = result
+            self.add_study_identifier(sr, study_iuid)
+            response = {"status": "200 OK" if study_iuid in existing else "201 Created"}
+            if sr.id:
+                response["location"] = f"ServiceRequest/{sr.id}"
+            response_entries.append({"resource": sr.dict(), "response": response})
+
+        self._set_response(response_body={
+            "resourceType": "Bundle",
+            "type": f"{bundle_type}-response",
+            "entry": response_entries
+        })
+
+    def prepare_order(self, json_data):
+        """
+        Validate a ServiceRequest and build its worklist, patient and
+        service_request rows. The service_request row is None when the
+        resource carries no server id or patient reference.
+
+        Raises OrderError when the resource cannot be used.
+        """
+        try:
+            sr = ServiceRequest(**json_data)
+        except ValueError as e:
+            LOGGER.error("Error parsing ServiceRequest", exc_info=True)
+            raise OrderError("error", "invalid", f"{e}")
+
+        patient_data = self.extract_patient_data(sr)
+        accession_number, study_iuid = self.extract_study_data(sr)
+        modality, scheduled_station_ae_title, referring_phyisician_name, procedure_data = self.extract_order_details(sr)
+
+        work_list_entry = self.work_list_entry(study_iuid, accession_number, patient_data, modality,
+                                               scheduled_station_ae_title, referring_phyisician_name, procedure_data, sr)
+        return sr, work_list_entry, self.patient_entry(patient_data), self.service_request_entry(sr, accession_number), study_iuid
+
+    def add_study_identifier(self, sr, study_iuid):
+        """Add the study instance UID to the resource identifier."""
+        if sr.identifier is None:
+            sr.identifier = []
         sr.identifier.append({
             "use": "official",
             "system": "urn:dicom:uid",
             "value": f"urn:oid:{study_iuid}"
         })
 
-        self._set_response(response_body=sr.dict())
-
     def extract_patient_data(self, sr):
         """Extract patient data from the ServiceRequest resource."""
         try:
-            for contained in sr.contained:
+            for contained in sr.contained or []:
                 if isinstance(contained, Patient):
                     patient_mrn = next(
                         (id.value for id in contained.identifier if id.system == f"http://sys-ids.kemkes.go.id/mrn/{organization_id}"),
@@ -152,54 +321,57 @@ class HTTPHandler(BaseHTTPRequestHandler):
                     }
         except Exception as e:
             LOGGER.error(f"Error parsing patient data: {e}")
-            self._send_operation_outcome("error", "value", f"Error parsing patient data: {e}", 400)
-            return None
+            raise OrderError("error", "value", f"Error parsing patient data: {e}")
 
-        self._send_operation_outcome("error", "value", "Patient resource not found in 'contained'", 400)
-        return None
+        raise OrderError("error", "value", "Patient resource not found in 'contained'")
 
-    def extract_study_data(self, sr, dbq_instance):
+    def extract_study_data(self, sr):
         """Extracts accession number and study instance UID."""
+        identifiers = sr.identifier or []
         accession_number = next(
-            (id.value for id in sr.identifier if id.system == f"http://sys-ids.kemkes.go.id/acsn/{organization_id}"),
+            (id.value for id in identifiers if id.system == f"http://sys-ids.kemkes.go.id/acsn/{organization_id}"),
             None
         )
-        study_iuid = next(
-            (id.value.strip(':').split(':')[2] for id in sr.identifier if id.system == "urn:dicom:uid"),
-            helper.new_study_iuid(organization_id)
-        )
+        study_uid = next((id.value for id in identifiers if id.system == "urn:dicom:uid"), None)
+        if study_uid is None:
+            return accession_number, helper.new_study_iuid(organization_id)
 
-        return accession_number, study_iuid
+        # urn:oid:<study instance UID>
+        parts = (study_uid or "").strip(':').split(':')
+        if len(parts) != 3 or parts[:2] != ["urn", "oid"] or not parts[2]:
+            raise OrderError("error", "value", f"Invalid urn:dicom:uid identifier: {study_uid}")
+        return accession_number, parts[2]
 
     def extract_order_details(self, sr):
         """Extracts modality, AE title, and referring physician from the ServiceRequest."""
-        modality, scheduled_station_ae_title, referring_phyisician_name = "", "", ""
-
         try:
             modality = next(
-                (coding.code for detail in sr.orderDetail for coding in detail.coding
+                (coding.code for detail in sr.orderDetail or [] for coding in detail.coding
                  if coding.system == "http://dicom.nema.org/resources/ontology/DCM"),
                 ""
             )
             scheduled_station_ae_title = next(
-                (coding.display for detail in sr.orderDetail for coding in detail.coding
+                (coding.display for detail in sr.orderDetail or [] for coding in detail.coding
                  if coding.system == "http://sys-ids.kemkes.go.id/ae-title"),
                 ""
             )
             referring_phyisician_name = sr.requester.display if sr.requester else ""
+            procedure_data = {
+                'procedure_id': sr.code.coding[0].code,
+                'procedure_description': sr.code.coding[0].display
+            }
         except Exception as e:
             LOGGER.error(f"Error extracting order details: {e}", exc_info=True)
-            self._send_operation_outcome("error", "value", "Error extracting order details", 400)
+            raise OrderError("error", "value", "Error extracting order details")
 
-        return modality, scheduled_station_ae_title, referring_phyisician_name, {
-            'procedure_id': sr.code.coding[0].code,
-            'procedure_description': sr.code.coding[0].display
-        }
+        return modality, scheduled_station_ae_title, referring_phyisician_name, procedure_data
 
-    def insert_work_list(self, dbq_instance, study_iuid, accession_number, patient_data, modality,
-                         scheduled_station_ae_title, referring_phyisician_name, procedure_data, sr):
-        """Insert data into MWL table."""
-        entry = (
+    def work_list_entry(self, study_iuid, accession_number, patient_data, modality,
+                        scheduled_station_ae_title, referring_phyisician_name, procedure_data, sr):
+        """Build the row inserted into the MWL table."""
+        if sr.occurrenceDateTime is None:
+            raise OrderError("error", "required", "ServiceRequest.occurrenceDateTime is required")
+        return (
             study_iuid,
             accession_number,
             study_iuid,
@@ -212,18 +384,24 @@ class HTTPHandler(BaseHTTPRequestHandler):
             sr.occurrenceDateTime.strftime("%Y%m%d"),
             sr.occurrenceDateTime.strftime("%H%M%S")
         )
-        dbq_instance.Insert(dbq_instance.INSERT_MWL, entry)
 
-    def insert_patient_data(self, dbq_instance, patient_data):
-        """Insert patient data into the patient table."""
-        entry = (
+    def service_request_entry(self, sr, accession_number):
+        """Build the row cached in the service_request table, if possible."""
+        reference = sr.subject.reference if sr.subject else None
+        if not sr.id or not accession_number or not reference or not reference.startswith("Patient/"):
+            return None
+        last_updated = sr.meta.lastUpdated.isoformat() if sr.meta and sr.meta.lastUpdated else None
+        return (sr.id, accession_number, reference.split("/")[-1], last_updated)
+
+    def patient_entry(self, patient_data):
+        """Build the row inserted into the patient table."""
+        return (
             patient_data['id'],
             patient_data['mrn'],
             patient_data['name'],
             patient_data['birthDate'],
             patient_data['gender']
         )
-        dbq_instance.Insert(dbq_instance.INSERT_PATIENT, entry)
 
     def _send_operation_outcome(self, severity, code, details, status_code=400):
         """Helper function to send an OperationOutcome response."""
@@ -233,11 +411,67 @@ class HTTPHandler(BaseHTTPRequestHandler):
         response['issue'][0]['details']['text'] = details
         self._set_response(status_code, response_body=response)
 
-def start_server(port):
-    """Start the HTTP server."""
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTPServer that handles connections on a bounded pool of worker threads.
+
+    A keep-alive connection holds its worker until it is closed, so while
+    accepted connections are waiting for a worker, responses carry
+    `Connection: close` (see HTTPHandler._set_response).
+    """
+
+    def __init__(self, server_address, handler_class, workers, backlog=None):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http-worker')
+        # Limit accepted-but-unserved connections; the accept loop blocks when full
+        self.slots = threading.BoundedSemaphore(workers + (backlog if backlog is not None else workers))
+        self.waiting = 0
+        self.waiting_lock = threading.Lock()
+
+    def saturated(self):
+        """True while accepted connections are waiting for a worker."""
+        return self.waiting > 0
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self.waiting_lock:
+            self.waiting += 1
+        self.executor.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        with self.waiting_lock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
+def start_server(port, workers=0, request_timeout=15, idle_timeout=2):
+    """
+    Start the HTTP server.
+
+    With `workers` > 0 requests are served concurrently by a bounded pool of
+    threads; otherwise the server handles one request at a time. Keep-alive
+    connections are closed after `idle_timeout` seconds without a request.
+    """
     server_address = ('', port)
-    httpd = HTTPServer(server_address, HTTPHandler)
+    HTTPHandler.timeout = request_timeout
+    HTTPHandler.idle_timeout = idle_timeout
+    if workers > 0:
+        LOGGER.info(f"HTTP server using {workers} worker threads")
+        httpd = PooledHTTPServer(server_address, HTTPHandler, workers)
+    else:
+        httpd = HTTPServer(server_address, HTTPHandler)
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
+        httpd.server_close()
         exit()
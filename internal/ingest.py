@@ -0,0 +1,55 @@
+import logging
+import os
+import queue
+import threading
+
+# Logger initialization
+LOGGER = logging.getLogger("flask_server")
+
+
+class IngestDispatcher:
+    """
+    Dispatches file paths to a bounded pool of worker threads.
+
+    Paths already waiting in the queue are coalesced, so a burst of events
+    for the same file results in a single call to `handler`. Once a worker
+    picks a path up, a new event for it is queued again.
+    """
+
+    def __init__(self, handler, workers, queue_size=1000):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"ingest-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, pathname):
+        """Queue a file for processing; blocks while the queue is full."""
+        with self.lock:
+            if pathname in self.pending:
+                return
+            self.pending.add(pathname)
+        self.queue.put(pathname)
+
+    def submit_tree(self, folder_path):
+        """Queue every file below a folder, e.g. a directory moved into the watch."""
+        for root, _, filenames in os.walk(folder_path):
+            for filename in filenames:
+                self.submit(os.path.join(root, filename))
+
+    def _worker(self):
+        while True:
+            pathname = self.queue.get()
+            with self.lock:
+                self.pending.discard(pathname)
+            try:
+                self.handler(pathname)
+            except Exception as e:
+                LOGGER.error(f"Error ingesting {pathname}: {e}")
+            finally:
+                self.queue.task_done()
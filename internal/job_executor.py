@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# Logger initialization
+LOGGER = logging.getLogger("dicom_router_inotify")
+
+# Job states; queued and running jobs count as in flight
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobExecutor:
+    """
+    Runs jobs on a bounded pool of threads, at most one in flight per key.
+
+    Every job is persisted in `collection`, so callers can poll its status
+    from any process. Jobs in flight carry `active: true`, and a unique
+    partial index on the key fields over active jobs makes MongoDB refuse a
+    second job for the same key, whichever process submits it.
+
+    The process owning a job holds a lease on it (`lease_until`) and renews
+    it every `lease_seconds / 3` while the job is queued or running. Jobs
+    whose lease has expired belong to a process that stopped; recover()
+    claims them atomically and re-queues them. It runs at start and with
+    every lease renewal.
+    """
+
+    def __init__(self, collection, target, key_fields, max_workers, lease_seconds=60):
+        self.collection = collection
+        self.target = target
+        self.key_fields = key_fields
+        self.lease = timedelta(seconds=lease_seconds)
+        self.instance_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self.owned = set()
+        self.lock = threading.Lock()
+
+        # Queued and running are the only states with `active`, so the index only covers jobs in flight
+        self.collection.create_index([(field, ASCENDING) for field in key_fields], name="active_job_unique",
+                                     unique=True, partialFilterExpression={"active": True})
+        self.collection.create_index([("active", ASCENDING), ("lease_until", ASCENDING)], name="active_lease")
+
+        self.heartbeat = threading.Thread(target=self._renew_leases, name="job-lease", daemon=True)
+        self.heartbeat.start()
+
+    def submit(self, key, args):
+        """
+        Queue a job for `key` unless one is already in flight.
+
+        Returns:
+            tuple: (job document, True if a new job was queued)
+        """
+        job = {
+            "_id": uuid.uuid4().hex,
+            **{field: key[field] for field in self.key_fields},
+            "args": list(args),
+            "status": QUEUED,
+            "active": True,
+            "instance": self.instance_id,
+            "lease_until": datetime.now() + self.lease,
+            "created_at": datetime.now(),
+        }
+        try:
+            self.collection.insert_one(job)
+        except DuplicateKeyError:
+            existing = self.collection.find_one({**{field: key[field] for field in self.key_fields}, "active": True})
+            if existing is not None:
+                return existing, False
+            # The job in flight finished in the meantime
+            return self.submit(key, args)
+
+        self._start(job)
+        return job, True
+
+    def recover(self):
+        """Re-queue jobs whose owner stopped renewing their lease. Returns the number recovered."""
+        recovered = 0
+        while True:
+            now = datetime.now()
+            job = self.collection.find_one_and_update(
+                {"active": True, "lease_until": {"$lt": now}},
+                {"$set": {"status": QUEUED, "instance": self.instance_id, "lease_until": now + self.lease}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job is None:
+                break
+            self._start(job)
+            recovered += 1
+
+        if recovered:
+            LOGGER.info(f"Recovered {recovered} job(s) with an expired lease")
+        return recovered
+
+    def get(self, job_id):
+        """Return the persisted job document."""
+        return self.collection.find_one({"_id": job_id})
+
+    def find_latest(self, key):
+        """Return the most recent job for a key."""
+        query = {field: key.get(field) for field in self.key_fields}
+        return self.collection.find_one(query, sort=[("created_at", -1)])
+
+    def _start(self, job):
+        with self.lock:
+            self.owned.add(job["_id"])
+        self.executor.submit(self._run, job["_id"], tuple(job["args"]))
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease.total_seconds() / 3)
+            with self.lock:
+                owned = list(self.owned)
+            try:
+                if owned:
+                    self.collection.update_many(
+                        {"_id": {"$in": owned}, "instance": self.instance_id, "active": True},
+                        {"$set": {"lease_until": datetime.now() + self.lease}}
+                    )
+                self.recover()
+            except PyMongoError as e:
+                LOGGER.error(f"Unable to renew job leases: {e}")
+
+    def _run(self, job_id, args):
+        try:
+            # The lease may have been lost to another process while the job was queued here
+            claimed = self.collection.find_one_and_update(
+                {"_id": job_id, "instance": self.instance_id, "active": True},
+                {"$set": {"status": RUNNING, "started_at": datetime.now()}}
+            )
+            if claimed is None:
+                LOGGER.warning(f"Job {job_id} is no longer owned by {self.instance_id}, skipping")
+                return
+
+            try:
+                self.target(*args)
+                update = {"status": DONE}
+            except Exception as e:
+                LOGGER.error(f"Job {job_id} failed: {e}")
+                update = {"status": FAILED, "error": str(e)}
+
+            # Scoped to the owner: a process that took the job over reports its own result
+            self.collection.update_one(
+                {"_id": job_id, "instance": self.instance_id},
+                {"$set": {**update, "finished_at": datetime.now()}, "$unset": {"active": "", "lease_until": ""}}
+            )
+        finally:
+            with self.lock:
+                self.owned.discard(job_id)
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure, PyMongoError
+
+# Logger initialization
+LOGGER = logging.getLogger("flask_server")
+
+# Collections are flushed parent first so readers never see orphaned images
+COLLECTIONS = ("patient", "study", "series", "image")
+
+# Fields identifying a document in its collection
+KEY_FIELDS = ("patient_id", "study_id", "series_instance_uid", "sop_instance_uid")
+
+# Write error codes worth retrying: unreachable, stepped down or shutting down primaries, timeouts, write conflicts
+TRANSIENT_CODES = {6, 7, 50, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+# Upserts rejected for good (e.g. duplicate keys) are kept here for inspection or replay
+ERRORS_COLLECTION = "metadata_write_error"
+
+
+class MetadataWriter:
+    """
+    Batches DICOM metadata upserts and writes them with bulk_write.
+
+    Upserts for the same document within a batch are collapsed, so a study
+    of N images results in one patient, one study and one series upsert.
+    A batch is flushed when it reaches `batch_size` documents or every
+    `flush_interval` seconds. Upserts only $set fields, which makes retrying
+    them idempotent: only the operations that failed transiently are retried,
+    and those still failing go back to the pending batch for the next flush.
+    Operations rejected for good are recorded in ERRORS_COLLECTION.
+    """
+
+    def __init__(self, db, batch_size=500, flush_interval=1.0, max_retries=3):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self.pending = {collection: {} for collection in COLLECTIONS}
+        self.pending_count = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.stats = {
+            "batches": 0,
+            "documents": 0,
+            "collapsed": 0,
+            "failed_documents": 0,
+            "requeued_documents": 0,
+            "retries": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+        self.thread = threading.Thread(target=self._run, name="metadata-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, collection, metadata):
+        """Queue an upsert of `metadata` into `collection`."""
+        key = tuple((field, metadata[field]) for field in KEY_FIELDS if field in metadata)
+        with self.lock:
+            documents = self.pending[collection]
+            if key in documents:
+                documents[key].update(metadata)
+                self.stats["collapsed"] += 1
+            else:
+                documents[key] = dict(metadata)
+                self.pending_count += 1
+            full = self.pending_count >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write all pending upserts, one unordered bulk_write per collection."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {collection: {} for collection in COLLECTIONS}
+                size, self.pending_count = self.pending_count, 0
+            if not size:
+                return
+
+            started = time.monotonic()
+            for collection in COLLECTIONS:
+                if batch[collection]:
+                    self._bulk_write(collection, list(batch[collection].items()))
+
+            elapsed = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.stats["batches"] += 1
+                self.stats["documents"] += size
+                self.stats["last_batch_size"] = size
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], size)
+                self.stats["last_flush_ms"] = round(elapsed, 2)
+                self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed), 2)
+                self.stats["total_flush_ms"] += elapsed
+            LOGGER.info(f"Flushed {size} metadata upserts in {elapsed:.1f} ms")
+
+    def _bulk_write(self, collection, documents):
+        """Upsert (key, metadata) pairs, retrying the transiently failed ones with backoff."""
+        for attempt in range(self.max_retries + 1):
+            now = datetime.now()
+            operations = [
+                UpdateOne(
+                    dict(key),
+                    {"$set": {**metadata, "updated_at": now}, "$setOnInsert": {"created_at": now}},
+                    upsert=True
+                )
+                for key, metadata in documents
+            ]
+            try:
+                self.db[collection].bulk_write(operations, ordered=False)
+                return
+            except BulkWriteError as e:
+                transient, rejected = [], []
+                for error in e.details.get("writeErrors", []):
+                    failed = (documents[error["index"]], error)
+                    (transient if error.get("code") in TRANSIENT_CODES else rejected).append(failed)
+                if rejected:
+                    self._reject(collection, rejected)
+                documents = [document for document, _ in transient]
+                reason = transient[0][1].get("errmsg") if transient else None
+            except (ConnectionFailure, OperationFailure) as e:
+                reason = e
+
+            if not documents:
+                return
+            if attempt == self.max_retries:
+                LOGGER.error(f"Keeping {len(documents)} {collection} upserts for the next flush: {reason}")
+                self._requeue(collection, documents)
+                return
+            LOGGER.warning(f"Retrying {len(documents)} {collection} upserts ({attempt + 1}/{self.max_retries}): {reason}")
+            with self.lock:
+                self.stats["retries"] += 1
+            time.sleep(0.5 * 2 ** attempt)
+
+    def _requeue(self, collection, documents):
+        """Put documents back into the pending batch; newer upserts of the same document win."""
+        with self.lock:
+            pending = self.pending[collection]
+            for key, metadata in documents:
+                if key in pending:
+                    pending[key] = {**metadata, **pending[key]}
+                else:
+                    pending[key] = metadata
+                    self.pending_count += 1
+            self.stats["requeued_documents"] += len(documents)
+
+    def _reject(self, collection, rejected):
+        """Record upserts that failed with a non-transient error in ERRORS_COLLECTION."""
+        LOGGER.error(f"{len(rejected)} {collection} upserts rejected, e.g. {rejected[0][1].get('errmsg')}")
+        with self.lock:
+            self.stats["failed_documents"] += len(rejected)
+        now = datetime.now()
+        try:
+            self.db[ERRORS_COLLECTION].insert_many([
+                {"collection": collection, "key": dict(key), "metadata": metadata,
+                 "code": error.get("code"), "error": error.get("errmsg"), "created_at": now}
+                for (key, metadata), error in rejected
+            ])
+        except PyMongoError as e:
+            LOGGER.error(f"Unable to record rejected {collection} upserts: {e}")
+
+    def metrics(self):
+        """Return batch size and flush latency metrics."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = self.pending_count
+        stats["avg_batch_size"] = round(stats["documents"] / stats["batches"], 2) if stats["batches"] else 0
+        stats["avg_flush_ms"] = round(stats.pop("total_flush_ms") / stats["batches"], 2) if stats["batches"] else 0
+        return stats
+
+    def close(self):
+        """Stop the background flusher and write what is left."""
+        self.stopped.set()
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                LOGGER.error(f"Metadata flush failed: {e}")
@@ -0,0 +1,177 @@
+import logging
+import os
+import threading
+from datetime import datetime
+
+from pydicom.dataset import Dataset
+
+from internal.admission import calling_ae_title
+from utils.dbquery import DBQuery
+
+# Logger initialization
+LOGGER = logging.getLogger("pynetdicom")
+
+# Performed Procedure Step Status values (PS3.3 C.4.14)
+IN_PROGRESS = "IN PROGRESS"
+COMPLETED = "COMPLETED"
+DISCONTINUED = "DISCONTINUED"
+
+# DIMSE statuses used by the MPPS SCP (PS3.4 F.7.2, PS3.7 C)
+STATUS_SUCCESS = 0x0000
+STATUS_PROCESSING_FAILURE = 0x0110
+STATUS_DUPLICATE_INSTANCE = 0x0111
+STATUS_NO_SUCH_INSTANCE = 0x0112
+STATUS_INVALID_ATTRIBUTE_VALUE = 0x0106
+
+
+def procedure_study(ds):
+    """Return (StudyInstanceUID, AccessionNumber) of a performed procedure step."""
+    for item in ds.get("ScheduledStepAttributesSequence", []):
+        if item.get("StudyInstanceUID"):
+            return item.StudyInstanceUID, item.get("AccessionNumber") or None
+    return None, None
+
+
+def referenced_instances(ds):
+    """Return the (SeriesInstanceUID, SOPInstanceUID) pairs listed in the Performed Series Sequence."""
+    instances = []
+    for series in ds.get("PerformedSeriesSequence", []):
+        for sequence in ("ReferencedImageSequence", "ReferencedNonImageCompositeSOPInstanceSequence"):
+            for item in series.get(sequence, []):
+                instances.append((series.SeriesInstanceUID, item.ReferencedSOPInstanceUID))
+    return instances
+
+
+class MppsTracker:
+    """
+    Modality Performed Procedure Step SCP deciding when a study is complete.
+
+    N-CREATE and N-SET are kept in the mpps table, the attribute list as
+    DICOM JSON. When a step is set to COMPLETED, its referenced instances
+    are recorded and `process(study_iuid, accession_number)` runs as soon
+    as all of them have been received: immediately when they are already
+    stored, otherwise from the C-STORE of the last one. After
+    `wait_timeout` seconds the study is processed with what has arrived.
+    Completion is claimed in the database, so it runs once across the SCP
+    worker processes.
+
+    C-STOREs are debounced per study: the first one schedules a single
+    check `check_delay` seconds later, which covers the instances stored
+    until then.
+    """
+
+    def __init__(self, process, wait_timeout=300, check_delay=1.0):
+        self.process = process
+        self.wait_timeout = wait_timeout
+        self.check_delay = check_delay
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def handle_n_create(self, event):
+        """EVT_N_CREATE handler: record a new performed procedure step."""
+        dbq = DBQuery()
+        ds = event.attribute_list
+        sop_instance_uid = event.request.AffectedSOPInstanceUID
+        if sop_instance_uid is None:
+            LOGGER.error("MPPS N-CREATE without Affected SOP Instance UID")
+            return STATUS_PROCESSING_FAILURE, None
+
+        status = ds.get("PerformedProcedureStepStatus")
+        if status != IN_PROGRESS:
+            LOGGER.error(f"MPPS N-CREATE {sop_instance_uid} with status {status}, expected {IN_PROGRESS}")
+            return STATUS_INVALID_ATTRIBUTE_VALUE, None
+
+        if dbq.query(dbq.GET_MPPS, [sop_instance_uid]):
+            return STATUS_DUPLICATE_INSTANCE, None
+
+        study_iuid, accession_number = procedure_study(ds)
+        now = datetime.now().isoformat()
+        dbq.insert(dbq.INSERT_MPPS, (sop_instance_uid, study_iuid, accession_number,
+                                     calling_ae_title(event.assoc), status, ds.to_json(), now, now))
+        LOGGER.info(f"MPPS {sop_instance_uid} IN PROGRESS for study {study_iuid}")
+        return STATUS_SUCCESS, ds
+
+    def handle_n_set(self, event):
+        """EVT_N_SET handler: update a performed procedure step, processing its study when COMPLETED."""
+        dbq = DBQuery()
+        sop_instance_uid = event.request.RequestedSOPInstanceUID
+        rows = dbq.query(dbq.GET_MPPS, [sop_instance_uid])
+        if not rows:
+            return STATUS_NO_SUCH_INSTANCE, None
+
+        row = rows[0]
+        if row["status"] != IN_PROGRESS:
+            LOGGER.error(f"MPPS {sop_instance_uid} is {row['status']} and may no longer be updated")
+            return STATUS_PROCESSING_FAILURE, None
+
+        ds = Dataset.from_json(row["dataset"])
+        ds.update(event.modification_list)
+        status = ds.get("PerformedProcedureStepStatus")
+        if status not in (IN_PROGRESS, COMPLETED, DISCONTINUED):
+            return STATUS_INVALID_ATTRIBUTE_VALUE, None
+
+        study_iuid = row["study_iuid"] or procedure_study(ds)[0]
+        dbq.update(dbq.UPDATE_MPPS, (study_iuid, status, ds.to_json(), datetime.now().isoformat(), sop_instance_uid))
+        LOGGER.info(f"MPPS {sop_instance_uid} {status} for study {study_iuid}")
+
+        if status == COMPLETED and study_iuid:
+            dbq.insert_many([(dbq.INSERT_MPPS_INSTANCE, [
+                (sop_instance_uid, study_iuid, series_iuid, instance_uid)
+                for series_iuid, instance_uid in referenced_instances(ds)
+            ])])
+            # Answer the N-SET first, the upload can take a while
+            threading.Thread(target=self.check, args=(study_iuid,), daemon=True).start()
+            timer = threading.Timer(self.wait_timeout, self.check, args=(study_iuid, True))
+            timer.daemon = True
+            timer.start()
+
+        return STATUS_SUCCESS, event.modification_list
+
+    def instance_stored(self, study_iuid):
+        """Called after each C-STORE: schedules a check of the study unless one is pending."""
+        with self.lock:
+            # Timers do not survive fork(): each SCP worker starts with no pending check
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pending = set()
+            if study_iuid in self.pending:
+                return
+            self.pending.add(study_iuid)
+
+        timer = threading.Timer(self.check_delay, self._check_pending, args=(study_iuid,))
+        timer.daemon = True
+        timer.start()
+
+    def _check_pending(self, study_iuid):
+        with self.lock:
+            self.pending.discard(study_iuid)
+        self.check(study_iuid)
+
+    def check(self, study_iuid, timed_out=False):
+        """Process the study of every COMPLETED step whose instances have all been received."""
+        dbq = DBQuery()
+        for row in dbq.query(dbq.GET_MPPS_COMPLETED_PER_STUDY, [study_iuid]) or []:
+            sop_instance_uid = row["sop_instance_uid"]
+            received, expected = dbq.query(dbq.COUNT_MPPS_INSTANCES, [sop_instance_uid])[0]
+            if received < expected and not timed_out:
+                LOGGER.info(f"MPPS {sop_instance_uid}: {received} of {expected} instances received")
+                continue
+            if received < expected:
+                LOGGER.warning(f"MPPS {sop_instance_uid}: processing study {study_iuid} after "
+                               f"{self.wait_timeout}s with {received} of {expected} instances")
+
+            # Another thread or worker process may have seen the same completion
+            if not dbq.update(dbq.CLAIM_MPPS, [sop_instance_uid]):
+                continue
+
+            accession_number = row["accession_number"]
+            if not accession_number:
+                accession_rows = dbq.query(dbq.GET_ACCESSION_PER_STUDY, [study_iuid])
+                accession_number = accession_rows[0][0] if accession_rows else None
+
+            LOGGER.info(f"MPPS {sop_instance_uid}: study {study_iuid} complete, processing")
+            try:
+                self.process(study_iuid, accession_number)
+            except Exception as e:
+                LOGGER.error(f"Processing study {study_iuid} of MPPS {sop_instance_uid} failed: {e}", exc_info=True)
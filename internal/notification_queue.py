@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+# Logger initialization
+LOGGER = logging.getLogger("flask_server")
+
+# Notification states; sending notifications are claimed by a worker
+QUEUED, SENDING, SENT, FAILED = "queued", "sending", "sent", "failed"
+
+# Fields of a notification passed on to the sender, in order
+MESSAGE_FIELDS = ("patient_phone_number", "preview_image", "patient_name", "examination", "hospital", "date", "link")
+
+# Claims older than this are considered abandoned by a stopped worker
+_CLAIM_TIMEOUT = timedelta(minutes=5)
+
+# Upper bound of the retry delay, in seconds
+_MAX_BACKOFF = 600
+
+# Seconds between membership refreshes; members silent for three of them are gone
+_MEMBER_INTERVAL = 10
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Change the rate, keeping the tokens earned at the previous one."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = max(1, int(rate))
+            self.tokens = min(self.capacity, self.tokens)
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def dedup_key(message):
+    """
+    Identify a notification by patient phone and study (study UID, accession number or link).
+
+    A message without any study identifier cannot be matched to another
+    one, so it gets a key of its own and is never deduplicated.
+    """
+    study = message.get("study_instance_uid") or message.get("accession_number") or message.get("link")
+    if not study:
+        study = f"message:{uuid.uuid4().hex}"
+    return f"{message['patient_phone_number']}|{study}"
+
+
+class NotificationQueue:
+    """
+    Persistent WhatsApp notification queue served by a pool of worker threads.
+
+    Notifications live in `collection`, so they survive restarts and can be
+    polled by id. Workers claim them atomically, which lets several
+    processes share the queue. Sends are throttled by a token bucket and
+    transient failures (network errors, 429, 5xx) are retried with
+    exponential backoff up to `max_attempts`.
+
+    With a `members` collection, every process serving the queue registers
+    there and `rate_limit` is split evenly between the processes that are
+    actually running, re-evaluated every few seconds.
+    """
+
+    def __init__(self, collection, sender, workers, rate_limit, max_attempts=5, poll_interval=1.0, members=None):
+        self.collection = collection
+        self.sender = sender
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.rate_limit = rate_limit
+        self.members = members
+        self.bucket = TokenBucket(rate_limit)
+        self.instance_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.wakeup = threading.Event()
+        if members is not None:
+            self._share_rate()
+            threading.Thread(target=self._refresh_membership, name="whatsapp-rate", daemon=True).start()
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"whatsapp-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, messages):
+        """
+        Queue messages in one bulk write, skipping (phone, study) pairs already queued or sent.
+
+        Failed notifications for the same pair are queued again.
+
+        Returns:
+            list: One {"job_id", "duplicate"} dict per message, in order.
+        """
+        now = datetime.now()
+        keys = [dedup_key(message) for message in messages]
+        operations = [
+            UpdateOne(
+                {"dedup_key": key},
+                {"$setOnInsert": {
+                    "_id": uuid.uuid4().hex,
+                    "dedup_key": key,
+                    "message": {field: message.get(field) for field in MESSAGE_FIELDS},
+                    "status": QUEUED,
+                    "attempts": 0,
+                    "next_attempt_at": now,
+                    "created_at": now,
+                }},
+                upsert=True
+            )
+            for key, message in zip(keys, messages)
+        ]
+        result = self.collection.bulk_write(operations, ordered=False)
+        requeued = self.collection.update_many(
+            {"dedup_key": {"$in": keys}, "status": FAILED},
+            {"$set": {"status": QUEUED, "attempts": 0, "next_attempt_at": now}, "$unset": {"error": ""}}
+        )
+
+        inserted = set(result.upserted_ids)
+        ids = {doc["dedup_key"]: doc["_id"] for doc in self.collection.find({"dedup_key": {"$in": keys}}, {"dedup_key": 1})}
+        if inserted or requeued.modified_count:
+            self.wakeup.set()
+        return [{"job_id": ids.get(key), "duplicate": index not in inserted} for index, key in enumerate(keys)]
+
+    def get(self, job_id):
+        """Return the persisted notification."""
+        return self.collection.find_one({"_id": job_id})
+
+    def _share_rate(self):
+        """Refresh this process' membership and take its share of the rate limit."""
+        now = datetime.now()
+        try:
+            self.members.update_one({"_id": self.instance_id}, {"$set": {"seen_at": now}}, upsert=True)
+            self.members.delete_many({"seen_at": {"$lt": now - timedelta(seconds=3 * _MEMBER_INTERVAL)}})
+            count = max(1, self.members.count_documents({}))
+        except PyMongoError as e:
+            LOGGER.error(f"Unable to refresh WhatsApp queue membership: {e}")
+            return
+        self.bucket.set_rate(self.rate_limit / count)
+
+    def _refresh_membership(self):
+        while True:
+            time.sleep(_MEMBER_INTERVAL)
+            self._share_rate()
+
+    def _claim(self):
+        """Atomically take the next due notification, including abandoned claims."""
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {"$or": [
+                {"status": QUEUED, "next_attempt_at": {"$lte": now}},
+                {"status": SENDING, "claimed_at": {"$lt": now - _CLAIM_TIMEOUT}},
+            ]},
+            {"$set": {"status": SENDING, "instance": self.instance_id, "claimed_at": now}},
+            sort=[("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _worker(self):
+        while True:
+            try:
+                notification = self._claim()
+            except PyMongoError as e:
+                LOGGER.error(f"Unable to claim WhatsApp notification: {e}")
+                notification = None
+
+            if notification is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            self.bucket.acquire()
+            self._send(notification)
+
+    def _send(self, notification):
+        message = notification["message"]
+        attempts = notification.get("attempts", 0) + 1
+        retry_after = None
+        try:
+            response = self.sender(*(message.get(field) for field in MESSAGE_FIELDS))
+            status_code = response.status_code
+            if status_code == 200:
+                self._finish(notification, {"status": SENT, "attempts": attempts, "response_status": status_code})
+                return
+            error = f"Provider returned {status_code}"
+            if status_code == 429:
+                retry_after = response.headers.get("Retry-After")
+            elif status_code < 500:
+                # Other client errors will not succeed on a retry
+                self._finish(notification, {"status": FAILED, "attempts": attempts, "response_status": status_code,
+                                            "error": error})
+                return
+        except Exception as e:
+            status_code, error = None, str(e)
+
+        if attempts >= self.max_attempts:
+            LOGGER.error(f"Giving up on WhatsApp notification {notification['_id']}: {error}")
+            self._finish(notification, {"status": FAILED, "attempts": attempts, "response_status": status_code,
+                                        "error": error})
+            return
+
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else min(_MAX_BACKOFF, 5 * 2 ** (attempts - 1))
+        LOGGER.warning(f"Retrying WhatsApp notification {notification['_id']} in {delay:.0f}s: {error}")
+        self._finish(notification, {"status": QUEUED, "attempts": attempts, "response_status": status_code,
+                                    "error": error, "next_attempt_at": datetime.now() + timedelta(seconds=delay)})
+
+    def _finish(self, notification, update):
+        self.collection.update_one(
+            {"_id": notification["_id"], "instance": self.instance_id},
+            {"$set": {**update, "updated_at": datetime.now()}}
+        )
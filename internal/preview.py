@@ -0,0 +1,265 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from pydicom import dcmread
+from pydicom.encaps import encapsulate, generate_pixel_data_frame
+from pydicom.multival import MultiValue
+
+# Logger initialization
+LOGGER = logging.getLogger("flask_server")
+
+# Output formats and the Pillow options used to write them
+FORMATS = {
+    "jpeg": ("jpg", {"format": "JPEG", "quality": 85, "optimize": True}),
+    "png": ("png", {"format": "PNG", "optimize": True}),
+}
+
+
+def _number(value, default=None):
+    """Return the first value of a (possibly multi-valued) numeric element."""
+    if value is None or value == "":
+        return default
+    if isinstance(value, MultiValue):
+        value = value[0]
+    return float(value)
+
+
+def _keep_frame(ds, index):
+    """
+    Reduce a multi-frame dataset to its frame at `index`, so only that frame is decoded.
+
+    Encapsulated frames are split out of the fragments without decoding the
+    others; native frames are sliced from the pixel buffer by frame size.
+
+    Returns:
+        bool: False when the frame cannot be isolated (bit-packed or YBR_FULL_422 native pixels).
+    """
+    transfer_syntax = ds.file_meta.get("TransferSyntaxUID") if hasattr(ds, "file_meta") else None
+    if transfer_syntax is None or "PixelData" not in ds:
+        return False
+
+    frames = int(ds.NumberOfFrames)
+    if transfer_syntax.is_compressed:
+        for number, frame in enumerate(generate_pixel_data_frame(ds.PixelData, frames)):
+            if number == index:
+                ds.PixelData = encapsulate([frame])
+                break
+        else:
+            return False
+    else:
+        bits = int(ds.BitsAllocated)
+        if bits % 8 or ds.get("PhotometricInterpretation") == "YBR_FULL_422":
+            return False
+        size = int(ds.Rows) * int(ds.Columns) * int(ds.get("SamplesPerPixel", 1) or 1) * bits // 8
+        frame = ds.PixelData[index * size:(index + 1) * size]
+        if len(frame) != size:
+            return False
+        ds.PixelData = frame
+
+    ds.NumberOfFrames = 1
+    return True
+
+
+def render_preview(dicom_path, output_path, max_size=512, image_format="jpeg"):
+    """
+    Render one frame of a DICOM file to a small 8 bit image.
+
+    Runs in a worker process. Of a multi-frame object only the middle
+    frame is decoded. The frame is decimated towards `max_size`
+    before any arithmetic, then the Modality LUT (rescale) and the VOI LUT
+    (Window Center/Width, falling back to the pixel range) are applied as
+    vectorized NumPy operations.
+
+    Args:
+        dicom_path (str): The DICOM file to render.
+        output_path (str): Where to write the image; written atomically.
+        max_size (int): Largest side of the output in pixels.
+        image_format (str): "jpeg" or "png".
+
+    Returns:
+        str: output_path
+    """
+    ds = dcmread(dicom_path, force=True)
+
+    # Multi-frame: decode the middle frame only, or all of them when it cannot be isolated
+    frames = int(ds.get("NumberOfFrames", 1) or 1)
+    samples = int(ds.get("SamplesPerPixel", 1) or 1)
+    if frames > 1 and _keep_frame(ds, frames // 2):
+        frames = 1
+    pixels = ds.pixel_array
+    if frames > 1:
+        pixels = pixels[frames // 2]
+
+    # Integer decimation first so windowing only touches the pixels we keep
+    step = max(1, max(pixels.shape[:2]) // (max_size * 2))
+    pixels = pixels[::step, ::step]
+
+    if samples == 1:
+        values = pixels.astype(np.float32)
+        values *= _number(ds.get("RescaleSlope"), 1.0)
+        values += _number(ds.get("RescaleIntercept"), 0.0)
+
+        center = _number(ds.get("WindowCenter"))
+        width = _number(ds.get("WindowWidth"))
+        if center is None or not width or width <= 1:
+            low, high = float(values.min()), float(values.max())
+            center, width = (low + high) / 2, max(high - low, 2.0)
+
+        # Linear VOI LUT function of PS3.3 C.11.2.1.2
+        values = ((values - (center - 0.5)) / (width - 1) + 0.5) * 255.0
+        np.clip(values, 0, 255, out=values)
+        if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+            values = 255.0 - values
+        image = Image.fromarray(values.astype(np.uint8), mode="L")
+    else:
+        if pixels.dtype != np.uint8:
+            pixels = (pixels / max(float(pixels.max()), 1.0) * 255.0).astype(np.uint8)
+        image = Image.fromarray(pixels, mode="RGB")
+
+    image.thumbnail((max_size, max_size), Image.BILINEAR)
+
+    _, options = FORMATS[image_format]
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    image.save(temp_path, **options)
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+def _series_key(instance):
+    try:
+        return int(instance.get("series_number") or 0)
+    except ValueError:
+        return 0
+
+
+def _instance_key(instance):
+    try:
+        return int(instance.get("instance_number") or 0)
+    except ValueError:
+        return 0
+
+
+def select_instance(images, series_rule="first", slice_rule="middle"):
+    """
+    Pick the representative instance of a study.
+
+    Args:
+        images (list): Image documents of the study (series_number, instance_number, sop_instance_uid, path).
+        series_rule (str): "first" series by number, or the "largest" series.
+        slice_rule (str): "middle" or "first" instance of that series.
+
+    Returns:
+        dict: The selected image document, or None for an empty study.
+    """
+    series = {}
+    for image in images:
+        series.setdefault(_series_key(image), []).append(image)
+    if not series:
+        return None
+
+    if series_rule == "largest":
+        instances = max(series.values(), key=len)
+    else:
+        instances = series[min(series)]
+
+    instances.sort(key=_instance_key)
+    return instances[0] if slice_rule == "first" else instances[len(instances) // 2]
+
+
+class PreviewGenerator:
+    """
+    Produces preview images in a process pool, cached per SOP Instance UID.
+
+    Previews are written to `output_dir` as <SOPInstanceUID>.<ext>, so an
+    existing file is a cache hit. Concurrent requests for the same instance
+    share one render.
+    """
+
+    def __init__(self, db, output_dir, workers=2, max_size=512, image_format="jpeg",
+                 series_rule="first", slice_rule="middle"):
+        self.db = db
+        self.output_dir = output_dir
+        self.max_size = max_size
+        self.image_format = image_format
+        self.series_rule = series_rule
+        self.slice_rule = slice_rule
+        # Spawned workers do not inherit the threads and sockets of this process
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stats = {"rendered": 0, "cache_hits": 0, "failed": 0, "total_render_ms": 0.0}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def output_path(self, sop_instance_uid):
+        extension, _ = FORMATS[self.image_format]
+        return os.path.join(self.output_dir, f"{sop_instance_uid}.{extension}")
+
+    def find_instance(self, study_instance_uid=None, sop_instance_uid=None):
+        """Look up the image document to preview, by SOP Instance UID or by study."""
+        projection = {"_id": 0, "sop_instance_uid": 1, "path": 1, "series_number": 1, "instance_number": 1}
+        if sop_instance_uid:
+            return self.db["image"].find_one({"sop_instance_uid": sop_instance_uid}, projection)
+
+        study = self.db["study"].find_one({"study_instance_uid": study_instance_uid}, {"patient_id": 1, "study_id": 1})
+        if study is None:
+            return None
+        images = list(self.db["image"].find(
+            {"patient_id": study["patient_id"], "study_id": study["study_id"]}, projection
+        ))
+        return select_instance(images, self.series_rule, self.slice_rule)
+
+    def submit(self, instance):
+        """
+        Schedule the preview of an image document without waiting for it.
+
+        Returns:
+            tuple: (output path, Future or None when the preview is cached)
+        """
+        sop_instance_uid = instance["sop_instance_uid"]
+        output_path = self.output_path(sop_instance_uid)
+        with self.lock:
+            future = self.pending.get(sop_instance_uid)
+            if future is not None:
+                return output_path, future
+            if os.path.isfile(output_path):
+                self.stats["cache_hits"] += 1
+                return output_path, None
+
+            started = time.monotonic()
+            future = self.pool.submit(render_preview, instance["path"], output_path, self.max_size, self.image_format)
+            self.pending[sop_instance_uid] = future
+
+        def done(future):
+            with self.lock:
+                self.pending.pop(sop_instance_uid, None)
+                if future.exception() is not None:
+                    self.stats["failed"] += 1
+                    LOGGER.error(f"Unable to render preview of {sop_instance_uid}: {future.exception()}")
+                else:
+                    self.stats["rendered"] += 1
+                    self.stats["total_render_ms"] += (time.monotonic() - started) * 1000
+
+        future.add_done_callback(done)
+        return output_path, future
+
+    def generate(self, instance, timeout=30):
+        """Return the path of the preview of an image document, rendering it if needed."""
+        output_path, future = self.submit(instance)
+        if future is not None:
+            future.result(timeout=timeout)
+        return output_path
+
+    def metrics(self):
+        """Return render counters and the average render latency."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self.pending)
+        total = stats.pop("total_render_ms")
+        stats["avg_render_ms"] = round(total / stats["rendered"], 2) if stats["rendered"] else 0
+        return stats
@@ -0,0 +1,172 @@
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from pynetdicom.transport import AssociationServer
+
+# Logger initialization
+LOGGER = logging.getLogger("pynetdicom")
+
+# Polling interval of the supervisor and of draining workers, in seconds
+_POLL_INTERVAL = 0.5
+
+# Workers exiting sooner than this after start count as crash looping
+_MIN_UPTIME = 10
+
+# Upper bound of the delay before restarting a crash looping worker
+_MAX_RESTART_DELAY = 30
+
+
+class ReusePortAssociationServer(AssociationServer):
+    """
+    Association server binding with SO_REUSEPORT, so several processes accept on one port.
+
+    `socket_options` are (level, option, value) tuples set on the listening
+    socket before it listens, e.g. buffer sizes inherited by accepted sockets.
+    Without `reuse_port` the socket binds exclusively, so a second instance
+    started by mistake fails instead of silently sharing the port.
+    """
+
+    def __init__(self, *args, socket_options=(), reuse_port=True, **kwargs):
+        self.socket_options = socket_options
+        self.reuse_port = reuse_port
+        super().__init__(*args, **kwargs)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        for level, option, value in self.socket_options:
+            self.socket.setsockopt(level, option, value)
+        super().server_bind()
+
+
+def serve(ae, address, evt_handlers, drain_timeout=30, socket_options=(), reuse_port=True):
+    """
+    Run the SCP of one worker process until SIGTERM or SIGINT, then drain.
+
+    `reuse_port` lets the workers of a supervisor share the port; a single
+    process serves without it.
+
+    On shutdown the listening socket is closed, so the kernel hands new
+    associations to the other workers, and active associations get
+    `drain_timeout` seconds to finish before the worker returns.
+    """
+    server = ReusePortAssociationServer(ae, address, ae.ae_title, ae.supported_contexts, evt_handlers=evt_handlers,
+                                        socket_options=socket_options, reuse_port=reuse_port)
+    ae._servers.append(server)
+
+    # shutdown() waits for serve_forever(), so it must not run in the signal handler itself
+    def shutdown(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    LOGGER.info(f"[Init] - DICOM worker {os.getpid()} listening on port {address[1]}")
+    server.serve_forever()
+
+    deadline = time.monotonic() + drain_timeout
+    while ae.active_associations and time.monotonic() < deadline:
+        time.sleep(_POLL_INTERVAL)
+    if ae.active_associations:
+        LOGGER.warning(f"DICOM worker {os.getpid()} aborting {len(ae.active_associations)} association(s) after drain timeout")
+    ae.shutdown()
+
+
+class ScpSupervisor:
+    """
+    Forks `workers` DICOM SCP processes and keeps them running.
+
+    Each worker calls `target(worker_id)`, which is expected to block in
+    serve(). Use start() to fork the workers and supervise() to wait.
+    Workers that exit unexpectedly are restarted, with a growing delay
+    when they keep crashing right after start. SIGTERM or SIGINT stops the
+    supervisor: workers are asked to drain and are killed if they are
+    still running after `drain_timeout` plus a grace period. `on_exit(pid)`
+    is called for every worker that exited, to drop what it held.
+    """
+
+    def __init__(self, target, workers, drain_timeout=30, on_exit=None):
+        self.target = target
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.on_exit = on_exit
+        self.children = {}
+        self.stopping = False
+        self.kill_deadline = None
+
+    def start(self):
+        """Fork the workers; call before the supervising process starts other threads."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+    def supervise(self):
+        """Restart workers that exit until stopped; blocks until all workers are gone."""
+        while self.children:
+            for pid, (worker_id, started, delay) in list(self.children.items()):
+                try:
+                    waited, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    waited, status = pid, 0
+                if waited == 0:
+                    continue
+
+                del self.children[pid]
+                if self.on_exit:
+                    self.on_exit(pid)
+                if self.stopping:
+                    continue
+
+                uptime = time.monotonic() - started
+                delay = min(_MAX_RESTART_DELAY, delay * 2) if uptime < _MIN_UPTIME else 1
+                LOGGER.error(f"DICOM worker {worker_id} (pid {pid}) exited with status {status}, "
+                             f"restarting in {delay}s")
+                time.sleep(delay)
+                if not self.stopping:
+                    self._spawn(worker_id, delay)
+
+            if self.kill_deadline and time.monotonic() > self.kill_deadline:
+                for pid in list(self.children):
+                    LOGGER.warning(f"Killing DICOM worker pid {pid} after drain timeout")
+                    os.kill(pid, signal.SIGKILL)
+                self.kill_deadline = None
+
+            time.sleep(_POLL_INTERVAL)
+
+        LOGGER.info("All DICOM workers stopped")
+
+    def stop(self, signum=None, frame=None):
+        """Ask every worker to drain and exit."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.kill_deadline = time.monotonic() + self.drain_timeout + 5
+        LOGGER.info(f"Stopping {len(self.children)} DICOM worker(s)")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, worker_id, delay=0.5):
+        pid = os.fork()
+        if pid == 0:
+            # The child must never return into the caller's code or run its atexit handlers
+            code = 0
+            try:
+                self.target(worker_id)
+            except Exception:
+                LOGGER.exception(f"DICOM worker {worker_id} failed")
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        self.children[pid] = (worker_id, time.monotonic(), delay)
+        LOGGER.info(f"Started DICOM worker {worker_id} (pid {pid})")
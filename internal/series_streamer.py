@@ -0,0 +1,71 @@
+import logging
+import os
+import threading
+import time
+
+# Logger initialization
+LOGGER = logging.getLogger("pynetdicom")
+
+
+class SeriesStreamer:
+    """
+    Uploads studies series by series while their association is still open.
+
+    handle_store reports every stored instance with touch(). A series that
+    has not received an instance for `quiet_period` seconds is considered
+    complete, and `upload(assoc_id, study_iuid, accession_number)` is called
+    for its study on the streamer thread. The upload sends whatever has not
+    been sent yet, so the final pass at association release only has the
+    last series left.
+
+    The thread starts with the first stored instance of the process, so a
+    streamer created before the SCP workers fork runs in each worker.
+    """
+
+    def __init__(self, upload, quiet_period=30, check_interval=1.0):
+        self.upload = upload
+        self.quiet_period = quiet_period
+        self.check_interval = check_interval
+        self.series = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def _ensure_thread(self):
+        # Threads do not survive fork(): start one per process
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.series = {}
+            threading.Thread(target=self._run, name="series-streamer", daemon=True).start()
+
+    def touch(self, assoc_id, study_iuid, series_iuid, accession_number):
+        """Record that an instance of a series has just been stored."""
+        with self.lock:
+            self._ensure_thread()
+            self.series[(assoc_id, study_iuid, series_iuid)] = (time.monotonic(), accession_number)
+
+    def finish(self, assoc_id):
+        """Stop tracking the series of a released association; the release handler uploads the rest."""
+        with self.lock:
+            for key in [key for key in self.series if key[0] == assoc_id]:
+                del self.series[key]
+
+    def _due(self):
+        """Pop the studies having a series quiet for `quiet_period`."""
+        now = time.monotonic()
+        studies = {}
+        with self.lock:
+            for key, (last_seen, accession_number) in list(self.series.items()):
+                if now - last_seen >= self.quiet_period:
+                    del self.series[key]
+                    studies[key[:2]] = accession_number
+        return studies
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            for (assoc_id, study_iuid), accession_number in self._due().items():
+                LOGGER.info(f"Series of study {study_iuid} complete, uploading while association is open")
+                try:
+                    self.upload(assoc_id, study_iuid, accession_number)
+                except Exception as e:
+                    LOGGER.error(f"Streaming upload of study {study_iuid} failed: {e}", exc_info=True)
@@ -0,0 +1,115 @@
+import datetime
+import logging
+import re
+import threading
+
+from interface import satusehat
+from utils import config
+from utils.dbquery import DBQuery
+
+# Initialize logger
+LOGGER = logging.getLogger('pynetdicom')
+
+# Name of the watermark row in the sync_state table
+_STATE_NAME = "service_request_last_updated"
+
+# Date-time, optional fraction and optional offset of a FHIR instant
+_INSTANT = re.compile(r"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:\d{2})?$")
+
+
+def parse_instant(value):
+    """
+    Parse a FHIR instant (e.g. 2024-05-01T10:00:00.123+07:00 or ...Z) to an aware datetime.
+
+    Returns None when the value cannot be parsed, so values written with
+    different offsets compare by the moment they denote, not as strings.
+    """
+    if not value:
+        return None
+    match = _INSTANT.match(value)
+    if not match:
+        return None
+    base, fraction, offset = match.groups()
+    fraction = (fraction or "")[1:7].ljust(6, "0")
+    offset = "+00:00" if offset in (None, "Z") else offset
+    try:
+        return datetime.datetime.fromisoformat(f"{base}.{fraction}{offset}")
+    except ValueError:
+        return None
+
+
+class ServiceRequestSynchronizer(threading.Thread):
+    """
+    Background thread that mirrors this organization's ServiceRequests from
+    SATUSEHAT into the local service_request table.
+
+    Each cycle pages through the resources updated since the last stored
+    watermark, so accession numbers can be resolved without a network call
+    when the study is released.
+    """
+
+    def __init__(self, interval, page_size=100, lookback_days=7):
+        super().__init__(name="servicerequest-sync", daemon=True)
+        self.interval = interval
+        self.page_size = page_size
+        self.lookback_days = lookback_days
+        self.dbq = DBQuery()
+        self.stopped = threading.Event()
+
+    def run(self):
+        LOGGER.info(f"[Init] - ServiceRequest synchronizer running every {self.interval}s")
+        while not self.stopped.is_set():
+            try:
+                self.sync_once()
+            except Exception as e:
+                LOGGER.error(f"ServiceRequest sync failed: {e}")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def sync_once(self):
+        """Pull all ServiceRequests updated since the watermark, page by page."""
+        token = config.token
+        if not token:
+            raise Exception("Unable to obtain OAuth2 token")
+
+        since = self._watermark()
+        resources, next_url = satusehat.search_service_requests(token, since=since, count=self.page_size)
+        total = 0
+
+        while True:
+            rows = [satusehat.service_request_row(resource) for resource in resources]
+            rows = [row for row in rows if row[0] and row[1]]
+            if rows:
+                self.dbq.insert_many([(self.dbq.UPSERT_SERVICE_REQUEST, rows)])
+                newest = max((row[3] for row in rows if parse_instant(row[3])), key=parse_instant, default=None)
+                if newest and (parse_instant(since) is None or parse_instant(newest) > parse_instant(since)):
+                    since = newest
+                    self.dbq.update(self.dbq.SET_SYNC_STATE, [_STATE_NAME, since])
+                total += len(rows)
+
+            if not next_url or self.stopped.is_set():
+                break
+            resources, next_url = satusehat.search_service_requests(token, page_url=next_url)
+
+        if total:
+            LOGGER.info(f"ServiceRequest sync stored {total} resources")
+
+    def _watermark(self):
+        """Return the lastUpdated watermark, defaulting to the lookback window."""
+        rows = self.dbq.query(self.dbq.GET_SYNC_STATE, [_STATE_NAME])
+        if rows:
+            return rows[0]["value"]
+        start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=self.lookback_days)
+        return start.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def start(interval, page_size=100, lookback_days=7):
+    """Start the synchronizer thread; an interval of 0 disables it."""
+    if interval <= 0:
+        LOGGER.info("[Init] - ServiceRequest synchronizer disabled")
+        return None
+    synchronizer = ServiceRequestSynchronizer(interval, page_size, lookback_days)
+    synchronizer.start()
+    return synchronizer
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from internal.dicom_listener import handle_file_dcm, get_metadata_writer
+from utils.dbquery import DBQuery
+
+# Logger initialization
+LOGGER = logging.getLogger("dicom_router_inotify")
+
+# Number of indexed files recorded in file_index per transaction
+_INDEX_FLUSH_SIZE = 200
+
+# Files queued per worker thread; the walk waits while the queue is full
+_QUEUED_PER_WORKER = 4
+
+# Number of finished jobs kept for status queries
+_JOB_HISTORY = 20
+
+# Seconds between progress writes; a running job not written for
+# _STALE_AFTER seconds belongs to a process that stopped
+_PERSIST_INTERVAL = 2
+_STALE_AFTER = 60
+
+
+class SyncJob(threading.Thread):
+    """
+    Background job that indexes the DICOM files below a folder.
+
+    The tree is walked recursively and files whose (size, mtime, inode) are
+    unchanged since the last sync are skipped using the persisted file_index
+    table. The remaining files are indexed on a pool of worker threads,
+    with at most _QUEUED_PER_WORKER files per worker queued at a time.
+
+    Progress is written to the sync_job table every few seconds, so any
+    process sharing instance.db (e.g. the gunicorn workers) can report it.
+    """
+
+    def __init__(self, job_id, folder_path, workers):
+        super().__init__(name="sync-job", daemon=True)
+        self.id = job_id
+        self.folder_path = folder_path
+        self.workers = workers
+        self.dbq = DBQuery()
+        self.counters_lock = threading.Lock()
+        self.pending_rows = []
+        self.queue_slots = threading.BoundedSemaphore(workers * _QUEUED_PER_WORKER)
+
+        self.status = "queued"
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.discovered = 0
+        self.skipped = 0
+        self.indexed = 0
+        self.failed = 0
+        self.persisted_at = 0
+
+    def _persist(self, force=False):
+        """Write the progress of the job, at most every _PERSIST_INTERVAL seconds unless forced."""
+        now = time.time()
+        if not force and now - self.persisted_at < _PERSIST_INTERVAL:
+            return
+        self.persisted_at = now
+        self.dbq.update(self.dbq.UPDATE_SYNC_JOB, (
+            self.status, self.error,
+            self.started_at.isoformat() if self.started_at else None,
+            self.finished_at.isoformat() if self.finished_at else None,
+            self.discovered, self.skipped, self.indexed, self.failed, now, self.id
+        ))
+
+    def run(self):
+        self.status = "running"
+        self.started_at = datetime.now()
+        self._persist(force=True)
+        LOGGER.info(f"Sync job {self.id} started for {self.folder_path}")
+
+        try:
+            known = {row["path"]: (row["size"], row["mtime"], row["inode"])
+                     for row in self.dbq.query(self.dbq.GET_FILE_INDEX) or []}
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sync-worker") as executor:
+                for root, _, filenames in os.walk(self.folder_path):
+                    # Keeps the heartbeat fresh through directories without DICOM files
+                    self._persist()
+                    for filename in filenames:
+                        if not filename.lower().endswith('.dcm'):
+                            continue
+                        pathname = os.path.join(root, filename)
+                        try:
+                            st = os.stat(pathname)
+                        except OSError:
+                            continue
+
+                        self.discovered += 1
+                        self._persist()
+                        signature = (st.st_size, st.st_mtime, st.st_ino)
+                        if known.get(pathname) == signature:
+                            self.skipped += 1
+                            continue
+                        self.queue_slots.acquire()
+                        executor.submit(self._index_file, pathname, signature)
+
+            # Make the queued metadata durable before recording the files as indexed
+            get_metadata_writer().flush()
+            self._flush_index(force=True)
+            self.status = "completed"
+        except Exception as e:
+            LOGGER.error(f"Sync job {self.id} failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished_at = datetime.now()
+            self._persist(force=True)
+            LOGGER.info(f"Sync job {self.id} {self.status}: {self.discovered} discovered, {self.skipped} skipped, "
+                        f"{self.indexed} indexed, {self.failed} failed")
+
+    def _index_file(self, pathname, signature):
+        """Index one file and remember its signature on success."""
+        try:
+            success = handle_file_dcm(pathname)
+        except Exception as e:
+            LOGGER.error(f"Error indexing {pathname}: {e}")
+            success = False
+        finally:
+            self.queue_slots.release()
+
+        with self.counters_lock:
+            if success:
+                self.indexed += 1
+                self.pending_rows.append((pathname, *signature, datetime.now().isoformat()))
+            else:
+                self.failed += 1
+        self._flush_index()
+        self._persist()
+
+    def _flush_index(self, force=False):
+        """Persist indexed file signatures in batches."""
+        with self.counters_lock:
+            if not self.pending_rows or (not force and len(self.pending_rows) < _INDEX_FLUSH_SIZE):
+                return
+            rows, self.pending_rows = self.pending_rows, []
+        self.dbq.insert_many([(self.dbq.UPSERT_FILE_INDEX, rows)])
+
+
+def _as_dict(row):
+    """Return a sync_job row as a JSON serializable dict."""
+    job = {key: row[key] for key in ("folder", "status", "error", "started_at", "finished_at",
+                                     "discovered", "skipped", "indexed", "failed")}
+    job["job_id"] = row["id"]
+    job["remaining"] = job["discovered"] - job["skipped"] - job["indexed"] - job["failed"]
+    return job
+
+
+def start_sync(folder_path, workers):
+    """
+    Start a sync job unless one is already running in any process; returns the active job.
+
+    The job row is inserted only when no queued or running job has written
+    progress recently, in one statement, so concurrent requests on several
+    processes start a single job.
+    """
+    dbq = DBQuery()
+    now = time.time()
+    dbq.update(dbq.ABANDON_SYNC_JOBS, (datetime.now().isoformat(), now - _STALE_AFTER))
+
+    job_id = uuid.uuid4().hex
+    if dbq.update(dbq.INSERT_SYNC_JOB, (job_id, folder_path, os.getpid(), now, now, now - _STALE_AFTER)):
+        dbq.delete(dbq.TRIM_SYNC_JOBS, (_JOB_HISTORY,))
+        SyncJob(job_id, folder_path, workers).start()
+    return get_job()
+
+
+def get_job(job_id=None):
+    """Return the job with the given id, or the most recent job, as a dict."""
+    dbq = DBQuery()
+    if job_id is None:
+        rows = dbq.query(dbq.GET_LATEST_SYNC_JOB)
+    else:
+        rows = dbq.query(dbq.GET_SYNC_JOB, (job_id,))
+    return _as_dict(rows[0]) if rows else None
@@ -1,62 +1,138 @@
 import requests
 import logging
+import threading
+import time
+from datetime import datetime, timezone
 from utils import halosis_config, config
-from utils.mongodb import connect_mongodb, client_mongodb
+from utils.mongodb import shared_db
 
 # Initialize configurations and logger
 config.init()
 LOGGER = logging.getLogger("flask_server")
 
-# MongoDB client and database connection
-_client = client_mongodb()
-_db = _client[config.pacs_db_name]
+class TokenCache:
+    """
+    Keeps the provider token in memory until shortly before it expires.
 
-def send(patientPhoneNumber, previewImage, patientName, examination, hospital, date, link):
-    """Send a WhatsApp message with patient examination details."""
-    bearer_token = get_valid_token()
+    The expiry comes from `token_expired_at` as returned by the provider, so
+    no request is spent checking the token. Refreshes are single-flight:
+    one thread refreshes while the others keep using the current token, or
+    wait for the new one if it has already expired. A refreshed token is
+    stored in the `whatsapp_token` collection and adopted from there by the
+    other workers instead of each logging in again.
+    """
 
-    if check_token_expiry(bearer_token):
-        deactivate_all_tokens()
-        bearer_token = get_valid_token()
+    def __init__(self, refresh_margin=300, default_ttl=3600):
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
 
-    return send_to_whatsapp(
-        bearer_token, patientPhoneNumber, previewImage,
-        patientName, examination, hospital, date, link
-    )
+    def get(self):
+        """Return a token, refreshing it when it is about to expire."""
+        now = time.time()
+        if self.token and now < self.expires_at - self.refresh_margin:
+            return self.token
 
-def deactivate_all_tokens():
-    """Set all active tokens to inactive in the database."""
-    collection = _db['whatsapp_token']
-    collection.update_many({'is_active': True}, {'$set': {'is_active': False}})
+        # Still usable: only one thread refreshes, the others go on with it
+        if self.token and now < self.expires_at:
+            if not self.lock.acquire(blocking=False):
+                return self.token
+            try:
+                return self._refresh()
+            finally:
+                self.lock.release()
 
-def get_valid_token():
-    """Retrieve a valid bearer token, or generate a new one if necessary."""
-    collection = _db['whatsapp_token']
-    active_token = collection.find_one({"is_active": True})
+        return self.refresh()
 
-    if active_token:
-        return active_token["token"]
+    def refresh(self, rejected=None):
+        """
+        Replace the token, e.g. after the provider answered 401 for `rejected`.
 
-    new_token_data = halosis_config.get_token()
-    new_token = {
-        "token": new_token_data["token"],
-        "expire_at": new_token_data["expire_at"],
-        "is_active": True
-    }
-    collection.insert_one(new_token)
-    return new_token_data["token"]
+        Returns:
+            str: The new bearer token.
+        """
+        with self.lock:
+            # Another thread may have replaced the token while we waited
+            if self.token and self.token != rejected and time.time() < self.expires_at - self.refresh_margin:
+                return self.token
+            return self._refresh(rejected)
 
-def check_token_expiry(bearer_token):
-    """Check if the current token has expired."""
-    url = config.whatsapp_provider
-    headers = {
-        "Authorization": f"Bearer {bearer_token}",
-        "Content-Type": "application/json",
-        'User-Agent': 'PostmanRuntime/7.26.8',
-    }
+    def _refresh(self, rejected=None):
+        collection = shared_db()['whatsapp_token']
+        rejected = rejected or (self.token if time.time() >= self.expires_at else None)
+
+        # Adopt a token another worker already stored
+        active_token = collection.find_one({"is_active": True}, sort=[("_id", -1)])
+        if active_token and active_token["token"] not in (rejected, self.token):
+            expires_at = self._expiry(active_token.get("expire_at"))
+            if time.time() < expires_at - self.refresh_margin:
+                self.token, self.expires_at = active_token["token"], expires_at
+                return self.token
+
+        new_token_data = halosis_config.get_token()
+        if not new_token_data or not new_token_data.get("token"):
+            raise RuntimeError("Unable to obtain a WhatsApp provider token")
 
-    response = requests.get(f"{url}/v1/balance", headers=headers)
-    return response.status_code != 200
+        collection.update_many({'is_active': True}, {'$set': {'is_active': False}})
+        collection.insert_one({
+            "token": new_token_data["token"],
+            "expire_at": new_token_data["expire_at"],
+            "is_active": True
+        })
+        self.token = new_token_data["token"]
+        self.expires_at = self._expiry(new_token_data["expire_at"])
+        LOGGER.info("WhatsApp provider token refreshed")
+        return self.token
+
+    def _expiry(self, value):
+        """Convert `token_expired_at` (epoch seconds/milliseconds or ISO 8601) to epoch seconds."""
+        try:
+            if isinstance(value, (int, float)) or (isinstance(value, str) and value.isdigit()):
+                value = float(value)
+                return value / 1000 if value > 1e11 else value
+            if isinstance(value, str):
+                expires_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                if expires_at.tzinfo is None:
+                    expires_at = expires_at.replace(tzinfo=timezone.utc)
+                return expires_at.timestamp()
+            if isinstance(value, datetime):
+                return value.replace(tzinfo=value.tzinfo or timezone.utc).timestamp()
+        except ValueError:
+            pass
+        LOGGER.warning(f"Unknown token expiry {value!r}, assuming {self.default_ttl} seconds")
+        return time.time() + self.default_ttl
+
+
+# Provider token shared by all senders of this process
+_token_cache = TokenCache(config.whatsapp_token_refresh_margin)
+
+def send(patientPhoneNumber, previewImage, patientName, examination, hospital, date, link):
+    """
+    Send a WhatsApp message with patient examination details.
+
+    The token is refreshed once and the message resent when the provider
+    rejects it with 401.
+
+    Returns:
+        requests.Response: The response of the provider to the last attempt.
+    """
+    bearer_token = _token_cache.get()
+    response = send_to_whatsapp(
+        bearer_token, patientPhoneNumber, previewImage,
+        patientName, examination, hospital, date, link
+    )
+
+    if response.status_code == 401:
+        LOGGER.warning("WhatsApp provider rejected the token, refreshing it")
+        bearer_token = _token_cache.refresh(rejected=bearer_token)
+        response = send_to_whatsapp(
+            bearer_token, patientPhoneNumber, previewImage,
+            patientName, examination, hospital, date, link
+        )
+
+    return response
 
 def send_to_whatsapp(bearer_token, patientPhoneNumber, previewImage, patientName, examination, hospital, date, link):
     """Send a WhatsApp message using the provided token and message details."""
@@ -99,5 +175,7 @@ def send_to_whatsapp(bearer_token, patientPhoneNumber, previewImage, patientName
 
     if response.status_code == 200:
         LOGGER.info("WhatsApp message has been sent!")
-    else:
-        LOGGER.error(f"Error sending WhatsApp message: {response.json()}")
+    elif response.status_code != 401:
+        LOGGER.error(f"Error sending WhatsApp message: {response.text}")
+
+    return response
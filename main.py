@@ -1,6 +1,8 @@
 import os
+import sys
+import atexit
 import logging
-import shutil
+import subprocess
 import threading
 from dotenv import load_dotenv
 load_dotenv()
@@ -27,14 +29,19 @@ def main_loop():
 				StudyRootQueryRetrieveInformationModelMove,
 				StudyRootQueryRetrieveInformationModelGet,
 				ModalityWorklistInformationFind,
+				ModalityPerformedProcedureStep,
 		)
 
 		# Now you can import your internal modules
-		from internal import dicom_listener, dicom_handler, http_server, whatsapp_handler
-		from internal.flask_server import app
+		from internal import dicom_listener, dicom_handler, http_server, whatsapp_handler, servicerequest_sync, ingest, scp_supervisor, admission
+		from internal.series_streamer import SeriesStreamer
+		from internal.mpps import MppsTracker
+		from internal.dimse_profile import DimseProfile
+		from internal.flask_server import app, start_background_workers
 		from utils.dicom2fhir import process_dicom_to_fhir
 		from utils.dbquery import DBQuery
-		from utils import config
+		from utils import config, mongo_indexes, metrics
+		from utils.mongodb import shared_db
 
 		# ====================================================
 		# Initialization
@@ -49,34 +56,73 @@ def main_loop():
 		LOGGER = initialize_logger()
 		LOGGER.info("[Init] - Starting services")
 
-		# Initialize configuration
+		# Initialize configuration; remote values are prefetched once the worker processes exist
 		config.init()
 
 		# Setup database
 		dbq = DBQuery()
+		# Study upload claims left by a previous run; its pids may be reused
+		dbq.update(dbq.CLEAR_STUDY_UPLOAD_CLAIMS, [])
 
 		# ====================================================
 		# Event Handlers Setup
 		# ====================================================
 		LOGGER.info("[Init] - Setting up DICOM handlers")
 
+		# Per-calling-AE association and C-STORE limits
+		admission_controller = admission.AdmissionController(
+				config.dicom_ae_limits, config.dicom_default_ae_associations, config.dicom_default_ae_stores,
+				config.dicom_max_associations
+		)
+		metrics.register("admission", admission_controller.metrics)
+
+		# Network profile (PDU size, timeouts, socket buffers, transfer syntaxes) with per-AE overrides
+		profile = DimseProfile.load(config.dimse_profile_file)
+
+		# Upload each completed series while its association is still open
+		streamer = None
+		if config.stream_series:
+				def upload_series(assoc_id, study_iuid, accession_number):
+						dicom_handler.process_study(assoc_id, study_iuid, accession_number, config.dcm_dir,
+								config.organization_id, config.mroc_client_url, config.encrypt)
+				streamer = SeriesStreamer(upload_series, config.stream_quiet_period)
+
+		# Process a study as soon as its performed procedure step is COMPLETED
+		mpps_tracker = None
+		if config.mpps_enabled:
+				def process_procedure(study_iuid, accession_number):
+						dicom_handler.process_study(None, study_iuid, accession_number, config.dcm_dir,
+								config.organization_id, config.mroc_client_url, config.encrypt, final=True)
+				mpps_tracker = MppsTracker(process_procedure, config.mpps_wait_timeout)
+
 		handlers = [
-				(evt.EVT_C_STORE, dicom_handler.handle_store, [config.dcm_dir, LOGGER]),
-				(evt.EVT_RELEASED, dicom_handler.handle_assoc_released, [config.dcm_dir, config.organization_id, config.mroc_client_url, config.encrypt, LOGGER]),
+				(evt.EVT_REQUESTED, admission_controller.handle_requested),
+				(evt.EVT_REQUESTED, profile.handle_requested),
+				(evt.EVT_C_STORE, admission_controller.limit_store(dicom_handler.handle_store), [config.dcm_dir, LOGGER, streamer, mpps_tracker]),
+				(evt.EVT_CONN_CLOSE, admission_controller.handle_closed),
+				(evt.EVT_RELEASED, dicom_handler.handle_assoc_released, [config.dcm_dir, config.organization_id, config.mroc_client_url, config.encrypt, LOGGER, streamer]),
 				(evt.EVT_C_ECHO, dicom_handler.handle_echo, [LOGGER]),
 				(evt.EVT_C_FIND, dicom_handler.handle_find, [LOGGER]),
+				(evt.EVT_C_GET, dicom_handler.handle_get, [config.dcm_dir, config.inotify_dir, LOGGER]),
+				(evt.EVT_C_MOVE, dicom_handler.handle_move, [config.dcm_dir, config.inotify_dir, config.move_destinations, LOGGER]),
 		]
+		if mpps_tracker:
+				handlers.append((evt.EVT_N_CREATE, mpps_tracker.handle_n_create))
+				handlers.append((evt.EVT_N_SET, mpps_tracker.handle_n_set))
 
 		# ====================================================
 		# Application Entity (AE) Setup
 		# ====================================================
 		LOGGER.info("[Init] - Initializing Application Entity (AE)")
-		ae = AE(ae_title=config.self_ae_title)
+		ae = admission.AdmissionAE(ae_title=config.self_ae_title)
+		ae.maximum_associations = config.dicom_max_associations
+		profile.apply(ae)
 
-		# Add supported presentation contexts
-		transfer_syntaxes = ALL_TRANSFER_SYNTAXES
-		for context in StoragePresentationContexts:
-				ae.add_supported_context(context.abstract_syntax, transfer_syntaxes)
+		# Add supported presentation contexts for all storage SOP Classes.
+		# Both roles are accepted so C-GET requestors can act as Storage SCP.
+		transfer_syntaxes = profile.default["transfer_syntaxes"]
+		for context in AllStoragePresentationContexts:
+				ae.add_supported_context(context.abstract_syntax, transfer_syntaxes, scu_role=True, scp_role=True)
 
 		# Support verification SCP (echo) and query/retrieve SCPs
 		ae.add_supported_context(Verification)
@@ -87,9 +133,8 @@ def main_loop():
 		ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
 		ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
 		ae.add_supported_context(ModalityWorklistInformationFind)
-
-		# Support all storage SOP Classes
-		ae.supported_contexts = AllStoragePresentationContexts
+		if config.mpps_enabled:
+				ae.add_supported_context(ModalityPerformedProcedureStep)
 
 		# Require Called AE Title to match
 		ae.require_called_aet = config.self_ae_title
@@ -97,36 +142,75 @@ def main_loop():
 		# ====================================================
 		# Folder Cleanup and Initialization
 		# ====================================================
-		LOGGER.info("[Init] - Clearing and preparing incoming folder")
+		LOGGER.info("[Init] - Preparing incoming folder")
 
+		# The staging store persists across restarts; only writes interrupted by a stop are removed
 		incoming_dir = os.path.join(os.getcwd(), config.dcm_dir)
-		try:
-				shutil.rmtree(incoming_dir)
-		except Exception as err:
-				LOGGER.error(f"Error while clearing folder: {err}")
-
 		os.makedirs(incoming_dir, exist_ok=True)
+		for root, _, filenames in os.walk(incoming_dir):
+				for filename in filenames:
+						if filename.endswith(".tmp"):
+								try:
+										os.remove(os.path.join(root, filename))
+								except OSError as err:
+										LOGGER.error(f"Error while removing {filename}: {err}")
 
 		# ====================================================
 		# Inotify Event Handler
 		# ====================================================
 		class EventHandler(pyinotify.ProcessEvent):
-				"""Handles the creation of files in the watched directory."""
-				def process_IN_CREATE(self, event):
-						# Push DICOM file on creation
-						dicom_listener.dicom_push(event.pathname)
+				"""Dispatches completed files in the watched directory to the ingest workers."""
+				def my_init(self, dispatcher=None):
+						self.dispatcher = dispatcher
+
+				def process_IN_CLOSE_WRITE(self, event):
+						# The writer has closed the file, so it is complete
+						self.dispatcher.submit(event.pathname)
+
+				def process_IN_MOVED_TO(self, event):
+						# Files (or whole folders) moved into the watched tree
+						if event.dir:
+								self.dispatcher.submit_tree(event.pathname)
+						else:
+								self.dispatcher.submit(event.pathname)
+
+		def start_inotify():
+				"""Watches INOTIFY_DIR recursively and feeds new files to a worker pool."""
+				if not config.inotify_dir or not os.path.isdir(config.inotify_dir):
+						LOGGER.warning(f"[Init] - INOTIFY_DIR is not a directory, file watching disabled: {config.inotify_dir}")
+						return None
+
+				dispatcher = ingest.IngestDispatcher(dicom_listener.dicom_push, config.ingest_workers, config.ingest_queue_size)
+				wm = pyinotify.WatchManager()
+				notifier = pyinotify.ThreadedNotifier(wm, EventHandler(dispatcher=dispatcher))
+				notifier.daemon = True
+				notifier.start()
+
+				mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+				wm.add_watch(config.inotify_dir, mask, rec=True, auto_add=True)
+				LOGGER.info(f"[Init] - Watching {config.inotify_dir} with {config.ingest_workers} ingest workers")
+				return notifier
 
 		# ====================================================
-		# Flask Server Thread
+		# Flask Server
 		# ====================================================
 		def flask_server():
-				"""Starts the Flask server."""
+				"""Starts the Flask development server."""
 				LOGGER.info(f'[Init] - Starting Flask service on port {config.flask_port}')
 				if __name__ == '__main__':
 						app.run(host="0.0.0.0", port=config.flask_port)
 
-		flask_thread = threading.Thread(target=flask_server)
-		flask_thread.start()
+		def start_flask_production():
+				"""Serves Flask from gunicorn worker processes, see gunicorn.conf.py."""
+				app_dir = os.path.dirname(os.path.abspath(__file__))
+				LOGGER.info(f'[Init] - Starting Flask service on port {config.flask_port} with gunicorn')
+				process = subprocess.Popen(
+						[sys.executable, '-m', 'gunicorn', '-c', os.path.join(app_dir, 'gunicorn.conf.py'), 'wsgi:app'],
+						cwd=app_dir
+				)
+				# SIGTERM lets the workers finish their requests within graceful_timeout
+				atexit.register(process.terminate)
+				return process
 
 		# ====================================================
 		# DICOM Server Initialization
@@ -135,12 +219,49 @@ def main_loop():
 
 		if pid > 0:
 				# Parent process: start DICOM interface
-				LOGGER.info(f"[Init] - Spawning DICOM interface on port {config.dicom_port} with AE title: {config.self_ae_title}.")
-				ae.start_server(("0.0.0.0", config.dicom_port), evt_handlers=handlers)
+				if config.flask_mode == 'production':
+						start_flask_production()
+
+				supervisor = None
+				if config.dicom_workers > 1:
+						# Fork the SCP workers before this process starts its own threads
+						LOGGER.info(f"[Init] - Spawning {config.dicom_workers} DICOM workers on port {config.dicom_port} with AE title: {config.self_ae_title}.")
+
+						def serve_worker(worker_id):
+								metrics.publish(config.metrics_dir, "dicom")
+								scp_supervisor.serve(
+										ae, ("0.0.0.0", config.dicom_port), handlers, config.dicom_drain_timeout, profile.socket_options()
+								)
+
+						supervisor = scp_supervisor.ScpSupervisor(
+								serve_worker, config.dicom_workers, config.dicom_drain_timeout, admission_controller.release_process
+						)
+						supervisor.start()
+
+				# Threads and the MongoDB client of this process start once every worker is forked
+				config.prefetch()
+				mongo_indexes.ensure_indexes_in_background(shared_db())
+				if config.flask_mode != 'production':
+						start_background_workers()
+						flask_thread = threading.Thread(target=flask_server)
+						flask_thread.start()
+
+				servicerequest_sync.start(config.sr_sync_interval, config.sr_sync_page_size, config.sr_sync_lookback_days)
+				start_inotify()
+
+				if supervisor:
+						supervisor.supervise()
+				else:
+						LOGGER.info(f"[Init] - Spawning DICOM interface on port {config.dicom_port} with AE title: {config.self_ae_title}.")
+						metrics.publish(config.metrics_dir, "dicom")
+						scp_supervisor.serve(
+								ae, ("0.0.0.0", config.dicom_port), handlers, config.dicom_drain_timeout, profile.socket_options(),
+								reuse_port=False
+						)
 		else:
 				# Child process: start HTTP server
 				LOGGER.info(f'[Init] - Starting HTTP service on port {config.http_port}...')
-				http_server.start_server(config.http_port)
+				http_server.start_server(config.http_port, config.http_workers, config.http_request_timeout, config.http_idle_timeout)
 
 
 # Load environment variables from a .env file
@@ -1,15 +1,47 @@
+import logging
 import os
-from utils import oauth2
-from interface import satusehat
+import threading
+import time
+from collections import namedtuple
 
 from dotenv import load_dotenv
 load_dotenv()
 
+LOGGER = logging.getLogger("pynetdicom")
+
+# Loaded once by init(); the same values are also module attributes
+settings = None
+_init_lock = threading.Lock()
+
+# Cached remote values: name -> (value, monotonic expiry or None)
+_remote = {}
+_remote_locks = {}
+
+
 def init():
-    global url, organization_id, dicom_pathsuffix, fhir_pathsuffix, dicom_port, dcm_dir, http_port, self_ae_title, mroc_client_url, encrypt
-    global client_key, secret_key, token, dcm_config
-    global flask_port, inotify_dir, mongodb_url, whatsapp_provider, pacs_db_name
+    """
+    Load the configuration from the environment, once per process.
+
+    Later calls return the same settings without doing any work. The values
+    are published as module attributes (config.dcm_dir) and as the immutable
+    `settings` namedtuple. No network call is made here: the SATUSEHAT token
+    and DICOM configuration are fetched on first access, see remote().
 
+    Returns:
+        Settings: The loaded configuration.
+    """
+    global settings
+    if settings is None:
+        with _init_lock:
+            if settings is None:
+                values = _load()
+                globals().update(values)
+                settings = namedtuple('Settings', values)(**values)
+    return settings
+
+
+def _load():
+    """Read every setting from the environment; each local variable is a setting."""
     # SATUSEHAT Configuration (loaded from environment variables)
     url = os.getenv('URL')
     organization_id = os.getenv('ORGANIZATION_ID')
@@ -19,26 +51,188 @@ def init():
 
     # Ports and Directories
     dicom_port = int(os.getenv('DICOM_PORT', 11112))  # Default to 11112 if not set
+    dicom_workers = int(os.getenv('DICOM_WORKERS', 1))  # SCP processes sharing DICOM_PORT via SO_REUSEPORT
+    dicom_drain_timeout = int(os.getenv('DICOM_DRAIN_TIMEOUT', 30))  # Seconds active associations get on shutdown
+    dicom_max_associations = int(os.getenv('DICOM_MAX_ASSOCIATIONS', 10))  # Global ceiling across all SCP processes
+    dicom_ae_limits = parse_ae_limits(os.getenv('DICOM_AE_LIMITS', ''))  # e.g. "CT01=4:8,CR_ED=2:4"
+    dicom_default_ae_associations = int(os.getenv('DICOM_DEFAULT_AE_ASSOCIATIONS', 0))  # 0 is unlimited
+    dicom_default_ae_stores = int(os.getenv('DICOM_DEFAULT_AE_STORES', 0))  # In-flight C-STOREs, 0 is unlimited
+    dimse_profile_file = os.getenv('DIMSE_PROFILE_FILE')  # JSON network profile, see internal/dimse_profile.py
+    stream_series = os.getenv('STREAM_SERIES', 'false').lower() == 'true'  # Upload series while the association is open
+    stream_quiet_period = int(os.getenv('STREAM_QUIET_PERIOD', 30))  # Seconds without instances before a series is complete
+    mpps_enabled = os.getenv('DICOM_MPPS', 'false').lower() == 'true'  # Accept MPPS N-CREATE/N-SET, process studies on COMPLETED
+    mpps_wait_timeout = int(os.getenv('MPPS_WAIT_TIMEOUT', 300))  # Seconds a COMPLETED step waits for its referenced instances
+    metrics_dir = os.getenv('METRICS_DIR', 'metrics')  # Where non-HTTP processes publish their metrics
     dcm_dir = os.getenv('DCM_DIR')
+    satusehat_task_workers = int(os.getenv('SATUSEHAT_TASK_WORKERS', 2))  # Concurrent /to-satusehat jobs
+    satusehat_job_lease = int(os.getenv('SATUSEHAT_JOB_LEASE', 60))  # Seconds before a job of a stopped process is taken over
+    resend_associations = int(os.getenv('RESEND_ASSOCIATIONS', 2))  # Concurrent associations per re-send task
+    resend_status_batch = int(os.getenv('RESEND_STATUS_BATCH', 500))  # Status updates per bulk_write
     http_port = int(os.getenv('HTTP_PORT', 8083))  # Default to 8083 if not set
+    http_workers = int(os.getenv('HTTP_WORKERS', 8))  # 0 serves one request at a time
+    http_request_timeout = int(os.getenv('HTTP_REQUEST_TIMEOUT', 15))  # Seconds allowed for reading a request
+    http_idle_timeout = int(os.getenv('HTTP_IDLE_TIMEOUT', 2))  # Idle keep-alive connections are closed after this
     flask_port = int(os.getenv('FLASK_PORT', 8082))  # Default to 8082 if not set
+    flask_mode = os.getenv('FLASK_MODE', 'development').lower()  # "production" serves Flask with gunicorn
     inotify_dir = os.getenv('INOTIFY_DIR')
+    file_resolve_dir = os.getenv('FILE_RESOLVE_DIR', '/var/www/lts-temp')  # Directory served by /file/resolve
+    file_resolve_max_age = int(os.getenv('FILE_RESOLVE_MAX_AGE', 0))  # Seconds before clients revalidate
+    file_resolve_x_sendfile = os.getenv('FILE_RESOLVE_X_SENDFILE', 'false').lower() == 'true'
+    preview_dir = os.getenv('PREVIEW_DIR', os.path.join(file_resolve_dir, 'preview'))  # Must be below FILE_RESOLVE_DIR
+    preview_workers = int(os.getenv('PREVIEW_WORKERS', 2))  # Processes rendering previews
+    preview_max_size = int(os.getenv('PREVIEW_MAX_SIZE', 512))  # Largest side in pixels
+    preview_format = os.getenv('PREVIEW_FORMAT', 'jpeg').lower()  # jpeg or png
+    preview_series_rule = os.getenv('PREVIEW_SERIES_RULE', 'first')  # first or largest series
+    preview_slice_rule = os.getenv('PREVIEW_SLICE_RULE', 'middle')  # middle or first instance
+    sync_workers = int(os.getenv('SYNC_WORKERS', 8))  # Worker threads used by /sync
+    ingest_workers = int(os.getenv('INGEST_WORKERS', os.cpu_count() or 4))  # Worker threads for inotify events
+    ingest_queue_size = int(os.getenv('INGEST_QUEUE_SIZE', 1000))
+
+    # C-MOVE destinations, e.g. "VIEWER=10.0.0.5:104,WS01=10.0.0.9:11112"
+    move_destinations = parse_move_destinations(os.getenv('MOVE_DESTINATIONS', ''))
 
     # Database and External URLs
     mongodb_url = os.getenv('MONGODB_URL')
     pacs_db_name = os.getenv('PACS_DB_NAME')
+    mongo_diagnostics = os.getenv('MONGO_DIAGNOSTICS', 'false').lower() == 'true'  # Log explain plans of slow queries
+    mongo_slow_query_ms = int(os.getenv('MONGO_SLOW_QUERY_MS', 100))
+
+    # Connection pool of the shared MongoDB client; unset options keep the pymongo defaults
+    mongo_max_pool_size = _optional_int('MONGO_MAX_POOL_SIZE')
+    mongo_min_pool_size = _optional_int('MONGO_MIN_POOL_SIZE')
+    mongo_max_idle_time_ms = _optional_int('MONGO_MAX_IDLE_TIME_MS')
+    mongo_wait_queue_timeout_ms = _optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS')  # Fail instead of waiting forever for a connection
+    mongo_connect_timeout_ms = _optional_int('MONGO_CONNECT_TIMEOUT_MS')
+    mongo_server_selection_timeout_ms = _optional_int('MONGO_SERVER_SELECTION_TIMEOUT_MS')
+    mongo_socket_timeout_ms = _optional_int('MONGO_SOCKET_TIMEOUT_MS')
     whatsapp_provider = os.getenv('WHATSAPP_PROVIDER')
+    whatsapp_token_refresh_margin = int(os.getenv('WHATSAPP_TOKEN_REFRESH_MARGIN', 300))  # Seconds before expiry to refresh
+    whatsapp_workers = int(os.getenv('WHATSAPP_WORKERS', 4))  # Notification queue workers per process
+    whatsapp_rate_limit = float(os.getenv('WHATSAPP_RATE_LIMIT', 5))  # Messages per second, shared by the gunicorn workers
+    whatsapp_max_attempts = int(os.getenv('WHATSAPP_MAX_ATTEMPTS', 5))
+    metadata_batch_size = int(os.getenv('METADATA_BATCH_SIZE', 500))  # Upserts per bulk_write batch
+    metadata_flush_interval = float(os.getenv('METADATA_FLUSH_INTERVAL', 1.0))  # Seconds between flushes
+    metadata_fields_file = os.getenv('METADATA_FIELDS_FILE')  # JSON overriding the indexed DICOM tags
     mroc_client_url = os.getenv('MROC_CLIENT_URL')
 
+    # ServiceRequest prefetch (seconds between sync cycles, 0 disables)
+    sr_sync_interval = int(os.getenv('SR_SYNC_INTERVAL', 300))
+    sr_sync_page_size = int(os.getenv('SR_SYNC_PAGE_SIZE', 100))
+    sr_sync_lookback_days = int(os.getenv('SR_SYNC_LOOKBACK_DAYS', 7))
+
     # OAuth credentials
     client_key = os.getenv('CLIENT_KEY')
     secret_key = os.getenv('SECRET_KEY')
 
-    # Get token using OAuth2
-    token = oauth2.get_token()
-
-    # Get DICOM configuration
-    dcm_config = satusehat.get_dcm_config(token)
+    # Seconds an OAuth2 token is reused before a new one is requested
+    token_ttl = int(os.getenv('TOKEN_TTL', 3000))
 
     # Enable encryption based on the environment variable, default to False if not found or set
     encrypt = os.getenv('ENCRYPT', 'false').lower() == 'true'
+
+    return dict(locals())
+
+
+def parse_ae_limits(value):
+    """
+    Parse a comma separated list of AE=associations:stores limits into a dict.
+
+    "CT01=4:8" allows CT01 4 concurrent associations with 8 C-STOREs in flight.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        ae_title, _, limit = item.partition('=')
+        associations, _, stores = limit.partition(':')
+        if not ae_title or not associations.isdigit() or (stores and not stores.isdigit()):
+            raise ValueError(f"Invalid DICOM_AE_LIMITS entry: {item}")
+        limits[ae_title.strip()] = (int(associations), int(stores) if stores else 0)
+    return limits
+
+
+def _optional_int(name):
+    """Return an integer environment variable, or None when it is not set."""
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def _fetch_token():
+    from utils import oauth2
+    return oauth2.get_token()
+
+
+def _fetch_dcm_config():
+    from interface import satusehat
+    return satusehat.get_dcm_config(remote('token'))
+
+
+# Values fetched from SATUSEHAT on first use: name -> (fetch function, TTL setting or None)
+_REMOTE = {
+    'token': (_fetch_token, 'token_ttl'),
+    'dcm_config': (_fetch_dcm_config, None),
+}
+
+
+def remote(name):
+    """
+    Return a remote configuration value, fetching it when missing or expired.
+
+    Concurrent callers share a single fetch. Failed fetches (None) are not
+    cached, so the next access retries. Also available as config.token and
+    config.dcm_config.
+    """
+    fetch, ttl_setting = _REMOTE[name]
+    entry = _remote.get(name)
+    if entry and (entry[1] is None or time.monotonic() < entry[1]):
+        return entry[0]
+
+    with _remote_locks[name]:
+        entry = _remote.get(name)
+        if entry and (entry[1] is None or time.monotonic() < entry[1]):
+            return entry[0]
+        value = fetch()
+        if value is not None:
+            ttl = getattr(init(), ttl_setting) if ttl_setting else None
+            _remote[name] = (value, time.monotonic() + ttl if ttl else None)
+        return value
+
+
+def prefetch():
+    """Fetch the remote values on a daemon thread so their first use does not wait."""
+    def run():
+        for name in _REMOTE:
+            try:
+                remote(name)
+            except Exception as e:
+                LOGGER.warning(f"Unable to prefetch {name}: {e}")
+
+    thread = threading.Thread(target=run, name='config-prefetch', daemon=True)
+    thread.start()
+    return thread
+
+
+def __getattr__(name):
+    if name in _REMOTE:
+        return remote(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _reset_after_fork():
+    """Fresh locks in the child; a fetch in flight in the parent never finishes here."""
+    global _remote_locks
+    _remote_locks = {name: threading.Lock() for name in _REMOTE}
+
+
+def parse_move_destinations(value):
+    """Parse a comma separated list of AE=host:port entries into a dict."""
+    destinations = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        ae_title, _, address = item.partition('=')
+        host, _, port = address.rpartition(':')
+        if not ae_title or not host or not port.isdigit():
+            raise ValueError(f"Invalid MOVE_DESTINATIONS entry: {item}")
+        destinations[ae_title.strip()] = (host.strip(), int(port))
+    return destinations
+
+
+_remote_locks.update({name: threading.Lock() for name in _REMOTE})
+os.register_at_fork(after_in_child=_reset_after_fork)
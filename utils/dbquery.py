@@ -1,33 +1,123 @@
 import logging
+import os
 import sqlite3
 import threading
 
 LOGGER = logging.getLogger('pynetdicom')
 
+# Milliseconds a writer waits for a lock held by another process
+BUSY_TIMEOUT_MS = 5000
+
+# Connection of the current process, shared by all its DBQuery instances
+_process_conn = None
+_process_lock = None
+_process_pid = None
+_connect_lock = threading.Lock()
+
 
 class DBQuery:
     def __init__(self):
-        # Initialize the database connection, cursor, and lock
-        self.conn = sqlite3.connect("instance.db", uri=True, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row  # Enables access to rows by column name
-        self.cursorObject = self.conn.cursor()
-        self.lock = threading.Lock()
+        # Attach to the database connection and lock of this process
+        self._connect()
 
         # SQL Queries
         self.GET_LAST_INSERT_ID = "SELECT last_insert_rowid()"
-        self.INSERT_SOP = "INSERT INTO dicom_obj VALUES (null,?,?,?,?,?,?,?,?,0,0)"
+        self.INSERT_SOP = "INSERT INTO dicom_obj VALUES (null,?,?,?,?,?,?,?,?,?,0)"
         self.UPDATE_ASSOC_COMPLETED = "UPDATE dicom_obj SET association_completed = 1 WHERE association_id = ?"
-        self.UPDATE_INSTANCE_STATUS_SENT = "UPDATE dicom_obj SET sent_status = 1 WHERE association_id = ? AND study_iuid = ? AND series_iuid = ? AND instance_uid = ?"
+        self.UPDATE_INSTANCE_STATUS_SENT = "UPDATE dicom_obj SET sent_status = 1 WHERE study_iuid = ? AND series_iuid = ? AND instance_uid = ? AND id <= ?"
         self.GET_IDS_PER_ASSOC = "SELECT DISTINCT study_iuid, accession_number FROM dicom_obj WHERE association_id = ?"
         self.GET_INSTANCES_PER_ASSOC = "SELECT study_iuid, series_iuid, instance_uid, sent_status FROM dicom_obj WHERE association_id = ? ORDER BY study_iuid, series_iuid, instance_uid"
         self.GET_INSTANCES_PER_STUDY = "SELECT series_iuid, instance_uid FROM dicom_obj WHERE association_id = ? AND study_iuid = ? ORDER BY series_iuid, instance_uid"
+        self.GET_UNSENT_INSTANCES_PER_STUDY = (
+            "SELECT d.series_iuid, d.instance_uid, d.fs_location, MAX(d.id), s.sha256 FROM dicom_obj d "
+            "LEFT JOIN instance_store s ON s.instance_uid = d.instance_uid WHERE d.study_iuid = ? AND d.sent_status = 0 "
+            "GROUP BY d.series_iuid, d.instance_uid, d.fs_location ORDER BY d.series_iuid, d.instance_uid"
+        )
+        self.GET_FILES_PER_STUDY = "SELECT fs_location FROM instance_store WHERE study_iuid = ?"
+        self.GET_ACCESSION_PER_STUDY = "SELECT accession_number FROM dicom_obj WHERE study_iuid = ? AND accession_number != '' LIMIT 1"
         self.QUERY_SOP = "SELECT * FROM dicom_obj WHERE association_id = ?"
+        self.GET_LOCATIONS = "SELECT DISTINCT instance_uid, fs_location FROM dicom_obj WHERE {}"
         self.INSERT_MWL = "INSERT OR REPLACE INTO work_list VALUES (COALESCE((SELECT id FROM work_list WHERE study_iuid = ?), NULL),?,?,?,?,?,?,?,?,?,?,0)"
         self.INSERT_PATIENT = "REPLACE INTO patient VALUES (?,?,?,?,?)"
+        self.GET_MWL_STUDIES = "SELECT study_iuid FROM work_list WHERE study_iuid IN (SELECT value FROM json_each(?))"
         self.GET_MWL = "SELECT a.*, b.patient_mrn, b.patient_name, b.patient_birthdate, b.patient_gender FROM work_list a LEFT JOIN patient b USING(patient_id)"
+        self.UPSERT_SERVICE_REQUEST = "INSERT OR REPLACE INTO service_request VALUES (?,?,?,?)"
+        self.GET_SERVICE_REQUEST_BY_ACSN = "SELECT id, patient_id FROM service_request WHERE accession_number = ? ORDER BY last_updated DESC LIMIT 1"
+        self.GET_SYNC_STATE = "SELECT value FROM sync_state WHERE name = ?"
+        self.SET_SYNC_STATE = "REPLACE INTO sync_state VALUES (?,?)"
+        self.GET_FILE_INDEX = "SELECT path, size, mtime, inode FROM file_index"
+        self.UPSERT_FILE_INDEX = "REPLACE INTO file_index VALUES (?,?,?,?,?)"
+        self.GET_INSTANCE_STORE = "SELECT * FROM instance_store WHERE instance_uid = ?"
+        self.UPSERT_INSTANCE_STORE = (
+            "INSERT INTO instance_store VALUES (?,?,?,?,?,?,0,?,NULL) ON CONFLICT(instance_uid) DO UPDATE SET "
+            "study_iuid = excluded.study_iuid, series_iuid = excluded.series_iuid, fs_location = excluded.fs_location, "
+            "size = excluded.size, stored_at = excluded.stored_at, sha256 = excluded.sha256, "
+            # Content changed since it was sent: it has to be sent again
+            "sent_status = CASE WHEN instance_store.sha256 = excluded.sha256 THEN instance_store.sent_status ELSE 0 END, "
+            "sent_at = CASE WHEN instance_store.sha256 = excluded.sha256 THEN instance_store.sent_at ELSE NULL END"
+        )
+        self.UPDATE_INSTANCE_STORE_SENT = "UPDATE instance_store SET sent_status = 1, sent_at = ? WHERE instance_uid = ? AND sha256 IS ?"
+        self.TAKE_ADMISSION_SLOT = (
+            "INSERT INTO admission_slot (ae_title, kind, pid) SELECT ?,?,? "
+            "WHERE (SELECT COUNT(*) FROM admission_slot WHERE ae_title = ? AND kind = ?) < ? "
+            "AND (SELECT COUNT(*) FROM admission_slot WHERE kind = ?) < ?"
+        )
+        self.FREE_ADMISSION_SLOT = "DELETE FROM admission_slot WHERE id = (SELECT id FROM admission_slot WHERE ae_title = ? AND kind = ? AND pid = ? LIMIT 1)"
+        self.FREE_ADMISSION_SLOTS_OF_PROCESS = "DELETE FROM admission_slot WHERE pid = ?"
+        self.CLEAR_ADMISSION_SLOTS = "DELETE FROM admission_slot"
+        self.COUNT_ADMISSION_SLOTS = "SELECT ae_title, kind, COUNT(*) AS slots FROM admission_slot GROUP BY ae_title, kind"
+        self.INSERT_SYNC_JOB = (
+            "INSERT INTO sync_job (id, folder, status, owner_pid, heartbeat_at, created_at) SELECT ?,?,'queued',?,?,? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sync_job WHERE status IN ('queued','running') AND heartbeat_at > ?)"
+        )
+        self.UPDATE_SYNC_JOB = "UPDATE sync_job SET status = ?, error = ?, started_at = ?, finished_at = ?, discovered = ?, skipped = ?, indexed = ?, failed = ?, heartbeat_at = ? WHERE id = ?"
+        self.ABANDON_SYNC_JOBS = "UPDATE sync_job SET status = 'failed', error = 'Abandoned by a stopped process', finished_at = ? WHERE status IN ('queued','running') AND heartbeat_at <= ?"
+        self.TRIM_SYNC_JOBS = "DELETE FROM sync_job WHERE id NOT IN (SELECT id FROM sync_job ORDER BY created_at DESC LIMIT ?)"
+        self.GET_SYNC_JOB = "SELECT * FROM sync_job WHERE id = ?"
+        self.GET_LATEST_SYNC_JOB = "SELECT * FROM sync_job ORDER BY created_at DESC LIMIT 1"
+        self.INSERT_STUDY_UPLOAD = "INSERT OR IGNORE INTO study_upload (study_iuid) VALUES (?)"
+        self.GET_STUDY_UPLOAD = "SELECT * FROM study_upload WHERE study_iuid = ?"
+        self.CLAIM_STUDY_UPLOAD = "UPDATE study_upload SET owner = ?, owner_pid = ? WHERE study_iuid = ? AND owner IS NULL"
+        self.RELEASE_STUDY_UPLOAD = "UPDATE study_upload SET owner = NULL, owner_pid = NULL WHERE study_iuid = ? AND owner = ?"
+        self.CLEAR_STUDY_UPLOAD_CLAIMS = "UPDATE study_upload SET owner = NULL, owner_pid = NULL WHERE owner IS NOT NULL"
+        self.SET_STUDY_UPLOAD_ID = "UPDATE study_upload SET imaging_study_id = ? WHERE study_iuid = ?"
+        self.INSERT_MPPS = "INSERT INTO mpps VALUES (?,?,?,?,?,?,0,?,?)"
+        self.GET_MPPS = "SELECT * FROM mpps WHERE sop_instance_uid = ?"
+        self.UPDATE_MPPS = "UPDATE mpps SET study_iuid = ?, status = ?, dataset = ?, updated_at = ? WHERE sop_instance_uid = ?"
+        self.GET_PENDING_MPPS_PER_STUDY = "SELECT sop_instance_uid, status FROM mpps WHERE study_iuid = ? AND (status = 'IN PROGRESS' OR (status = 'COMPLETED' AND processed = 0))"
+        self.GET_MPPS_COMPLETED_PER_STUDY = "SELECT sop_instance_uid, accession_number FROM mpps WHERE study_iuid = ? AND status = 'COMPLETED' AND processed = 0"
+        self.CLAIM_MPPS = "UPDATE mpps SET processed = 1 WHERE sop_instance_uid = ? AND processed = 0"
+        self.INSERT_MPPS_INSTANCE = "INSERT OR IGNORE INTO mpps_instance VALUES (?,?,?,?)"
+        self.COUNT_MPPS_INSTANCES = "SELECT COALESCE(SUM(EXISTS (SELECT 1 FROM dicom_obj d WHERE d.study_iuid = m.study_iuid AND d.instance_uid = m.instance_uid)), 0), COUNT(*) FROM mpps_instance m WHERE m.mpps_uid = ?"
 
-        # Create necessary tables if they don't exist
-        self._create_tables()
+    def _connect(self):
+        """
+        Attaches to the connection of the current process, opening it first if needed.
+
+        WAL lets the SCP worker processes read while one of them writes, and
+        the busy timeout makes concurrent writers wait instead of failing.
+        The connection is opened and the schema created once per process;
+        DBQuery instances created per request or per C-STORE reuse them.
+        """
+        global _process_conn, _process_lock, _process_pid
+        with _connect_lock:
+            if _process_pid != os.getpid():
+                conn = sqlite3.connect("instance.db", uri=True, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000)
+                conn.row_factory = sqlite3.Row  # Enables access to rows by column name
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn = conn
+                self._create_tables()
+                _process_conn, _process_lock, _process_pid = conn, threading.Lock(), os.getpid()
+            self.conn = _process_conn
+            self.lock = _process_lock
+            self.pid = _process_pid
+
+    def _check_fork(self):
+        """Reconnects in a forked child; SQLite connections must not be shared across fork."""
+        if self.pid != os.getpid():
+            self._connect()
 
     def _create_tables(self):
         """Creates the required tables if they don't already exist."""
@@ -46,6 +136,9 @@ class DBQuery:
             association_completed SMALLINT
         );
         """
+        create_dicom_obj_index = """
+        CREATE INDEX IF NOT EXISTS idx_dicom_obj_study ON dicom_obj (study_iuid, instance_uid);
+        """
         create_patient_table = """
         CREATE TABLE IF NOT EXISTS patient (
             patient_id VARCHAR(32) PRIMARY KEY,
@@ -71,19 +164,140 @@ class DBQuery:
             sent_status SMALLINT
         );
         """
+        create_service_request_table = """
+        CREATE TABLE IF NOT EXISTS service_request (
+            id VARCHAR(64) PRIMARY KEY,
+            accession_number VARCHAR(32),
+            patient_id VARCHAR(64),
+            last_updated VARCHAR(32)
+        );
+        """
+        create_service_request_index = """
+        CREATE INDEX IF NOT EXISTS idx_service_request_accession ON service_request (accession_number);
+        """
+        create_sync_state_table = """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name VARCHAR(64) PRIMARY KEY,
+            value VARCHAR(256)
+        );
+        """
+        create_file_index_table = """
+        CREATE TABLE IF NOT EXISTS file_index (
+            path VARCHAR(1024) PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            inode INTEGER,
+            indexed_at VARCHAR(32)
+        );
+        """
+        create_admission_slot_table = """
+        CREATE TABLE IF NOT EXISTS admission_slot (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ae_title VARCHAR(32),
+            kind VARCHAR(16),
+            pid INTEGER
+        );
+        """
+        create_admission_slot_index = """
+        CREATE INDEX IF NOT EXISTS idx_admission_slot ON admission_slot (kind, ae_title);
+        """
+        create_sync_job_table = """
+        CREATE TABLE IF NOT EXISTS sync_job (
+            id VARCHAR(32) PRIMARY KEY,
+            folder VARCHAR(1024),
+            status VARCHAR(16),
+            error TEXT,
+            owner_pid INTEGER,
+            started_at VARCHAR(32),
+            finished_at VARCHAR(32),
+            discovered INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,
+            indexed INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            heartbeat_at REAL,
+            created_at REAL
+        );
+        """
+        create_instance_store_table = """
+        CREATE TABLE IF NOT EXISTS instance_store (
+            instance_uid VARCHAR(64) PRIMARY KEY,
+            study_iuid VARCHAR(64),
+            series_iuid VARCHAR(64),
+            fs_location VARCHAR(1024),
+            sha256 VARCHAR(64),
+            size INTEGER,
+            sent_status SMALLINT,
+            stored_at VARCHAR(32),
+            sent_at VARCHAR(32)
+        );
+        """
+        create_instance_store_index = """
+        CREATE INDEX IF NOT EXISTS idx_instance_store_study ON instance_store (study_iuid);
+        """
+        create_mpps_table = """
+        CREATE TABLE IF NOT EXISTS mpps (
+            sop_instance_uid VARCHAR(64) PRIMARY KEY,
+            study_iuid VARCHAR(64),
+            accession_number VARCHAR(32),
+            scu_ae VARCHAR(32),
+            status VARCHAR(16),
+            dataset TEXT,
+            processed SMALLINT,
+            created_at VARCHAR(32),
+            updated_at VARCHAR(32)
+        );
+        """
+        create_mpps_index = """
+        CREATE INDEX IF NOT EXISTS idx_mpps_study ON mpps (study_iuid);
+        """
+        create_mpps_instance_table = """
+        CREATE TABLE IF NOT EXISTS mpps_instance (
+            mpps_uid VARCHAR(64),
+            study_iuid VARCHAR(64),
+            series_iuid VARCHAR(64),
+            instance_uid VARCHAR(64),
+            PRIMARY KEY (mpps_uid, instance_uid)
+        );
+        """
+        create_study_upload_table = """
+        CREATE TABLE IF NOT EXISTS study_upload (
+            study_iuid VARCHAR(64) PRIMARY KEY,
+            imaging_study_id VARCHAR(64),
+            owner VARCHAR(64),
+            owner_pid INTEGER
+        );
+        """
         self.conn.execute(create_dicom_obj_table)
+        self.conn.execute(create_dicom_obj_index)
         self.conn.execute(create_patient_table)
         self.conn.execute(create_worklist_table)
+        self.conn.execute(create_service_request_table)
+        self.conn.execute(create_service_request_index)
+        self.conn.execute(create_sync_state_table)
+        self.conn.execute(create_file_index_table)
+        self.conn.execute(create_admission_slot_table)
+        self.conn.execute(create_admission_slot_index)
+        self.conn.execute(create_sync_job_table)
+        self.conn.execute(create_instance_store_table)
+        self.conn.execute(create_instance_store_index)
+        self.conn.execute(create_mpps_table)
+        self.conn.execute(create_mpps_index)
+        self.conn.execute(create_mpps_instance_table)
+        self.conn.execute(create_study_upload_table)
 
     def _execute_query(self, query, entries=(), commit=False):
         """Executes a query with locking and optional commit."""
+        self._check_fork()
         try:
             self.lock.acquire(True)
             cursor = self.conn.cursor()
-            cursor.execute("BEGIN;")
+            # Reads must not open a transaction that is never committed
+            if commit:
+                cursor.execute("BEGIN;")
             cursor.execute(query, entries)
             if commit:
-                cursor.execute("COMMIT;")
+                # On the connection, so the cursor keeps the rowcount of the query
+                self.conn.execute("COMMIT;")
             return cursor
         except Exception as err:
             LOGGER.exception("Database query failed: %s", err)
@@ -93,8 +307,9 @@ class DBQuery:
             self.lock.release()
 
     def update(self, query, entries):
-        """Performs an update query with thread-safe locking."""
-        self._execute_query(query, entries, commit=True)
+        """Performs an update query with thread-safe locking. Returns the number of rows changed."""
+        cursor = self._execute_query(query, entries, commit=True)
+        return cursor.rowcount if cursor else 0
 
     def insert(self, query, entries):
         """Performs an insert query with thread-safe locking."""
@@ -104,6 +319,30 @@ class DBQuery:
         """Performs a delete query with thread-safe locking."""
         self._execute_query(query, entries, commit=True)
 
+    def insert_many(self, statements, lookup=None):
+        """
+        Executes several statements with many rows each in a single transaction.
+
+        `statements` is a list of (query, rows) pairs. Unlike insert(), errors
+        are raised to the caller after the transaction is rolled back.
+        `lookup` is an optional (query, entries) pair run first in the same
+        transaction, which takes the write lock up front; its rows are returned.
+        """
+        self._check_fork()
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE;")
+                found = cursor.execute(*lookup).fetchall() if lookup else None
+                for query, rows in statements:
+                    if rows:
+                        cursor.executemany(query, rows)
+                cursor.execute("COMMIT;")
+                return found
+            except Exception:
+                self.conn.rollback()
+                raise
+
     def query(self, query, entries=()):
         """Executes a SELECT query and returns the results."""
         cursor = self._execute_query(query, entries)
@@ -115,6 +354,15 @@ class DBQuery:
         return cursor.fetchone()[0] if cursor else None
 
 
+def _reset_after_fork():
+    """The connect lock may have been held by a parent thread at fork time."""
+    global _connect_lock
+    _connect_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 """
 
 CREATE TABLE IF NOT EXISTS patient (
@@ -136,16 +136,18 @@ def get_study_description(ds):
         return "No Description"
 
 
-def process_dicom_to_fhir(dcm_dir, imagingStudyID, serviceRequestID, patientID):
-    """Process DICOM files and convert to FHIR ImagingStudy resource."""
-    files = [os.path.join(r, file) for r, _, f in os.walk(dcm_dir) for file in f if '.dcm' in file]
+def process_dicom_to_fhir(dcm_dir, imagingStudyID, serviceRequestID, patientID, files=None):
+    """Process DICOM files (those of dcm_dir unless given) and convert to FHIR ImagingStudy resource."""
+    if files is None:
+        files = [os.path.join(r, file) for r, _, f in os.walk(dcm_dir) for file in f if '.dcm' in file]
 
     imaging_study = None
     studyInstanceUID = None
 
     try:
         for fp in files:
-            with dcmread(fp, force=True) as ds:
+            # Only header attributes are used, skip reading the pixel data
+            with dcmread(fp, force=True, stop_before_pixels=True) as ds:
                 if studyInstanceUID is None:
                     studyInstanceUID = ds.StudyInstanceUID
 
@@ -0,0 +1,104 @@
+import json
+
+from pydicom import dcmread
+from pydicom.datadict import tag_for_keyword
+from pydicom.tag import Tag
+
+# Declarative description of the documents stored per collection:
+# collection -> {document field: DICOM keyword}
+METADATA_FIELDS = {
+    "patient": {
+        "patient_id": "PatientID",
+        "patient_name": "PatientName",
+    },
+    "study": {
+        "patient_id": "PatientID",
+        "study_id": "StudyID",
+        "study_instance_uid": "StudyInstanceUID",
+        "study_date": "StudyDate",
+        "study_time": "StudyTime",
+        "study_description": "StudyDescription",
+        "accession_number": "AccessionNumber",
+    },
+    "series": {
+        "patient_id": "PatientID",
+        "study_id": "StudyID",
+        "series_number": "SeriesNumber",
+        "series_instance_uid": "SeriesInstanceUID",
+        "series_date": "SeriesDate",
+        "series_time": "SeriesTime",
+        "series_description": "SeriesDescription",
+        "body_part_examined": "BodyPartExamined",
+        "modality": "Modality",
+    },
+    "image": {
+        "patient_id": "PatientID",
+        "study_id": "StudyID",
+        "series_number": "SeriesNumber",
+        "instance_number": "InstanceNumber",
+        "sop_instance_uid": "SOPInstanceUID",
+    },
+}
+
+
+def load_metadata_fields(path=None):
+    """
+    Return the metadata field lists, optionally extended from a JSON file.
+
+    Args:
+        path (str, optional): JSON file with the same shape as METADATA_FIELDS.
+            Its fields are merged into (and override) the defaults.
+
+    Returns:
+        dict: collection -> {document field: DICOM keyword}
+    """
+    fields = {collection: dict(mapping) for collection, mapping in METADATA_FIELDS.items()}
+    if path:
+        with open(path) as fp:
+            for collection, mapping in json.load(fp).items():
+                fields.setdefault(collection, {}).update(mapping)
+    return fields
+
+
+class MetadataExtractor:
+    """
+    Extracts the patient/study/series/image documents of a file in one pass.
+
+    The field lists are compiled to DICOM tags once. Each file is read up to
+    the pixel data and only the tags in use are parsed; every value is
+    converted once and shared by all documents that need it.
+    """
+
+    def __init__(self, fields=None):
+        fields = fields or METADATA_FIELDS
+        self.fields = {}
+        for collection, mapping in fields.items():
+            compiled = []
+            for name, keyword in mapping.items():
+                tag = tag_for_keyword(keyword) if not keyword[:1].isdigit() else Tag(int(keyword, 16))
+                if tag is None:
+                    raise ValueError(f"Unknown DICOM keyword for {collection}.{name}: {keyword}")
+                compiled.append((name, Tag(tag)))
+            self.fields[collection] = compiled
+        self.tags = sorted({tag for compiled in self.fields.values() for _, tag in compiled})
+
+    def read(self, pathname):
+        """Read only the tags in use, stopping before the pixel data."""
+        return dcmread(pathname, force=True, stop_before_pixels=True, specific_tags=self.tags)
+
+    def extract(self, pathname, ds=None):
+        """Return a dict of collection -> document for the file at `pathname`."""
+        ds = ds if ds is not None else self.read(pathname)
+
+        values = {}
+        for tag in self.tags:
+            elem = ds.get(tag)
+            values[tag] = str(elem.value) if elem is not None and elem.value is not None else None
+
+        documents = {
+            collection: {name: values[tag] for name, tag in compiled}
+            for collection, compiled in self.fields.items()
+        }
+        if "image" in documents:
+            documents["image"]["path"] = str(pathname)
+        return documents
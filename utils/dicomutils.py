@@ -1,6 +1,19 @@
 import hashlib
 import hmac
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom.filereader import read_file_meta_info
+from pynetdicom.presentation import build_context
+
+LOGGER = logging.getLogger('pynetdicom')
+
+# Number of threads reading file meta information before files are sent
+META_PREFETCH_WORKERS = 8
+
+# Association requestors are limited to 128 presentation contexts
+MAX_REQUESTED_CONTEXTS = 128
 
 
 def make_association_id(event) -> str:
@@ -16,6 +29,40 @@ def make_hash(study_id: str) -> str:
     return hmac.new(byte_key, message, hashlib.sha256).hexdigest()
 
 
+def read_meta(path):
+    """Read the SOP Class and Transfer Syntax from the file meta information; None if unreadable."""
+    try:
+        meta = read_file_meta_info(path)
+        return meta.MediaStorageSOPClassUID, meta.TransferSyntaxUID
+    except Exception as e:
+        LOGGER.warning(f"Unable to read file meta information from {path}: {e}")
+        return None
+
+
+def read_metas(paths):
+    """read_meta() of every path, in order, on a small thread pool."""
+    with ThreadPoolExecutor(max_workers=META_PREFETCH_WORKERS) as executor:
+        return list(executor.map(read_meta, paths))
+
+
+def transfer_syntaxes_by_sop_class(metas):
+    """Group (SOP Class, Transfer Syntax) pairs by SOP Class, skipping unreadable files."""
+    required = {}
+    for meta in metas:
+        if meta:
+            sop_class, transfer_syntax = meta
+            required.setdefault(sop_class, set()).add(transfer_syntax)
+    return required
+
+
+def requested_contexts(required):
+    """Build one presentation context per (SOP Class, Transfer Syntaxes), up to the association limit."""
+    required = list(required)
+    if len(required) > MAX_REQUESTED_CONTEXTS:
+        LOGGER.warning(f"{len(required)} SOP Classes to send, only the first {MAX_REQUESTED_CONTEXTS} can be negotiated")
+    return [build_context(sop_class, sorted(syntaxes)) for sop_class, syntaxes in required[:MAX_REQUESTED_CONTEXTS]]
+
+
 class DcmModel:
     """Represents a DICOM model with attributes extracted from a JSON string."""
 
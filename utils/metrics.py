@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+import time
+
+# Registered metric providers, keyed by name
+_providers = {}
+_lock = threading.Lock()
+
+
+def register(name, provider):
+    """
+    Register a callable returning a JSON serializable dict of metrics.
+
+    Args:
+        name (str): The key the metrics are reported under.
+        provider (callable): Called on every snapshot.
+    """
+    with _lock:
+        _providers[name] = provider
+
+
+def snapshot():
+    """
+    Collect the current metrics of all registered providers.
+
+    Returns:
+        dict: Metrics keyed by provider name.
+    """
+    with _lock:
+        providers = dict(_providers)
+    return {name: provider() for name, provider in providers.items()}
+
+
+def publish(directory, name, interval=10):
+    """
+    Periodically write this process's snapshot to `directory`, for processes without an HTTP endpoint.
+
+    Args:
+        directory (str): Shared folder read by collect().
+        name (str): Process role, e.g. "dicom"; the pid is appended.
+        interval (float): Seconds between writes.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    def run():
+        while True:
+            path = os.path.join(directory, f"{name}-{os.getpid()}.json")
+            try:
+                with open(f"{path}.tmp", "w") as fp:
+                    json.dump({"updated_at": time.time(), "interval": interval, "metrics": snapshot()}, fp, default=str)
+                os.replace(f"{path}.tmp", path)
+            except (OSError, TypeError, ValueError):
+                pass
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="metrics-publisher", daemon=True)
+    thread.start()
+    return thread
+
+
+def collect(directory):
+    """
+    Read the snapshots published by other processes, skipping stale ones.
+
+    Returns:
+        dict: Metrics keyed by "<name>-<pid>".
+    """
+    collected = {}
+    if not directory or not os.path.isdir(directory):
+        return collected
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as fp:
+                published = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        # Processes that stopped publishing are gone
+        if time.time() - published.get("updated_at", 0) > 3 * published.get("interval", 10):
+            continue
+        collected[filename[:-len(".json")]] = published["metrics"]
+    return collected
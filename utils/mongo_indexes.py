@@ -0,0 +1,162 @@
+import logging
+import queue
+import threading
+
+from pymongo import ASCENDING, IndexModel, monitoring
+from pymongo.errors import PyMongoError
+
+LOGGER = logging.getLogger("flask_server")
+
+# Indexes required by the access paths of the router, per collection.
+# Unique indexes mirror the upsert filters of the metadata writer and
+# /dicom-upsert; study stays non-unique because /dicom-upsert also filters
+# on study_instance_uid there.
+INDEXES = {
+    "patient": [
+        IndexModel([("patient_id", ASCENDING)], name="patient_id_unique", unique=True),
+    ],
+    "study": [
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING)], name="patient_study"),
+        IndexModel([("study_instance_uid", ASCENDING)], name="study_instance_uid"),
+    ],
+    "series": [
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING), ("series_instance_uid", ASCENDING)],
+                   name="patient_study_series_unique", unique=True),
+        IndexModel([("series_instance_uid", ASCENDING)], name="series_instance_uid"),
+    ],
+    "image": [
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING), ("sop_instance_uid", ASCENDING)],
+                   name="patient_study_instance_unique", unique=True),
+        IndexModel([("sop_instance_uid", ASCENDING)], name="sop_instance_uid"),
+        IndexModel([("path", ASCENDING)], name="path"),
+        # dicom_to_satusehat_task: filter on patient/study/status, sort by series_number
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING),
+                    ("integration_status_satusehat", ASCENDING), ("series_number", ASCENDING)],
+                   name="patient_study_status_series"),
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING),
+                    ("series_number", ASCENDING), ("instance_number", ASCENDING)],
+                   name="patient_study_series_instance"),
+    ],
+    "integration": [
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING), ("accession_number", ASCENDING)],
+                   name="patient_study_accession"),
+    ],
+    "integration_job": [
+        IndexModel([("patient_id", ASCENDING), ("study_id", ASCENDING), ("accession_number", ASCENDING),
+                    ("created_at", ASCENDING)], name="patient_study_accession_created"),
+        IndexModel([("status", ASCENDING)], name="status"),
+    ],
+    "whatsapp_token": [
+        IndexModel([("is_active", ASCENDING)], name="is_active"),
+    ],
+    "whatsapp_notification": [
+        # Deduplicates notifications per (patient phone, study)
+        IndexModel([("dedup_key", ASCENDING)], name="dedup_key_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+    ],
+}
+
+# Commands that can be explained when they turn out to be slow
+_EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+
+# Session and cluster fields that explain does not accept
+_STRIP_FIELDS = {"lsid", "$clusterTime", "$db", "txnNumber", "autocommit", "startTransaction",
+                 "$readPreference", "readConcern", "writeConcern"}
+
+
+def missing_indexes(db, indexes=None):
+    """
+    Compare the declared indexes with the ones present in the database.
+
+    Returns:
+        dict: collection name -> list of IndexModel that do not exist yet.
+    """
+    missing = {}
+    for collection, models in (indexes or INDEXES).items():
+        existing = {tuple(info["key"]) for info in db[collection].index_information().values()}
+        absent = [model for model in models if tuple(model.document["key"].items()) not in existing]
+        if absent:
+            missing[collection] = absent
+    return missing
+
+
+def ensure_indexes(db, indexes=None):
+    """Create every declared index that is missing. Returns the names created."""
+    created = []
+    for collection, models in missing_indexes(db, indexes).items():
+        for model in models:
+            name = model.document["name"]
+            try:
+                # Builds are non-blocking on MongoDB 4.2+; background=True covers older servers
+                db[collection].create_index(list(model.document["key"].items()), name=name, background=True,
+                                            **{k: v for k, v in model.document.items() if k not in ("key", "name")})
+                created.append(f"{collection}.{name}")
+                LOGGER.info(f"Created index {name} on {collection}")
+            except PyMongoError as e:
+                LOGGER.error(f"Unable to create index {name} on {collection}: {e}")
+    return created
+
+
+def ensure_indexes_in_background(db, indexes=None):
+    """Reconcile the declared indexes on a daemon thread so startup is not delayed."""
+    def run():
+        try:
+            created = ensure_indexes(db, indexes)
+            LOGGER.info(f"Index reconciliation finished, {len(created)} index(es) created")
+        except PyMongoError as e:
+            LOGGER.error(f"Index reconciliation failed: {e}")
+
+    thread = threading.Thread(target=run, name="mongo-index-reconciler", daemon=True)
+    thread.start()
+    return thread
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Logs the explain plan of commands slower than `threshold_ms`.
+
+    Explains run on a separate thread and client so the command being
+    monitored is never delayed.
+    """
+
+    def __init__(self, client_factory, threshold_ms=100):
+        self.client_factory = client_factory
+        self.threshold_ms = threshold_ms
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=100)
+        self.thread = threading.Thread(target=self._explain_worker, name="mongo-slow-query", daemon=True)
+        self.thread.start()
+
+    def started(self, event):
+        if event.command_name in _EXPLAINABLE:
+            command = {k: v for k, v in event.command.items() if k not in _STRIP_FIELDS}
+            with self.lock:
+                self.in_flight[event.request_id] = (event.database_name, command)
+
+    def succeeded(self, event):
+        with self.lock:
+            started = self.in_flight.pop(event.request_id, None)
+        duration_ms = event.duration_micros / 1000
+        if started and duration_ms >= self.threshold_ms:
+            try:
+                self.queue.put_nowait((duration_ms, *started))
+            except queue.Full:
+                pass
+
+    def failed(self, event):
+        with self.lock:
+            self.in_flight.pop(event.request_id, None)
+
+    def _explain_worker(self):
+        client = None
+        while True:
+            duration_ms, database_name, command = self.queue.get()
+            try:
+                client = client or self.client_factory()
+                plan = client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+                winning = plan.get("queryPlanner", {}).get("winningPlan", {})
+                LOGGER.warning(f"Slow query ({duration_ms:.1f} ms) on {database_name}: {command} "
+                               f"-> winning plan: {winning}")
+            except PyMongoError as e:
+                LOGGER.warning(f"Unable to explain slow query on {database_name}: {e}")
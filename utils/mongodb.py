@@ -1,26 +1,146 @@
-from pymongo import MongoClient
-from utils import config
+from pymongo import MongoClient, monitoring
+from utils import config, metrics
+from utils.mongo_indexes import SlowQueryListener
 import certifi
 import os
+import threading
+import time
 
 # Initialize configuration
 config.init()
 
+# Slow query listener shared by all clients when diagnostics are enabled
+_slow_query_listener = None
+
+# Client shared by the modules of the current process, see shared_client()
+_shared_client = None
+_shared_client_lock = threading.Lock()
+_pool_listener = None
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+		"""
+		Counts connections and measures how long threads wait to check one out.
+
+		pymongo publishes the check out events on the requesting thread, so the
+		start time is kept in a thread local.
+		"""
+
+		def __init__(self):
+				self.local = threading.local()
+				self.lock = threading.Lock()
+				self.stats = {
+						"checkouts": 0,
+						"checkout_failures": 0,
+						"in_use": 0,
+						"open": 0,
+						"total_wait_ms": 0.0,
+						"max_wait_ms": 0.0,
+						"pool_clears": 0,
+				}
+
+		def metrics(self):
+				"""Return connection counts and checkout wait times."""
+				with self.lock:
+						stats = dict(self.stats)
+				total = stats.pop("total_wait_ms")
+				stats["avg_wait_ms"] = round(total / stats["checkouts"], 3) if stats["checkouts"] else 0
+				stats["max_wait_ms"] = round(stats["max_wait_ms"], 3)
+				return stats
+
+		def _count(self, key, delta=1):
+				with self.lock:
+						self.stats[key] += delta
+
+		def connection_check_out_started(self, event):
+				self.local.started = time.monotonic()
+
+		def connection_checked_out(self, event):
+				waited = (time.monotonic() - getattr(self.local, "started", time.monotonic())) * 1000
+				with self.lock:
+						self.stats["checkouts"] += 1
+						self.stats["in_use"] += 1
+						self.stats["total_wait_ms"] += waited
+						self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], waited)
+
+		def connection_check_out_failed(self, event):
+				self._count("checkout_failures")
+
+		def connection_checked_in(self, event):
+				self._count("in_use", -1)
+
+		def connection_created(self, event):
+				self._count("open")
+
+		def connection_closed(self, event):
+				self._count("open", -1)
+
+		def pool_cleared(self, event):
+				self._count("pool_clears")
+
+		def connection_ready(self, event):
+				pass
+
+		def pool_created(self, event):
+				pass
+
+		def pool_ready(self, event):
+				pass
+
+		def pool_closed(self, event):
+				pass
+
+
+def _pool_options():
+		"""
+		Return the connection pool settings of the shared client.
+
+		Returns:
+				dict: MongoClient keyword arguments for the options that are set.
+		"""
+		options = {
+				"maxPoolSize": config.mongo_max_pool_size,
+				"minPoolSize": config.mongo_min_pool_size,
+				"maxIdleTimeMS": config.mongo_max_idle_time_ms,
+				"waitQueueTimeoutMS": config.mongo_wait_queue_timeout_ms,
+				"connectTimeoutMS": config.mongo_connect_timeout_ms,
+				"serverSelectionTimeoutMS": config.mongo_server_selection_timeout_ms,
+				"socketTimeoutMS": config.mongo_socket_timeout_ms,
+		}
+		return {key: value for key, value in options.items() if value is not None}
+
+
+def _event_listeners():
+		"""
+		Return the command listeners to attach to new clients.
+
+		Returns:
+				list: A SlowQueryListener in diagnostic mode, otherwise empty.
+		"""
+		global _slow_query_listener
+		if not config.mongo_diagnostics:
+				return []
+		if _slow_query_listener is None:
+				_slow_query_listener = SlowQueryListener(
+						lambda: MongoClient(config.mongodb_url, tlsCAFile=certifi.where()),
+						config.mongo_slow_query_ms
+				)
+		return [_slow_query_listener]
+
 def connect_mongodb(coll=None, client=None):
 		"""
 		Connect to a MongoDB collection.
 
 		Args:
 				coll (str, optional): The name of the collection to connect to. Defaults to "dicom_metadata".
-				client (MongoClient, optional): An existing MongoClient instance. If not provided, a new instance is created.
+				client (MongoClient, optional): An existing MongoClient instance. Defaults to the shared client.
 
 		Returns:
 				Collection: A MongoDB collection object.
 		"""
-		mongodb_url = config.mongodb_url
 		db_name = config.pacs_db_name
 		if client is None:
-				client = MongoClient(mongodb_url,  tlsCAFile=certifi.where())
+				client = shared_client()
 
 		db = client[db_name]
 		collection_name = coll or "dicom_metadata"  # Use default collection if coll is None
@@ -30,8 +150,53 @@ def client_mongodb():
 		"""
 		Create and return a new MongoClient instance.
 
+		Prefer shared_client(); every client owns a connection pool and monitor threads.
+
 		Returns:
 				MongoClient: A new MongoClient connected to the MongoDB server.
 		"""
 		mongodb_url = config.mongodb_url
-		return MongoClient(mongodb_url, tlsCAFile=certifi.where())
+		return MongoClient(mongodb_url, tlsCAFile=certifi.where(), event_listeners=_event_listeners())
+
+
+def shared_client():
+		"""
+		Return the MongoClient shared within the current process.
+
+		The client is created on first use and dropped in forked children, so
+		each worker process (DICOM, HTTP, WSGI workers) opens its own sockets
+		instead of inheriting the ones of its parent.
+
+		Returns:
+				MongoClient: The client of the current process.
+		"""
+		global _shared_client, _pool_listener
+		if _shared_client is None:
+				with _shared_client_lock:
+						if _shared_client is None:
+								_pool_listener = PoolListener()
+								_shared_client = MongoClient(
+										config.mongodb_url, tlsCAFile=certifi.where(),
+										event_listeners=_event_listeners() + [_pool_listener], **_pool_options()
+								)
+								metrics.register("mongo_pool", _pool_listener.metrics)
+		return _shared_client
+
+def shared_db():
+		"""
+		Return the PACS database on the shared client.
+
+		Returns:
+				Database: The database named by PACS_DB_NAME.
+		"""
+		return shared_client()[config.pacs_db_name]
+
+def _reset_after_fork():
+		"""Forget the parent's client and listener; neither its sockets nor its threads survive a fork."""
+		global _shared_client, _shared_client_lock, _slow_query_listener, _pool_listener
+		_shared_client = None
+		_pool_listener = None
+		_shared_client_lock = threading.Lock()
+		_slow_query_listener = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
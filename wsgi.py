@@ -0,0 +1,7 @@
+"""
+WSGI entry point for the Flask API, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+from internal.flask_server import app  # noqa: E402